@@ -0,0 +1,90 @@
+"""File containing an offline-compiled belief graph for the ATM planners.
+
+Between measurements, the beliefs of the planner only depend on the last measured state and the actions taken.
+The graph contains all beliefs reachable from each (measured) state in up to 'depth' steps, with for each belief its
+optimal actions and, for each of these, the next belief and the measuring decision. Episodes can then be run
+as walks over node IDs (see ACNO_Planner.run_episode_compiled)."""
+import numpy as np
+import time as t
+
+from AM_Gyms.AM_Belief import Belief
+from ACNO_Beliefs import rtol, atol
+
+class BeliefGraph():
+    """Belief graph stored as flat arrays. For node n and action a:
+        - node_actions[node_action_ptr[n]:node_action_ptr[n+1]]: optimal actions in n (ties are broken randomly online);
+        - edge_next[n,a]: next node, or MEASURE if the planner measures (or OUTSIDE if (n,a) is not compiled);
+        - edge_unchanged[n,a]: whether the belief stays the same (which forces a measurement);
+        - edge_next_ties[n,a]: number of optimal actions in the next belief, also if it is not stored."""
+
+    MEASURE = -1
+    OUTSIDE = -2
+
+    def __init__(self, planner, depth:int = 5, max_nodes:int = 1_000_000, precision:float = 1e-9, logging:bool = False):
+        """Compiles the graph for the given planner, up to depth steps after each measurement
+        (and at most max_nodes nodes, not counting the root nodes of all states, which are always included)."""
+        t_start = t.perf_counter()
+        self.depth, self.precision = depth, precision
+        StateSize, ActionSize = planner.StateSize, planner.ActionSize
+
+        self.beliefs, node_ids, node_depth = [], {}, []
+        def get_node(b:Belief, depth:int, is_root:bool = False):
+            key = b.key(precision)
+            if key not in node_ids:
+                if len(self.beliefs) >= max_nodes and not is_root:
+                    return self.OUTSIDE
+                node_ids[key] = len(self.beliefs)
+                self.beliefs.append(b)
+                node_depth.append(depth)
+            return node_ids[key]
+
+        self.root = np.array([get_node(Belief.point(s), 0, is_root=True) for s in range(StateSize)], dtype=np.int64)
+
+        # Expand all nodes in order of creation (i.e. breadth-first)
+        node_actions, edges = [], []
+        n = 0
+        while n < len(self.beliefs):
+            b = self.beliefs[n]
+            actions = planner.determine_action_set(b)
+            node_actions.append(actions)
+            if node_depth[n] < depth:
+                for a in actions:
+                    edges.append((n, a) + self.compile_edge(planner, b, int(a), node_depth[n], get_node))
+            n += 1
+
+        nmbr_nodes = len(self.beliefs)
+        self.node_action_ptr = np.zeros(nmbr_nodes+1, dtype=np.int64)
+        self.node_action_ptr[1:] = np.cumsum([np.size(actions) for actions in node_actions])
+        self.node_actions = np.concatenate(node_actions).astype(np.int64)
+        self.is_point = np.array([len(b) == 1 for b in self.beliefs])
+
+        self.edge_next = np.full((nmbr_nodes, ActionSize), self.OUTSIDE, dtype=np.int64)
+        self.edge_unchanged = np.zeros((nmbr_nodes, ActionSize), dtype=bool)
+        self.edge_next_ties = np.ones((nmbr_nodes, ActionSize), dtype=np.int64)
+        for (n, a, next_node, unchanged, next_ties) in edges:
+            self.edge_next[n,a], self.edge_unchanged[n,a], self.edge_next_ties[n,a] = next_node, unchanged, next_ties
+
+        self.compile_time = t.perf_counter() - t_start
+        if logging:
+            print(self.summary())
+
+    def compile_edge(self, planner, b:Belief, a:int, depth:int, get_node):
+        """Returns (next node, unchanged, next_ties) for taking action a in b, following the same steps as run_episode"""
+        b_next = planner.compute_next_belief(b, a)
+        if b.isclose(b_next, rtol, atol):
+            return self.MEASURE, True, 1
+        actions_next = planner.determine_action_set(b_next)
+        # The measuring value is (up to tolerance) the same for all optimal next actions
+        if planner.determine_measurement(b, a, b_next, int(actions_next[0])):
+            return self.MEASURE, False, np.size(actions_next)
+        return get_node(b_next, depth+1), False, np.size(actions_next)
+
+    def choose_action(self, n:int):
+        """Returns a random optimal action of node n (same random draw as optimal_action)"""
+        start, end = self.node_action_ptr[n], self.node_action_ptr[n+1]
+        return int(self.node_actions[start + np.random.randint(end - start)])
+
+    def summary(self):
+        nmbr_edges = np.sum(self.edge_next != self.OUTSIDE)
+        return "Belief graph: {} nodes, {} edges (depth {}), compiled in {:.2f} s".format(
+                len(self.beliefs), nmbr_edges, self.depth, self.compile_time)
@@ -0,0 +1,205 @@
+"""File containing a sparse belief engine for the (R)ATM planners.
+Beliefs are represented as Belief objects (see AM_Gyms/AM_Belief.py)."""
+import numpy as np
+from collections import OrderedDict
+
+from AM_Gyms.Sparse_Tables import dict_to_csr, weighted_row_sum, gather_rows
+from AM_Gyms.AM_Belief import Belief
+
+# Globally used tolerances for floating numbers (same as in ACNO_Planning)
+rtol=0.0001
+atol= 1e-10
+
+class SparseBeliefEngine():
+    """Stores a transition function P as one sparse matrix per action (built once),
+    and computes belief updates as sparse vector-matrix products."""
+
+    def __init__(self, P:dict, StateSize:int, ActionSize:int):
+        self.StateSize, self.ActionSize = StateSize, ActionSize
+        self.indptr, self.indices, self.data = dict_to_csr(P, StateSize, ActionSize)
+
+    def next_belief(self, b:Belief, a:int):
+        """computes next belief state, according to current belief b and action a."""
+        states, probs = weighted_row_sum(self.indptr, self.indices, self.data, b.states*self.ActionSize + a, b.probs)
+        return Belief(states, probs)
+
+    def next_beliefs(self, B:"BeliefBatch", actions:np.ndarray):
+        """computes next belief states for a batch of beliefs, with one action per belief."""
+        positions, entry_row = gather_rows(self.indptr, B.states*self.ActionSize + actions[B.episodes])
+        keys = B.episodes[entry_row] * self.StateSize + self.indices[positions]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        probs = np.bincount(inverse, weights = B.probs[entry_row] * self.data[positions], minlength=np.size(keys))
+        return BeliefBatch(keys // self.StateSize, keys % self.StateSize, probs, B.size)
+
+    def successors(self, s:int, a:int):
+        """Returns (next states, probs) for state-action pair (s,a)."""
+        row = s*self.ActionSize + a
+        start, end = self.indptr[row], self.indptr[row+1]
+        return self.indices[start:end], self.data[start:end]
+
+class BeliefBatch():
+    """Beliefs of a batch of episodes, stacked into flat arrays (sorted by episode, then by state)."""
+
+    __slots__ = ("episodes", "states", "probs", "size")
+
+    def __init__(self, episodes:np.ndarray, states:np.ndarray, probs:np.ndarray, size:int):
+        self.episodes, self.states, self.probs, self.size = episodes, states, probs, size
+
+    @classmethod
+    def points(cls, states:np.ndarray):
+        """Returns batch of beliefs with all probability mass in the given states"""
+        return cls(np.arange(np.size(states)), np.asarray(states, dtype=np.int64), np.ones(np.size(states)), np.size(states))
+
+    @classmethod
+    def from_beliefs(cls, beliefs:list):
+        """Returns batch containing the given beliefs"""
+        lengths = [len(b) for b in beliefs]
+        episodes = np.repeat(np.arange(len(beliefs)), lengths)
+        if not beliefs:
+            return cls(episodes, np.zeros(0, dtype=np.int64), np.zeros(0), 0)
+        return cls(episodes, np.concatenate([b.states for b in beliefs]), np.concatenate([b.probs for b in beliefs]), len(beliefs))
+
+    def get(self, k:int):
+        """Returns belief of episode k"""
+        start, end = np.searchsorted(self.episodes, [k, k+1])
+        return Belief(self.states[start:end], self.probs[start:end])
+
+    def lengths(self):
+        return np.bincount(self.episodes, minlength=self.size)
+
+    def select(self, mask:np.ndarray):
+        """Returns batch of only the episodes in (boolean) mask"""
+        new_ids = np.cumsum(mask) - 1
+        entries = mask[self.episodes]
+        return BeliefBatch(new_ids[self.episodes[entries]], self.states[entries], self.probs[entries], int(np.sum(mask)))
+
+    def append(self, other:"BeliefBatch"):
+        """Returns batch with the episodes of other added after these"""
+        return BeliefBatch(np.concatenate([self.episodes, other.episodes + self.size]), np.concatenate([self.states, other.states]),
+                           np.concatenate([self.probs, other.probs]), self.size + other.size)
+
+    def replace(self, mask:np.ndarray, other:"BeliefBatch"):
+        """Returns batch where the beliefs of episodes in (boolean) mask are replaced by those of other (in order)"""
+        entries = ~mask[self.episodes]
+        episodes = np.concatenate([self.episodes[entries], np.flatnonzero(mask)[other.episodes]])
+        states   = np.concatenate([self.states[entries], other.states])
+        probs    = np.concatenate([self.probs[entries], other.probs])
+        order = np.lexsort((states, episodes))
+        return BeliefBatch(episodes[order], states[order], probs[order], self.size)
+
+    def isclose(self, other:"BeliefBatch", rtol:float, atol:float):
+        """For each episode, checks whether other has the same support and approximately the same probabilities (see Belief.isclose)"""
+        if np.size(other.states) == 0:
+            return self.lengths() == 0
+        statesize = max(np.max(self.states, initial=0), np.max(other.states, initial=0)) + 1
+        keys, other_keys = self.episodes * statesize + self.states, other.episodes * statesize + other.states
+        index = np.minimum(np.searchsorted(other_keys, keys), np.size(other_keys)-1)
+        other_probs = other.probs[index]
+        close = np.logical_and(other_keys[index] == keys,
+                               np.abs(self.probs - other_probs) <= np.maximum(rtol * np.abs(other_probs), atol))
+        nmbr_not_close = np.bincount(self.episodes, weights=~close, minlength=self.size)
+        return np.logical_and(nmbr_not_close == 0, self.lengths() == other.lengths())
+
+    def weighted_sum(self, values:np.ndarray):
+        """Returns sum_s b(s) * values[entry] for each episode, with values given per entry"""
+        return np.bincount(self.episodes, weights=self.probs * values, minlength=self.size)
+
+    def weighted_rows(self, M:np.ndarray):
+        """Returns sum_s b(s) * M[s] for each episode"""
+        result = np.zeros((self.size, np.shape(M)[1]))
+        np.add.at(result, self.episodes, self.probs[:,np.newaxis] * M[self.states])
+        return result
+
+class BeliefCache():
+    """Size-bounded (LRU) cache for belief transitions (b, a) -> b_next.
+    Probabilities are rounded to a multiple of 'precision' before lookup, such that near-identical beliefs share an entry."""
+
+    def __init__(self, maxsize:int, precision:float = 1e-6):
+        self.maxsize, self.precision = maxsize, precision
+        self.entries = OrderedDict()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def key(self, b:Belief, a:int):
+        return (a, b.key(self.precision))
+
+    def get(self, key):
+        """Returns cached next belief (or None if not present)"""
+        b_next = self.entries.get(key)
+        if b_next is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return b_next
+
+    def put(self, key, b_next:Belief):
+        self.entries[key] = b_next
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def summary(self):
+        lookups = max(self.hits + self.misses, 1)
+        return "Belief cache: {} hits, {} misses ({:.1%} hit rate), {} evictions, {}/{} entries".format(
+                self.hits, self.misses, self.hits/lookups, self.evictions, len(self.entries), self.maxsize)
+
+# Generalized functions:
+
+def greedy_values(Q:np.ndarray, Q_decision:np.ndarray = None):
+    """Returns Q[s, argmax(Q_decision[s])] for all states s."""
+    if Q_decision is None:
+        Q_decision = Q
+    return Q[np.arange(np.shape(Q)[0]), np.argmax(Q_decision, axis=1)]
+
+def optimal_action(b:Belief, Q1:np.ndarray, Q2:np.ndarray = None, returnvalue = False):
+    """Returns the optimal action for sparse belief state b as given by Q1.
+    Ties are broken according to Q2, then randomly."""
+
+    states, probs = b.states, b.probs
+    thisQ1 = probs @ Q1[states]
+
+    thisQ1Max = thisQ1.max()
+    filter = np.abs(thisQ1 - thisQ1Max) <= atol + rtol * abs(thisQ1Max)   # i.e. np.isclose, without its overhead
+    optimal_actions = np.flatnonzero(filter)
+
+    if np.size(optimal_actions) > 1 and Q2 is not None:
+        thisQ2 = probs @ Q2[states]
+        thisQ2Max = np.max(thisQ2[filter])
+        filter2 = np.abs(thisQ2 - thisQ2Max) <= atol + rtol * abs(thisQ2Max)
+        optimal_actions = np.flatnonzero(np.logical_and(filter, filter2))
+
+    # Same random draw as np.random.choice(optimal_actions), but faster
+    optimal_action = int(optimal_actions[np.random.randint(np.size(optimal_actions))])
+
+    if returnvalue:
+        return optimal_action, thisQ1[optimal_action]
+    return optimal_action
+
+def optimal_action_set(b:Belief, Q1:np.ndarray):
+    """Returns all optimal actions for sparse belief state b as given by Q1 (i.e. all actions optimal_action might return)."""
+    thisQ1 = b.probs @ Q1[b.states]
+    thisQ1Max = thisQ1.max()
+    return np.flatnonzero(np.abs(thisQ1 - thisQ1Max) <= atol + rtol * abs(thisQ1Max))
+
+def optimal_actions(B:BeliefBatch, Q1:np.ndarray):
+    """Returns the optimal action for each belief in batch B as given by Q1, with ties broken randomly."""
+    thisQ1 = B.weighted_rows(Q1)
+    thisQ1Max = np.max(thisQ1, axis=1, keepdims=True)
+    filter = np.abs(thisQ1 - thisQ1Max) <= atol + rtol * np.abs(thisQ1Max)
+    return np.argmax(filter * np.random.random(np.shape(thisQ1)), axis=1)
+
+def measuring_values(B:BeliefBatch, a_B:np.ndarray, Q:np.ndarray, V_measure:np.ndarray, Bm:BeliefBatch = None):
+    """Returns the measuring value for each belief in batch B (see measuring_value)."""
+    if Bm is None:
+        Bm = B
+    return Bm.weighted_sum(V_measure[Bm.states]) - B.weighted_sum(Q[B.states, a_B[B.episodes]])
+
+def measuring_value(b:Belief, a_b:int, Q:np.ndarray, V_measure:np.ndarray, bm:Belief = None):
+    """Returns the measuring value for sparse beliefs. V_measure[s] gives the value of state s
+    if it were measured (see greedy_values), while values for not measuring are given by Q."""
+    if bm is None:
+        bm = b
+    return bm.probs @ V_measure[bm.states] - b.probs @ Q[b.states, a_b]
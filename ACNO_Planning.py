@@ -1,19 +1,23 @@
 """File containting all (R)ACNO-MDP planner used in the paper. RMDP-values are pre-computed in seperate files. """
 import numpy as np
 import math as m
-import pytest
-import cvxpy as cp
-import AM_Gyms.DroneInCorridor as drone
-# from functools import lru_cache
 
 from AM_Gyms.AM_Tables import  RAM_Environment_Explicit
 from AM_Gyms.AM_Env_wrapper import AM_ENV
+from AM_Gyms.AM_Belief import Belief
+import ACNO_Beliefs as sparse
+from ACNO_Beliefs import SparseBeliefEngine, BeliefCache, BeliefBatch
+from ACNO_Worst_Belief import WorstBeliefSolver
+from ACNO_Belief_Graph import BeliefGraph
+from ACNO_Profiling import PhaseProfiler
 
 # Globally used tolerances for floating numbers
 rtol=0.0001
 atol= 1e-10
 
-cache_size = 1_000
+# Size of the worst-case belief cache, and the precision to which beliefs are rounded for it
+cache_size = 10_000
+cache_precision = 1e-6
 
 class ACNO_Planner():
     """Generic ATM planner from Krale et al (2023)."""
@@ -21,6 +25,9 @@ class ACNO_Planner():
     t = 0 # for debugging
     epsilon_measuring = 0 # 0.05
     loopPenalty = 1
+    graph = None # compiled belief graph (see compile)
+    compile_statistics = None # statistics of compiling the graph (e.g. solver telemetry, see compile)
+    profiler = None # per-phase timing (see enable_profiling)
     
     def __init__(self, Env:AM_ENV, tables:RAM_Environment_Explicit, use_robust:bool = False, df=0.95):
         
@@ -32,11 +39,16 @@ class ACNO_Planner():
         else:
             self.P, _R, self.Q = tables.get_avg_tables()
         
+        # Sparse versions of P and Q used for all belief computations
+        self.engine      = SparseBeliefEngine(self.P, self.StateSize, self.ActionSize)
+        self.V_measure   = sparse.greedy_values(self.Q)
+        
         self.df          = df
         
 
     def run(self, eps, logging=False):
         
+        self.reset_statistics()
         if logging:
             print("starting learning of model...")
         rewards, steps, measurements = np.zeros(eps), np.zeros(eps), np.zeros(eps)
@@ -52,16 +64,39 @@ class ACNO_Planner():
                 print ("{} / {} runs complete (current avg reward = {}, nmbr steps = {}, nmbr measures = {})".format( 
                         i, eps, np.average(rewards[(i-log_nmbr):i]), np.average(steps[(i-log_nmbr):i]), np.average(measurements[(i-log_nmbr):i]) ) )
         
+        self.report_statistics()
         return (np.sum(rewards), rewards, steps, measurements)
     
+    def compile(self, depth:int = 5, max_nodes:int = 1_000_000, logging:bool = False):
+        """Pre-computes all beliefs reachable within depth steps after a measurement, after which episodes
+        are run by walking over this graph (see run_episode_compiled).
+        Statistics of compiling (e.g. worst-case beliefs solved for the graph) are kept as compile_statistics."""
+        self.reset_statistics()
+        self.graph = BeliefGraph(self, depth, max_nodes, logging=logging)
+        self.compile_statistics = self.statistics()
+        if self.compile_statistics:
+            print("Compiling the belief graph:")
+            self.report_statistics()
+        return self.graph
+    
+    def enable_profiling(self):
+        """Records time and calls per phase of all following episodes, plus belief support sizes (see ACNO_Profiling.py).
+        Batched episodes (run_batched) are not profiled. Steps within a compiled belief graph involve no phases,
+        so for these only their support sizes (and measurements) are recorded."""
+        self.profiler = PhaseProfiler(self)
+        return self.profiler
+    
     def run_episode(self):
         
+        if self.graph is not None:
+            return self.run_episode_compiled()
+        
         # ATM planning loop, with two minor adjustements:
         # 1) if beliefs do not change, we force a measuring action (to prevent infinite selfloops);
         # 2) for efficiency, we choose control actions for the next step before chosing measurement for the current step (since this is used to compute MV).
         
         self.env.reset()
-        currentBelief, nextBelief = {self.s_init:1}, {}
+        currentBelief, nextBelief = Belief.point(self.s_init), None
         nextAction:int; currentAction:int; currentMeasuring:bool
         done = False
         total_reward, total_steps, total_measures = 0, 0, 0
@@ -71,7 +106,7 @@ class ACNO_Planner():
         while not done:
 
             nextBelief = self.compute_next_belief (currentBelief, currentAction)
-            if currentBelief == pytest.approx(nextBelief, rtol, atol):
+            if currentBelief.isclose(nextBelief, rtol, atol):
                 if len(currentBelief) == 1:
                     currentAction = np.random.choice(self.ActionSize)
                 currentMeasuring = True
@@ -91,19 +126,160 @@ class ACNO_Planner():
         
         return total_reward, total_steps, total_measures
     
+    def run_episode_compiled(self):
+        
+        # Same loop as run_episode, but with beliefs given by nodes of the compiled graph.
+        # Once we leave the compiled region (node = -1), we use the live computations until the next measurement.
+        
+        graph = self.graph
+        self.env.reset()
+        currentNode, nextNode = graph.root[self.s_init], -1
+        currentBelief, nextBelief = None, None
+        nextAction:int; currentAction:int; currentMeasuring:bool
+        done = False
+        total_reward, total_steps, total_measures = 0, 0, 0
+        
+        currentAction = graph.choose_action(currentNode)
+        
+        while not done:
+            
+            if currentNode >= 0:
+                nextNode = graph.edge_next[currentNode, currentAction]
+                if self.profiler is not None and nextNode != graph.OUTSIDE:
+                    self.profiler.record_support(len(graph.beliefs[currentNode]))
+                if nextNode == graph.OUTSIDE:
+                    currentBelief, currentNode = graph.beliefs[currentNode], -1
+                elif graph.edge_unchanged[currentNode, currentAction]:
+                    if graph.is_point[currentNode]:
+                        currentAction = np.random.choice(self.ActionSize)
+                    currentMeasuring = True
+                elif nextNode == graph.MEASURE:
+                    np.random.randint(graph.edge_next_ties[currentNode, currentAction]) # (keeps the random draws the same as in run_episode)
+                    currentMeasuring = True
+                else:
+                    nextAction = graph.choose_action(nextNode)
+                    currentMeasuring = False
+            if currentNode < 0:
+                nextNode = -1
+                nextBelief = self.compute_next_belief (currentBelief, currentAction)
+                if currentBelief.isclose(nextBelief, rtol, atol):
+                    if len(currentBelief) == 1:
+                        currentAction = np.random.choice(self.ActionSize)
+                    currentMeasuring = True
+                else:
+                    nextAction = self.determine_action      (nextBelief)
+                    currentMeasuring  = self.determine_measurement (currentBelief, currentAction, nextBelief, nextAction)
+            
+            reward, done = self.execute_action(currentAction, currentBelief, currentMeasuring)
+            if currentMeasuring or np.random.random() < self.epsilon_measuring:
+                b_measured, cost = self.measure()
+                nextNode = graph.root[b_measured.states[0]]
+                nextAction = graph.choose_action(nextNode)
+                total_measures += 1
+            else:
+                cost = 0
+            total_reward += reward - cost
+            total_steps += 1
+            currentNode, currentBelief, currentAction = nextNode, nextBelief, nextAction
+        
+        return total_reward, total_steps, total_measures
+    
+    def run_batched(self, eps, batch_size=100, logging=False):
+        """Same as run, but runs (up to) batch_size episodes in lock-step, with all belief updates,
+        action choices and environment steps done for the whole batch at once.
+        Finished episodes are replaced by new ones until all eps episodes have been run."""
+        
+        if not hasattr(self.env, "step_episodes"):
+            return self.run(eps, logging)
+        
+        self.reset_statistics()
+        rewards, steps, measurements = np.zeros(eps), np.zeros(eps), np.zeros(eps)
+        batch_size = min(batch_size, eps)
+        self.env.reset_episodes(batch_size)
+        
+        # Per active episode: its environment slot, episode number and current belief & action
+        slots = np.arange(batch_size)
+        episode_nmbrs = np.arange(batch_size)
+        nmbr_started = batch_size
+        currentBeliefs = BeliefBatch.points(np.full(batch_size, self.s_init))
+        currentActions = self.determine_actions(currentBeliefs)
+        
+        while np.size(slots) > 0:
+            
+            # Same steps as in run_episode, for all active episodes at once
+            nextBeliefs = self.compute_next_beliefs(currentBeliefs, currentActions)
+            unchanged = currentBeliefs.isclose(nextBeliefs, rtol, atol)
+            random_actions = np.logical_and(unchanged, currentBeliefs.lengths() == 1)
+            currentActions[random_actions] = np.random.randint(self.ActionSize, size=np.sum(random_actions))
+            nextActions = self.determine_actions(nextBeliefs)
+            measuring = np.logical_or(unchanged, self.determine_measurements(currentBeliefs, currentActions, nextBeliefs, nextActions))
+            
+            reward, done = self.env.step_episodes(slots, currentActions)
+            if self.epsilon_measuring > 0:
+                measuring = np.logical_or(measuring, np.random.random(np.size(slots)) < self.epsilon_measuring)
+            cost = np.zeros(np.size(slots))
+            if np.any(measuring):
+                states, cost[measuring] = self.env.measure_episodes(slots[measuring])
+                measuredBeliefs = BeliefBatch.points(states)
+                nextBeliefs = nextBeliefs.replace(measuring, measuredBeliefs)
+                nextActions[measuring] = self.determine_actions(measuredBeliefs)
+            rewards[episode_nmbrs] += reward - cost
+            steps[episode_nmbrs] += 1
+            measurements[episode_nmbrs] += measuring
+            currentBeliefs, currentActions = nextBeliefs, nextActions
+            
+            if not np.any(done):
+                continue
+            
+            # Start new episodes in the slots of finished ones (as long as required), remove the rest.
+            if logging:
+                for i in episode_nmbrs[done]:
+                    if i > 0 and i%100 == 0:
+                        print("{} / {} runs complete".format(i, eps))
+            finished = np.flatnonzero(done)
+            restarted = finished[:max(eps - nmbr_started, 0)]
+            if np.size(restarted) > 0:
+                restart = np.zeros(np.size(slots), dtype=bool); restart[restarted] = True
+                self.env.reset_episode_ids(slots[restarted])
+                episode_nmbrs[restarted] = np.arange(nmbr_started, nmbr_started + np.size(restarted))
+                nmbr_started += np.size(restarted)
+                initialBeliefs = BeliefBatch.points(np.full(np.size(restarted), self.s_init))
+                currentBeliefs = currentBeliefs.replace(restart, initialBeliefs)
+                currentActions[restarted] = self.determine_actions(initialBeliefs)
+                done[restarted] = False
+            if np.any(done):
+                keep = ~done
+                slots, episode_nmbrs, currentActions = slots[keep], episode_nmbrs[keep], currentActions[keep]
+                currentBeliefs = currentBeliefs.select(keep)
+        
+        self.report_statistics()
+        return (np.sum(rewards), rewards, steps, measurements)
     
     def determine_action(self, b):
-        return optimal_action(b, self.Q, None)
+        return sparse.optimal_action(b, self.Q, None)
+    
+    def determine_action_set(self, b):
+        return sparse.optimal_action_set(b, self.Q)
+    
+    def determine_actions(self, B:BeliefBatch):
+        return sparse.optimal_actions(B, self.Q)
     
     def compute_next_belief(self, b, a):
-        return next_belief(b,a,self.P)
+        return self.engine.next_belief(b,a)
+    
+    def compute_next_beliefs(self, B:BeliefBatch, actions:np.ndarray):
+        return self.engine.next_beliefs(B, actions)
     
     def determine_measurement(self, b, a, b_next=None, a_next=None):
         if b_next is None:
             b_next = self.compute_next_belief(b,a)
         if a_next is None:
             a_next = self.determine_action(b_next)
-        MV = measuring_value(b_next, a_next, self.Q)
+        MV = sparse.measuring_value(b_next, a_next, self.Q, self.V_measure)
+        return MV > self.cost
+    
+    def determine_measurements(self, B:BeliefBatch, actions:np.ndarray, B_next:BeliefBatch, actions_next:np.ndarray):
+        MV = sparse.measuring_values(B_next, actions_next, self.Q, self.V_measure)
         return MV > self.cost
     
     def execute_action(self, action, belief, measuring):
@@ -112,44 +288,87 @@ class ACNO_Planner():
     
     def measure(self):
         s, cost = self.env.measure()
-        return {s:1}, cost
+        return Belief.point(s), cost
+    
+    def reset_statistics(self):
+        pass
+    
+    def report_statistics(self):
+        pass
+    
+    def statistics(self):
+        """Returns statistics of the last run (as stored in results files)"""
+        return {}
 
 class ACNO_Planner_Robust(ACNO_Planner):
     """The R-ATM algorithm. Uses the same loop as ACNO_Planner, but with altered functions to calculte beliefs & action-pairs"""
     
-    def __init__(self, Env:AM_ENV, tables:RAM_Environment_Explicit, df=0.95):
+    def __init__(self, Env:AM_ENV, tables:RAM_Environment_Explicit, df=0.95, cache_size = cache_size):
         self.env        = Env
         # Read (pre-computed) model description and RMDP-values from 'tables'
         self.StateSize, self.ActionSize, self.cost, self.s_init = tables.get_vars()
         self.Pmin, self.Pmax, _R = tables.get_uncertain_tables()
         self.P, self.Q, _R =  tables.get_robust_tables()
+        self.engine     = SparseBeliefEngine(self.P, self.StateSize, self.ActionSize)
+        self.V_measure  = sparse.greedy_values(self.Q)
+        self.solver     = WorstBeliefSolver(self.Pmin, self.Pmax, self.Q, self.StateSize, self.ActionSize)
+        self.cache      = BeliefCache(cache_size, cache_precision)
         
         self.df         = df
         self.epsilon_measuring = super().epsilon_measuring # = 0
         
     def determine_measurement(self, b, a, b_next=None, a_next=None):
-        b_next_measuring = next_belief(b,a, self.P)
+        b_next_measuring = self.engine.next_belief(b,a)
         if a_next is None:
             a_next = self.determine_action(b_next)
-        MV = measuring_value(b_next, a_next, self.Q, bm=b_next_measuring)
+        MV = sparse.measuring_value(b_next, a_next, self.Q, self.V_measure, bm=b_next_measuring)
         return MV > self.cost and not np.isclose(MV, 0, rtol=rtol, atol=atol)
+    
+    def determine_measurements(self, B:BeliefBatch, actions:np.ndarray, B_next:BeliefBatch, actions_next:np.ndarray):
+        B_next_measuring = self.engine.next_beliefs(B, actions)
+        MV = sparse.measuring_values(B_next, actions_next, self.Q, self.V_measure, Bm=B_next_measuring)
+        return np.logical_and(MV > self.cost, ~np.isclose(MV, 0, rtol=rtol, atol=atol))
 
     def determine_action(self, b):
-        return optimal_action(b, self.Q, None)
+        return sparse.optimal_action(b, self.Q, None)
+    
+    def compute_next_belief(self, b:Belief, a:int):
+        key = self.cache.key(b, a)
+        b_next = self.cache.get(key)
+        if b_next is None:
+            b_next = self.compute_next_belief_(b, a)
+            self.cache.put(key, b_next)
+        return b_next
     
-    def compute_next_belief(self, b:dict, a:int):
-        b_hashable = frozenset(b.items())
-        return self.compute_next_belief_(b_hashable, a)
+    def compute_next_beliefs(self, B:BeliefBatch, actions:np.ndarray):
+        # Worst-case beliefs are solved one by one (most are found in the cache)
+        return BeliefBatch.from_beliefs([self.compute_next_belief(B.get(k), int(actions[k])) for k in range(B.size)])
     
-    # @lru_cache(maxsize=cache_size)
-    def compute_next_belief_(self, b_hashable, a):
-        b = {s:p for (s, p) in b_hashable}
-        return custom_worst_belief(b, a, self.P, self.Pmin, self.Pmax, self.Q)
+    def compute_next_belief_(self, b:Belief, a:int):
+        b_next = self.solver.solve(b, a)
+        if b_next is None:
+            # Fall back to the nominal belief (counted in the solver telemetry)
+            return self.engine.next_belief(b, a)
+        return b_next
+    
+    def reset_statistics(self):
+        self.cache.reset_counters()
+        self.solver.telemetry.reset()
+    
+    def report_statistics(self):
+        print(self.cache.summary())
+        print(self.solver.telemetry.summary())
+    
+    def statistics(self):
+        statistics = {"worst_belief_solver": self.solver.telemetry.to_dict()}
+        if self.compile_statistics is not None:
+            statistics["compile"] = self.compile_statistics
+        return statistics
         
 
 class ACNO_Planner_Control_Robust(ACNO_Planner_Robust):
 
-    def __init__(self, Env:AM_ENV, PlanEnv:RAM_Environment_Explicit, MeasureEnv:RAM_Environment_Explicit, df=0.95):
+    def __init__(self, Env:AM_ENV, PlanEnv:RAM_Environment_Explicit, MeasureEnv:RAM_Environment_Explicit, df=0.95, cache_size = cache_size):
         self.env = Env
         # Read (pre-computed) model description and RMDP-values from 'tables'
         self.StateSize, self.ActionSize, self.cost, self.s_init = PlanEnv.get_vars()
@@ -157,9 +376,16 @@ class ACNO_Planner_Control_Robust(ACNO_Planner_Robust):
         self.Pmin, self.Pmax, _R = PlanEnv.get_uncertain_tables()
         self.Pmeasure, self.Qmeasure, _R = MeasureEnv.get_robust_tables()
         
+        # Sparse versions of both transition functions, and state values if measuring
+        self.engine         = SparseBeliefEngine(self.P, self.StateSize, self.ActionSize)
+        self.measure_engine = SparseBeliefEngine(self.Pmeasure, self.StateSize, self.ActionSize)
+        self.V_measure      = sparse.greedy_values(self.Q)
+        self.V_measure_robust = sparse.greedy_values(self.Qmeasure, Q_decision=self.Q)
+        self.solver         = WorstBeliefSolver(self.Pmin, self.Pmax, self.Q, self.StateSize, self.ActionSize)
+        self.cache          = BeliefCache(cache_size, cache_precision)
+        
         self.df = df
         self.epsilon_measuring = super().epsilon_measuring # =0
-        self.b_measure:dict = {}; self.b_measure_next:dict = {}
         self.s_init, _c = Env.measure()
     
     def run_episode(self):
@@ -167,8 +393,8 @@ class ACNO_Planner_Control_Robust(ACNO_Planner_Robust):
         # Same basic control loop as for ACNO_Planner, but we now need to keep track of b_CR as well.
         
         self.env.reset()
-        currentBelief, nextBelief = {self.s_init:1}, {}
-        currentMeasureBelief, nextMeasureBelief = {self.s_init:1}, {}
+        currentBelief, nextBelief = Belief.point(self.s_init), None
+        currentMeasureBelief, nextMeasureBelief = Belief.point(self.s_init), None
         nextAction:int; currentAction:int; currentMeasuring:bool
         done = False
         total_reward, total_steps, total_measures = 0, 0, 0
@@ -179,7 +405,7 @@ class ACNO_Planner_Control_Robust(ACNO_Planner_Robust):
 
             nextBelief = self.compute_next_belief (currentBelief, currentAction)
             nextMeasureBelief = self.compute_next_measure_belief(currentMeasureBelief, currentAction)
-            if currentBelief == pytest.approx(nextBelief, rtol, atol):
+            if currentBelief.isclose(nextBelief, rtol, atol):
                 if len(currentBelief) == 1:
                     currentAction = np.random.choice(self.ActionSize)
                 currentMeasuring = True
@@ -200,16 +426,20 @@ class ACNO_Planner_Control_Robust(ACNO_Planner_Robust):
             currentBelief, currentAction, currentMeasureBelief = nextBelief, nextAction, nextMeasureBelief
         return total_reward, total_steps, total_measures
     
+    def run_batched(self, eps, batch_size=100, logging=False):
+        # Batched mode does not track the measure-beliefs yet: run episodes sequentially.
+        return self.run(eps, logging)
+    
     def compute_next_measure_belief(self, b, a):
-        return next_belief(b,a,self.Pmeasure)
+        return self.measure_engine.next_belief(b,a)
         
     def determine_measurement(self, b, a, bm, b_next:None, a_next:None, bm_next:None):
         if b_next is None or a_next is None or bm_next is None:
             print("ERROR: determine_measurement not fully implemented for non-given next beliefs/actions")
-        bnext_if_measuring = next_belief(b,a,self.P)
+        bnext_if_measuring = self.engine.next_belief(b,a)
         #NOTE: since this is already 'less conservative' then the robust belief update, even control-robust ATM with P_Rmdp has an effect!
-        MV_robust = measuring_value(bm_next, a_next, self.Qmeasure, Q_decision=self.Q )
-        MV_extra  = measuring_value(b_next, a_next, self.Q, bm=bnext_if_measuring)
+        MV_robust = sparse.measuring_value(bm_next, a_next, self.Qmeasure, self.V_measure_robust)
+        MV_extra  = sparse.measuring_value(b_next, a_next, self.Q, self.V_measure, bm=bnext_if_measuring)
         
         return MV_robust > self.cost or MV_extra > self.cost
 
@@ -319,14 +549,8 @@ def get_partial_P(state_indexes:np.ndarray, P:dict, a:int, flat = False):
     return P_array
 
 def b_array_to_dict(b_array:np.ndarray, indexes:np.ndarray, min_probability_considered:float = 0.001):
-    b_array[b_array < min_probability_considered] = 0
-    b_array = b_array / np.sum(b_array)
-    
-    b_dict = {}
-    for (index, prob) in enumerate(b_array):
-        if prob > 0:
-            b_dict[indexes[index]] = prob
-    return b_dict
+    """Returns dict-belief from array of probabilities for states indexes, without probabilities below min_probability_considered"""
+    return Belief(np.asarray(indexes), b_array).pruned(min_probability_considered).to_dict()
 
 def get_Ps_for_belief(state_indexes:np.ndarray, b:dict, a:int, P:dict, Pmin:dict, Pmax:dict):
     """Returns arrays of current belief and next possible beliefs, according to  """
@@ -348,8 +572,10 @@ def get_Ps_for_belief(state_indexes:np.ndarray, b:dict, a:int, P:dict, Pmin:dict
 
     return (b_array, bnext, bnext_min, bnext_max)
             
-def custom_worst_belief(b:dict, a:int, Pguess, Pmin:dict, Pmax:dict, Q:np.ndarray, min_probability_considered:float = 0.01):
-    """Computes the worst-case next belief when taking action a form belief b, given the specified uncertain transition- and Q-value functions."""
+def custom_worst_belief(b:dict, a:int, Pguess, Pmin:dict, Pmax:dict, Q:np.ndarray, min_probability_considered:float = 0.001):
+    """Computes the worst-case next belief when taking action a form belief b, given the specified uncertain transition- and Q-value functions.
+    (Reference implementation using cvxpy: the planners use ACNO_Worst_Belief.WorstBeliefSolver instead.)"""
+    import cvxpy as cp
     
     # Unpack P & Q into arrays of required sizes
     relevant_current_states, relevant_next_states = [], []
@@ -392,5 +618,5 @@ def custom_worst_belief(b:dict, a:int, Pguess, Pmin:dict, Pmax:dict, Q:np.ndarra
         return next_belief(b,a,Pguess)
     
 
-    b_worst_dict = b_array_to_dict(bnext.value, state_indexes)
+    b_worst_dict = b_array_to_dict(bnext.value, state_indexes, min_probability_considered)
     return b_worst_dict
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""File containing optional per-phase timing of planner episodes (see ACNO_Planner.enable_profiling).
+Phase methods are only wrapped for planners with profiling enabled, such that other planners run at full speed."""
+import time as t
+import numpy as np
+
+# Phases of the (R)ATM episode loops which are timed (if the planner has them)
+phases = ["compute_next_belief", "compute_next_measure_belief", "determine_action", "determine_measurement", "execute_action", "measure"]
+
+class PhaseProfiler():
+    """Accumulates time and number of calls per phase of a planner, plus the support size of the belief in each step
+    (i.e. of each belief passed to compute_next_belief). Times are recorded both exclusive (without time spent in
+    nested phases, such that they add up to the total) and inclusive."""
+
+    def __init__(self, planner):
+        self.reset()
+        for phase in phases:
+            if hasattr(planner, phase):
+                setattr(planner, phase, self.timed(phase, getattr(planner, phase)))
+
+    def reset(self):
+        self.times, self.calls = dict.fromkeys(phases, 0.0), dict.fromkeys(phases, 0)
+        self.inclusive_times = dict.fromkeys(phases, 0.0)
+        self.nested_times = [0.0]   # time spent in nested phases, per currently running phase
+        self.support_sizes = {}     # support size -> number of steps
+
+    def timed(self, phase:str, method):
+        """Returns method, with its time and calls added to phase (and belief support sizes recorded for compute_next_belief)"""
+        record_support = (phase == "compute_next_belief")
+        def timed_method(*args, **kwargs):
+            if record_support:
+                self.record_support(len(args[0]))
+            self.nested_times.append(0.0)
+            t_start = t.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                time = t.perf_counter() - t_start
+                self.times[phase] += time - self.nested_times.pop()
+                self.inclusive_times[phase] += time
+                self.nested_times[-1] += time
+                self.calls[phase] += 1
+            return result
+        return timed_method
+
+    def record_support(self, size:int):
+        """Records a step with a belief of given support size (also used for steps within a compiled belief graph)"""
+        self.support_sizes[size] = self.support_sizes.get(size, 0) + 1
+
+    def to_dict(self):
+        """Returns accumulated (exclusive and inclusive) times, calls and support sizes (as stored in results files)"""
+        return {"phases":           {phase: {"time": self.times[phase], "inclusive_time": self.inclusive_times[phase], "calls": self.calls[phase]}
+                                     for phase in phases if self.calls[phase] > 0},
+                "support_sizes":    {int(size): count for (size, count) in sorted(self.support_sizes.items())}}
+
+def merge_profiles(profiles:list):
+    """Returns the sum of profiles (as given by PhaseProfiler.to_dict)"""
+    merged = {"phases": {}, "support_sizes": {}}
+    for profile in profiles:
+        for (phase, stats) in profile["phases"].items():
+            total = merged["phases"].setdefault(phase, {"time": 0.0, "inclusive_time": 0.0, "calls": 0})
+            total["time"] += stats["time"]
+            total["inclusive_time"] += stats.get("inclusive_time", stats["time"])
+            total["calls"] += stats["calls"]
+        for (size, count) in profile["support_sizes"].items():
+            merged["support_sizes"][int(size)] = merged["support_sizes"].get(int(size), 0) + count
+    merged["support_sizes"] = dict(sorted(merged["support_sizes"].items()))
+    return merged
+
+def profile_summary(profile:dict):
+    """Returns printable summary of a profile (as given by PhaseProfiler.to_dict)"""
+    lines = ["Time per phase (exclusive, with inclusive time in brackets):"]
+    total = max(sum(stats["time"] for stats in profile["phases"].values()), 1e-12)
+    for (phase, stats) in sorted(profile["phases"].items(), key=lambda item: -item[1]["time"]):
+        inclusive = stats.get("inclusive_time", stats["time"])
+        lines.append("  {:<28} {:>9.3f} s ({:>5.1%}) ({:>9.3f} s), {:>9} calls, {:>8.1f} us/call".format(
+                     phase, stats["time"], stats["time"]/total, inclusive, stats["calls"], 1e6*inclusive/max(stats["calls"], 1)))
+    if profile["support_sizes"]:
+        sizes, counts = np.array(list(profile["support_sizes"].keys())), np.array(list(profile["support_sizes"].values()))
+        lines.append("Belief support size per step: mean {:.1f}, max {}".format(np.sum(sizes*counts)/np.sum(counts), np.max(sizes)))
+    return "\n".join(lines)
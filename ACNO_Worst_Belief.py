@@ -0,0 +1,249 @@
+"""File containing a dedicated solver for the worst-case belief update of (CR-)R-ATM.
+Given belief b and action a, it solves the LP
+
+    min_{P}  max_{a'} (b @ P) @ Q[:,a']    s.t.  Pmin[s] <= P[s] <= Pmax[s],  sum(P[s]) = 1  for all s in b
+
+without going through cvxpy. Running this file checks the solver against the cvxpy/GLPK version on random instances,
+or re-solves the slow instances logged during experiments (with -instances <folder>)."""
+import os
+import numpy as np
+import time as t
+import argparse
+from scipy.optimize import linprog
+from scipy.sparse import csr_matrix
+
+from AM_Gyms.Sparse_Tables import dict_to_csr, align_to_csr, gather_rows, greedy_minimize
+from AM_Gyms.AM_Belief import Belief
+
+# Names of the statuses returned by scipy's linprog
+lp_statuses = {0: "optimal", 1: "time_limit", 2: "infeasible", 3: "unbounded", 4: "numerical_difficulties"}
+
+class WorstBeliefSolver():
+    """Solves the worst-case belief update for interval uncertainty sets.
+
+    The problem is first solved 'greedily': for each action a', we compute the next belief
+    minimizing the value of a' (as in ModelLearner_Robust.custom_delta_minimize).
+    If a' is also the best action in that belief, this belief is optimal. Only if no such
+    action exists, we solve the (compact, sparse) LP using scipy's HiGHS interface.
+    All solves are recorded in the solver's telemetry (see SolverTelemetry)."""
+
+    tol = 1e-9
+    time_limit = 1.0    # time limit of the LP solver (s), as for the cvxpy version
+
+    def __init__(self, Pmin:dict, Pmax:dict, Q:np.ndarray, StateSize:int, ActionSize:int, min_probability_considered:float = 0.001):
+        self.StateSize, self.ActionSize = StateSize, ActionSize
+        self.Q = Q
+        self.min_probability_considered = min_probability_considered
+
+        # Pmin and Pmax as CSR arrays, with Pmin on the same sparsity pattern as Pmax.
+        self.indptr, self.indices, self.pmax = dict_to_csr(Pmax, StateSize, ActionSize)
+        self.pmin = align_to_csr(Pmin, self.indptr, self.indices, StateSize, ActionSize)
+
+        self.telemetry = SolverTelemetry()
+
+    def solve(self, b:Belief, a:int, prune:bool = True):
+        """Returns worst-case next belief after taking action a in b, or None if the problem is infeasible or the LP solver fails."""
+        t_start = t.perf_counter()
+        states, probs = b.states, b.probs
+        positions, entry_row = gather_rows(self.indptr, states*self.ActionSize + a)
+        pmin, pmax = self.pmin[positions], self.pmax[positions]
+        next_states, entry_next = np.unique(self.indices[positions], return_inverse=True)
+        weights = probs[entry_row]
+        Q_entries = self.Q[next_states][entry_next]                 # Q-values of the next state of each entry
+
+        b_next, method, status = self.solve_entries(pmin, pmax, entry_row, entry_next, weights, Q_entries, np.size(states), np.size(next_states))
+
+        time = t.perf_counter() - t_start
+        self.telemetry.record(np.size(states), np.size(next_states), method, status, time)
+        if self.telemetry.is_slow(time):
+            self.telemetry.dump_instance(states=states, probs=probs, action=a, next_states=next_states, pmin=pmin, pmax=pmax,
+                                         entry_row=entry_row, entry_next=entry_next, weights=weights, Q_entries=Q_entries,
+                                         time=time, method=method, status=status)
+        if b_next is None:
+            return None
+        if prune:
+            return Belief(next_states, b_next).pruned(self.min_probability_considered)
+        return Belief(next_states, b_next)
+
+    @classmethod
+    def solve_entries(cls, pmin:np.ndarray, pmax:np.ndarray, entry_row:np.ndarray, entry_next:np.ndarray, weights:np.ndarray,
+                      Q_entries:np.ndarray, nmbr_rows:int, nmbr_next:int):
+        """Solves the problem given per entry (i.e. pair of a state in b and a successor): its bounds, row (state in b), index of
+        the next state, weight (probability of its row in b) and Q-values of its next state.
+        nmbr_rows and nmbr_next give the number of states in b and of next states.
+        Returns (next belief probabilities or None, method ('infeasible', 'greedy' or 'lp'), solver status)"""
+
+        # Check feasibility
+        nmbr_actions = np.shape(Q_entries)[1]
+        slack = 1 - np.bincount(entry_row, pmin, minlength=nmbr_rows)
+        capacity = np.bincount(entry_row, pmax-pmin, minlength=nmbr_rows)
+        if np.any(slack < -cls.tol) or np.any(capacity < slack - cls.tol):
+            return None, "infeasible", "infeasible"
+
+        # 1) For each action, find the transition function minimizing its value
+        P_greedy = greedy_minimize(Q_entries, pmin, pmax, entry_row, slack)
+        weighted_P = weights[:,np.newaxis] * P_greedy
+        values = weighted_P.T @ Q_entries                           # values[i,j] = value of action j, when minimizing for action i
+        lower_bounds = np.diagonal(values)
+        is_optimal = lower_bounds >= np.max(values, axis=1) - cls.tol
+        if np.any(is_optimal):
+            return np.bincount(entry_next, weighted_P[:, np.argmax(is_optimal)], minlength=nmbr_next), "greedy", "optimal"
+
+        # 2) Otherwise, solve the (sparse) LP with variables P[entry] and Qmax
+        nmbr_entries = np.size(pmin)
+        c = np.zeros(nmbr_entries+1); c[-1] = 1
+        A_ub = np.hstack([(weights[:,np.newaxis] * Q_entries).T, -np.ones((nmbr_actions,1))])
+        A_eq = csr_matrix((np.ones(nmbr_entries), (entry_row, np.arange(nmbr_entries))), shape=(nmbr_rows, nmbr_entries+1))
+        bounds = np.column_stack([np.append(pmin, -np.inf), np.append(pmax, np.inf)])
+        result = linprog(c, A_ub=A_ub, b_ub=np.zeros(nmbr_actions), A_eq=A_eq, b_eq=np.ones(nmbr_rows),
+                         bounds=bounds, method="highs", options={"time_limit": cls.time_limit})
+        status = lp_statuses.get(result.status, str(result.status))
+        if result.status != 0:
+            return None, "lp", status
+        return np.bincount(entry_next, weights * result.x[:-1], minlength=nmbr_next), "lp", status
+
+class SolverTelemetry():
+    """Counts and histograms of all solves of a WorstBeliefSolver: problem sizes (support of b and number of successors),
+    methods, solver statuses, solve times and fallbacks (solves without result, after which planners use the nominal belief).
+    Optionally, instances which take longer than slow_time are written to a folder, to be re-solved offline (see benchmark_instances)."""
+
+    time_bins = 10.0**np.arange(-6, 1.5, 0.5)      # edges of the solve time histogram (s)
+
+    def __init__(self):
+        self.slow_folder, self.slow_time, self.max_dumps = None, np.inf, 0
+        self.nmbr_dumped = 0
+        self.reset()
+
+    def reset(self):
+        self.solves, self.fallbacks, self.time_limit_hits = 0, 0, 0
+        self.total_time, self.max_time = 0.0, 0.0
+        self.methods, self.statuses = {}, {}
+        self.support_sizes, self.successor_counts = {}, {}
+        self.time_histogram = np.zeros(np.size(self.time_bins)+1, dtype=int)
+
+    def record(self, support:int, successors:int, method:str, status:str, time:float):
+        self.solves += 1
+        self.fallbacks += status != "optimal"
+        self.time_limit_hits += status == "time_limit"
+        self.total_time += time
+        self.max_time = max(self.max_time, time)
+        self.methods[method] = self.methods.get(method, 0) + 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.support_sizes[support] = self.support_sizes.get(support, 0) + 1
+        self.successor_counts[successors] = self.successor_counts.get(successors, 0) + 1
+        self.time_histogram[np.searchsorted(self.time_bins, time)] += 1
+
+    def log_slow_solves(self, folder:str, slow_time:float, max_dumps:int = 1000):
+        """Writes (at most max_dumps) instances taking longer than slow_time (s) to folder"""
+        os.makedirs(folder, exist_ok=True)
+        self.slow_folder, self.slow_time, self.max_dumps = folder, slow_time, max_dumps
+
+    def is_slow(self, time:float):
+        return time > self.slow_time and self.nmbr_dumped < self.max_dumps
+
+    def dump_instance(self, **instance):
+        path = os.path.join(self.slow_folder, "slow_solve_{}_{}.npz".format(os.getpid(), self.nmbr_dumped))
+        np.savez(path, **instance)
+        self.nmbr_dumped += 1
+
+    def to_dict(self):
+        """Returns all counts and histograms (as stored in results files)"""
+        return {"solves":           self.solves,
+                "fallbacks":        self.fallbacks,
+                "time_limit_hits":  self.time_limit_hits,
+                "total_time":       self.total_time,
+                "max_time":         self.max_time,
+                "methods":          dict(self.methods),
+                "statuses":         dict(self.statuses),
+                "support_sizes":    {int(size): count for (size, count) in sorted(self.support_sizes.items())},
+                "successor_counts": {int(size): count for (size, count) in sorted(self.successor_counts.items())},
+                "time_histogram":   {"edges": self.time_bins.tolist(), "counts": self.time_histogram.tolist()}}
+
+    def summary(self):
+        return "Worst-case belief solver: {} solves ({} greedy, {} LP), {} fallbacks ({} time limit hits), avg time {:.1f} us, max time {:.1f} us".format(
+                self.solves, self.methods.get("greedy", 0), self.methods.get("lp", 0), self.fallbacks, self.time_limit_hits,
+                1e6*self.total_time/max(self.solves, 1), 1e6*self.max_time)
+
+def benchmark_instances(folder:str, repeats:int = 10, logging:bool = True):
+    """Re-solves all instances dumped by SolverTelemetry in folder, returns dict of (original time, median time now, method, status) by file name"""
+    results = {}
+    for file in sorted(os.listdir(folder)):
+        if not file.endswith(".npz"):
+            continue
+        instance = np.load(os.path.join(folder, file))
+        arguments = [instance[key] for key in ["pmin", "pmax", "entry_row", "entry_next", "weights", "Q_entries"]]
+        arguments += [np.size(instance["states"]), np.size(instance["next_states"])]
+        times = []
+        for _ in range(repeats):
+            t_start = t.perf_counter()
+            _b_next, method, status = WorstBeliefSolver.solve_entries(*arguments)
+            times.append(t.perf_counter() - t_start)
+        results[file] = (float(instance["time"]), float(np.median(times)), method, status)
+        if logging:
+            print("{}: support {}, {} successors, {} ({}), originally {:.1f} us, now {:.1f} us".format(file, np.size(instance["states"]),
+                  np.size(instance["next_states"]), method, status, 1e6*float(instance["time"]), 1e6*np.median(times)))
+    return results
+
+######################################################
+        ###     Comparison with cvxpy       ###
+######################################################
+
+def random_instance(StateSize:int, ActionSize:int, max_successors:int, alpha:float, rng:np.random.Generator):
+    """Returns random (Pavg, Pmin, Pmax, Q) tables, with uncertainty set as given by RAM_Environment_Explicit.uP_from_alpha"""
+    Pavg, Pmin, Pmax = {}, {}, {}
+    for s in range(StateSize):
+        Pavg[s], Pmin[s], Pmax[s] = {}, {}, {}
+        for a in range(ActionSize):
+            snexts = rng.choice(StateSize, size=rng.integers(1, min(max_successors, StateSize)+1), replace=False)
+            probs = rng.dirichlet(np.ones(np.size(snexts)))
+            Pavg[s][a] = {int(snext):p for (snext,p) in zip(snexts, probs)}
+            Pmin[s][a] = {int(snext):0 for snext in snexts}
+            Pmax[s][a] = {int(snext):min(p/alpha,1) for (snext,p) in zip(snexts, probs)}
+    Q = rng.random((StateSize, ActionSize))
+    return Pavg, Pmin, Pmax, Q
+
+def compare_with_cvxpy(nmbr_instances:int = 100, seed:int = 0, logging:bool = True):
+    """Compares WorstBeliefSolver with custom_worst_belief (cvxpy/GLPK) on random instances.
+    Returns the maximum difference in objective value and the speedup."""
+    from ACNO_Planning import custom_worst_belief
+    rng = np.random.default_rng(seed)
+    max_difference, time_cvxpy, time_solver = 0, 0, 0
+    nmbr_greedy = 0
+
+    for i in range(nmbr_instances):
+        StateSize, ActionSize = int(rng.integers(5, 200)), int(rng.choice([2,4,5,25]))
+        Pavg, Pmin, Pmax, Q = random_instance(StateSize, ActionSize, max_successors=8, alpha=rng.uniform(0.5,1), rng=rng)
+        solver = WorstBeliefSolver(Pmin, Pmax, Q, StateSize, ActionSize)
+
+        support = np.sort(rng.choice(StateSize, size=rng.integers(1, min(StateSize, 40)), replace=False))
+        b = Belief(support, rng.dirichlet(np.ones(np.size(support))))
+        a = int(rng.integers(ActionSize))
+
+        t_start = t.perf_counter()
+        b_cvxpy = custom_worst_belief(b.to_dict(), a, Pavg, Pmin, Pmax, Q, min_probability_considered=0)
+        t_mid = t.perf_counter()
+        b_solver = solver.solve(b, a, prune=False)
+        t_end = t.perf_counter()
+        nmbr_greedy += solver.telemetry.methods.get("greedy", 0)
+        time_cvxpy += t_mid - t_start; time_solver += t_end - t_mid
+
+        value_cvxpy  = np.max(sum(p * Q[s] for (s,p) in b_cvxpy.items()))
+        value_solver = np.max(b_solver.probs @ Q[b_solver.states])
+        max_difference = max(max_difference, abs(value_cvxpy - value_solver))
+
+    speedup = time_cvxpy / time_solver
+    if logging:
+        print("{} instances ({} solved greedily): max difference in objective {:.2e}, avg time cvxpy {:.2e} s, avg time solver {:.2e} s (speedup {:.1f}x)".format(
+               nmbr_instances, nmbr_greedy, max_difference, time_cvxpy/nmbr_instances, time_solver/nmbr_instances, speedup))
+    return max_difference, speedup
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the worst-case belief solver with the cvxpy/GLPK version on random instances.")
+    parser.add_argument('-n'    , default = 100,    help='Number of random instances')
+    parser.add_argument('-seed' , default = 0,      help='Random seed')
+    parser.add_argument('-instances', default = None, help='Folder of logged slow instances to re-solve instead (see SolverTelemetry)')
+    args = parser.parse_args()
+    if args.instances is not None:
+        benchmark_instances(args.instances)
+    else:
+        compare_with_cvxpy(int(args.n), int(args.seed))
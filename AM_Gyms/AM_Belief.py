@@ -0,0 +1,108 @@
+"""File containing a compact belief state class, as used by the planners, BAM_QMDP and the AM_ENV logging functions."""
+import numpy as np
+
+class Belief():
+    """Sparse belief state, given by a sorted array of states and an array of their probabilities.
+
+    Supports read-only dict-like access (b[s], s in b, len(b), b.items(), ...),
+    so it can be used in place of the {state:prob} dictionaries used before."""
+
+    __slots__ = ("states", "probs")
+
+    def __init__(self, states:np.ndarray, probs:np.ndarray):
+        """Creates belief from arrays of states and probabilities (states should be sorted!)"""
+        self.states = states
+        self.probs  = probs
+
+    @classmethod
+    def point(cls, s:int):
+        """Returns belief with all probability mass in state s."""
+        return cls(np.array([s], dtype=np.int64), np.ones(1))
+
+    @classmethod
+    def from_dict(cls, b:dict):
+        """Returns belief with the same probabilities as dict b"""
+        states = np.fromiter(b.keys(), dtype=np.int64, count=len(b))
+        probs  = np.fromiter(b.values(), dtype=np.float64, count=len(b))
+        order  = np.argsort(states)
+        return cls(states[order], probs[order])
+
+    @classmethod
+    def from_unsorted(cls, states:np.ndarray, probs:np.ndarray):
+        """Returns belief from arrays of (possibly unsorted and repeating) states and their probabilities."""
+        states, inverse = np.unique(states, return_inverse=True)
+        return cls(states, np.bincount(inverse, weights=probs, minlength=np.size(states)))
+
+    def to_dict(self):
+        """Returns belief as {state:prob} dictionary"""
+        return dict(zip(self.states.tolist(), self.probs.tolist()))
+
+    def pruned(self, min_probability_considered:float = 0.001):
+        """Returns belief without states with probability lower than min_probability_considered, renormalised.
+        (If this would remove all states, only states with zero probability are removed.)"""
+        filter = np.logical_and(self.probs >= min_probability_considered, self.probs > 0)
+        if not np.any(filter):
+            filter = self.probs > 0
+        probs = self.probs[filter]
+        return Belief(self.states[filter], probs / np.sum(probs))
+
+    def without(self, s:int):
+        """Returns belief conditioned on not being in state s (i.e. with s removed and renormalised)."""
+        i = np.searchsorted(self.states, s)
+        if i == np.size(self.states) or self.states[i] != s:
+            return self
+        states, probs = np.delete(self.states, i), np.delete(self.probs, i)
+        return Belief(states, probs / np.sum(probs))
+
+    def isclose(self, other:"Belief", rtol:float = 1e-6, atol:float = 1e-12):
+        """Checks whether other has the same support and approximately the same probabilities
+        (with tolerance max(rtol * other.probs, atol), as in pytest.approx)."""
+        return (np.array_equal(self.states, other.states) and
+                bool(np.all(np.abs(self.probs - other.probs) <= np.maximum(rtol * np.abs(other.probs), atol))))
+
+    def key(self, precision:float = 1e-6):
+        """Returns hashable key, with probabilities rounded to multiples of precision."""
+        return (self.states.tobytes(), np.rint(self.probs / precision).astype(np.int64).tobytes())
+
+    def __eq__(self, other):
+        if not isinstance(other, Belief):
+            return NotImplemented
+        return np.array_equal(self.states, other.states) and np.array_equal(self.probs, other.probs)
+
+    def __hash__(self):
+        return hash((self.states.tobytes(), self.probs.tobytes()))
+
+    # Dict-like access:
+
+    def get(self, s:int, default = None):
+        i = np.searchsorted(self.states, s)
+        if i < np.size(self.states) and self.states[i] == s:
+            return self.probs[i]
+        return default
+
+    def __getitem__(self, s:int):
+        p = self.get(s, None)
+        if p is None:
+            raise KeyError(s)
+        return p
+
+    def __contains__(self, s:int):
+        return self.get(s, None) is not None
+
+    def __len__(self):
+        return np.size(self.states)
+
+    def __iter__(self):
+        return iter(self.states.tolist())
+
+    def keys(self):
+        return self.states.tolist()
+
+    def values(self):
+        return self.probs.tolist()
+
+    def items(self):
+        return zip(self.states.tolist(), self.probs.tolist())
+
+    def __repr__(self):
+        return "Belief({})".format(self.to_dict())
@@ -1,7 +1,6 @@
 # Wrapper to turn Open AI Gym-environments into active measure environments
 import numpy as np
 import math as m
-import matplotlib.pyplot as plt
 
 
 class AM_ENV():
@@ -71,6 +70,22 @@ class AM_ENV():
     
     def set_state(self,s):
         self.env.set_state(s)
+
+    def has_step_batch(self):
+        return hasattr(self.env, "step_batch")
+
+    def step_batch(self, states, actions, rng = None):
+        """Performs actions in states (both arrays), as step does after set_state. Returns arrays (next states, rewards, dones).
+        Random numbers are drawn from rng (a np.random.Generator, or np.random by default), step limits are not applied."""
+        next_states, rewards, dones = self.env.step_batch(states, actions, rng)
+        return next_states, rewards * self.reward_factor, dones
+
+    def has_transition_distribution(self):
+        return hasattr(self.env, "transition_distribution")
+
+    def transition_distribution(self, s, action):
+        "Returns all outcomes of taking action in state s as list of (prob, snext, reward, done), if the environment provides these"
+        return [(p, snext, reward * self.reward_factor, done) for (p, snext, reward, done) in self.env.transition_distribution(s, action)]
     
     def horizon(self):
         return None
@@ -83,13 +98,11 @@ class AM_ENV():
     # Used for debugging Agents running on Frozen Lake environment.
 
     def log_action(self, action, obs, s):
+        "Logs action and belief accuracy, with belief s either a dict or a Belief (see AM_Belief.py)"
 
         self.choiceTable[obs,action] += 1
         self.densityTable[obs] += 1
-        if obs in s:
-            self.accuracyTable[obs] = ( self.accuracyTable[obs] * (self.densityTable[obs]-1) + s[obs] ) / self.densityTable[obs]
-        else: 
-            self.accuracyTable[obs] = self.accuracyTable[obs] * (self.densityTable[obs]-1) / self.densityTable[obs]
+        self.accuracyTable[obs] = ( self.accuracyTable[obs] * (self.densityTable[obs]-1) + s.get(obs, 0) ) / self.densityTable[obs]
 
 
 class AM_Visualiser(): # Assuming a grid!
@@ -116,6 +129,7 @@ class AM_Visualiser(): # Assuming a grid!
         elif action == 3: return '^'
 
     def plot_choice_certainty(self):
+        import matplotlib.pyplot as plt
 
         # Gather data:
         choice, certainty = np.zeros(self.StateSize, dtype=np.int8), np.zeros(self.StateSize)
@@ -141,6 +155,7 @@ class AM_Visualiser(): # Assuming a grid!
 
 
     def plot_choice_density(self):
+        import matplotlib.pyplot as plt
         choice = np.zeros(self.StateSize, dtype=np.int8)
         for i in range(self.StateSize):
             choice[i] = np.argmax(self.QTable[i])
@@ -163,6 +178,7 @@ class AM_Visualiser(): # Assuming a grid!
         plt.clf()
 
     def plot_choice_maxQ(self):
+        import matplotlib.pyplot as plt
         choice, maxQ = np.zeros(self.StateSize, dtype=np.int8), np.zeros(self.StateSize)
         for i in range(self.StateSize):
             choice[i] = np.argmax(self.QTable[i])
@@ -184,6 +200,7 @@ class AM_Visualiser(): # Assuming a grid!
         plt.clf()
     
     def plot_choice_state_accuracy(self):
+        import matplotlib.pyplot as plt
         choice, acc = np.zeros(self.StateSize, dtype=np.int8), np.zeros(self.StateSize)
         choice = np.argmax(self.QTable, 1)
         acc = self.accuracy
@@ -4,9 +4,17 @@ import numpy as np
 from gym import Env, spaces, utils
 from AM_Gyms.AM_Env_wrapper import AM_ENV
 from AM_Gyms.ModelLearner_V2 import ModelLearner
-from AM_Gyms.ModelLearner_Robust import ModelLearner_Robust
+from AM_Gyms.ModelLearner_Robust import ModelLearner_Robust, ModelLearner_Robust_Alphas
+from AM_Gyms.Sparse_Tables import dict_to_csr, csr_to_dict
 import os
 import json
+import tempfile
+
+# Format used for exporting models: "npz" (binary) or "json"
+model_format = "npz"
+
+# Models read so far, by (path, modification time). Only used after calling share_models().
+shared_models = None
 
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -27,6 +35,88 @@ def jsonKeys2int(x):
         return newdict
     return x
 
+def model_to_arrays(model:dict):
+    """Returns model dictionary as flat arrays: (s,a,snext)-tables are stored in CSR-format
+    (as name.indptr, name.indices and name.data, see Sparse_Tables.dict_to_csr), all other entries as (dense) arrays."""
+    StateSize, ActionSize = model["StateSize"], model["ActionSize"]
+    arrays = {}
+    for (name, value) in model.items():
+        if isinstance(value, dict):
+            arrays[name+".indptr"], arrays[name+".indices"], arrays[name+".data"] = dict_to_csr(value, StateSize, ActionSize)
+        else:
+            arrays[name] = np.asarray(value)
+    return arrays
+
+def model_from_arrays(arrays):
+    """Returns model dictionary from flat arrays (i.e. the inverse of model_to_arrays)"""
+    model = {name: arrays[name].item() for name in ["StateSize", "ActionSize", "MeasureCost", "s_init"]}
+    for name in arrays:
+        if name.endswith(".indptr"):
+            table = name[:-len(".indptr")]
+            model[table] = csr_to_dict(arrays[name], arrays[table+".indices"], arrays[table+".data"],
+                                       model["StateSize"], model["ActionSize"])
+        elif "." not in name and name not in model:
+            model[name] = arrays[name]
+    return model
+
+def model_file(fullPath:str):
+    """Returns (path, format) of the model file with the given path, with format "npz" or "json".
+    Binary files (fullPath.npz) are used if they exist and are not older than the json-file."""
+    binaryPath = fullPath + ".npz"
+    if os.path.exists(binaryPath) and (not os.path.exists(fullPath) or os.path.getmtime(binaryPath) >= os.path.getmtime(fullPath)):
+        return binaryPath, "npz"
+    with open(fullPath, 'rb') as infile:
+        if infile.read(2) == b"PK": # i.e. a zip-file, as used for npz
+            return fullPath, "npz"
+    return fullPath, "json"
+
+def share_models():
+    """Keeps all models read from now on in memory, such that they are read only once by this process and its (forked) children.
+    Note that read_model then returns the same dictionary for each read, so models should not be altered."""
+    global shared_models
+    if shared_models is None:
+        shared_models = {}
+
+def read_model(fullPath:str):
+    """Reads model dictionary from file (in either format)"""
+    path, format = model_file(fullPath)
+    if shared_models is not None:
+        key = (path, os.path.getmtime(path))
+        if key not in shared_models:
+            shared_models[key] = read_model_file(path, format)
+        return shared_models[key]
+    return read_model_file(path, format)
+
+def read_model_file(path:str, format:str):
+    if format == "npz":
+        with np.load(path, allow_pickle=False) as arrays:
+            return model_from_arrays(arrays)
+    with open(path, 'r') as infile:
+        return json.load(infile, object_hook = jsonKeys2int)
+
+def write_model(fullPath:str, model:dict, format:str = None):
+    """Writes model dictionary to file, in binary (fullPath.npz) or json (fullPath) format."""
+    if format is None:
+        format = model_format
+    if format == "npz":
+        atomic_write(fullPath + ".npz", lambda outfile: np.savez(outfile, **model_to_arrays(model)), binary=True)
+    else:
+        atomic_write(fullPath, lambda outfile: json.dump(model, outfile, cls=NumpyEncoder))
+
+def atomic_write(path:str, write, binary:bool = False):
+    """Writes a file by calling write(file) on a temporary file in the same folder, which then replaces path.
+    This way, (concurrent) readers never see a partially written file."""
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path) or None, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as outfile:
+            write(outfile)
+        umask = os.umask(0); os.umask(umask)    # (temporary files are only readable by their owner)
+        os.chmod(tmpPath, 0o666 & ~umask)
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
 class Environment_Explicit_Interface():
     # Interface class for our explicit environments, contains for importing & exporting
     
@@ -49,21 +139,19 @@ class Environment_Explicit_Interface():
     def env_from_dict(self):
         pass
     
-    def export_model(self, fileName, folder = None):
-        """Exports model to json file"""
+    def export_model(self, fileName, folder = None, format = None):
+        """Exports model to binary (npz) or json file (default: as set by model_format)"""
         if folder is None:
             folder = os.getcwd()
         fullPath = os.path.join(folder,fileName)
-        with open(fullPath, 'w') as outfile:
-            json.dump(self.env_to_dict(), outfile, cls=NumpyEncoder)
+        write_model(fullPath, self.env_to_dict(), format)
 
     def import_model(self, fileName, folder=None):
-        """Imports model from json file"""
+        """Imports model from binary (npz) or json file (detected automatically)"""
         if folder is None:
             folder = os.getcwd()
         fullPath = os.path.join(folder,fileName)
-        with open(fullPath, 'r') as outfile:
-            model = json.load(outfile, object_hook = jsonKeys2int)
+        model = read_model(fullPath)
         self.env_from_dict(model)
         self.isLearned = True
         
@@ -98,15 +186,18 @@ class AM_Environment_Explicit(Environment_Explicit_Interface):
         """Learns explicit model from Gym class (unimplemented!)"""
         print("to be implemented!")
         
-    def learn_model_AMEnv(self, env:AM_ENV, N = 100, df = 0.8):
-        """Learns explicit model from AM_ENV class"""
+    def learn_model_AMEnv(self, env:AM_ENV, N = 100, df = 0.8, workers = 1):
+        """Learns explicit model from AM_ENV class (exactly if the environment provides its transition distributions, otherwise by sampling)"""
         self.StateSize, self.ActionSize, self.MeasureCost, self.s_init = env.get_vars()
         self.StateSize += 1
         learner                 = ModelLearner(env, df = df)
-        try:
-            learner.run_setStates(N)
-        except AttributeError:
-            learner.run_visits(N)
+        if env.has_transition_distribution():
+            learner.run_exact(workers = workers)
+        else:
+            try:
+                learner.run_setStates(N, workers = workers)
+            except AttributeError:
+                learner.run_visits(N)
         print("done!")
 
         # TODO: add catch-except stuff
@@ -150,15 +241,35 @@ class RAM_Environment_Explicit(Environment_Explicit_Interface):
     # Worst-case dynamics assuming full observability
     PrMdp:dict
     QrMdp:np.ndarray
+    optimistic = False
     
-    def learn_robust_model_Env_alpha(self, env: Env, alpha:float, N_standard=None, N_robust=None, df = 0.95):
-        """Learn robust model from AM_Env class, assuming uncertainty is equal for all transitions and given by parameter alpha."""
+    def learn_robust_model_Env_alpha(self, env: Env, alpha:float, N_standard=None, N_robust=None, df = 0.95, tolerance = None):
+        """Learn robust model from AM_Env class, assuming uncertainty is equal for all transitions and given by parameter alpha.
+        If a tolerance is given, value iteration runs until the Bellman residual is below it (instead of N_robust sweeps)."""
         
         self.set_constants_env(env)
         if N_robust is None:
             N_robust = 200
         self.uP_from_alpha(alpha)
-        self.learn_RMDP(N_robust, df)
+        self.learn_RMDP(N_robust, df, tolerance)
+        
+    def learn_robust_models_alphas(self, alphas:list, N_robust=None, df = 0.95, tolerance = None):
+        """Returns robust models (of this class) for all given alphas, as learned by learn_robust_model_Env_alpha,
+        given the MDP-model is already initialised in this class (e.g. by import_MDP_env).
+        All alphas are learned at once (see ModelLearner_Robust_Alphas)."""
+        if N_robust is None:
+            N_robust = 200
+        learner = ModelLearner_Robust_Alphas(self, df = df, optimistic = self.optimistic)
+        models = []
+        for (Pmin, Pmax, Pr, Qr, sweeps, residual) in learner.run(alphas, N_robust, tolerance = tolerance):
+            model = self.__class__()
+            model.StateSize, model.ActionSize, model.MeasureCost, model.s_init = self.get_vars()
+            model.Pavg, model.R, model.Qavg = self.get_avg_tables()
+            model.Pmin, model.Pmax, model.PrMdp, model.QrMdp = Pmin, Pmax, Pr, Qr
+            model.RMDP_sweeps, model.RMDP_residual = sweeps, residual
+            model.isLearned = True
+            models.append(model)
+        return models
         
     def set_constants_env(self, env):
         """Reads constants from AM_environment"""
@@ -166,23 +277,24 @@ class RAM_Environment_Explicit(Environment_Explicit_Interface):
         self.StateSize += 1
     
     
-    def learn_MDP_env(self, env, N_standard, df):
+    def learn_MDP_env(self, env, N_standard, df, workers = 1):
         """Learn the MDP-model from an AM environment (using ModelLearner module)"""
         env_expl = AM_Environment_Explicit()
-        env_expl.learn_model_AMEnv(env, N_standard, df = df)
+        env_expl.learn_model_AMEnv(env, N_standard, df = df, workers = workers)
         self.Pavg, self.R, self.Qavg = env_expl.get_tables()
     
     def import_MDP_env(self, fileName, folder):
         env_expl = AM_Environment_Explicit()
         env_expl.import_model(fileName, folder)
         self.Pavg, self.R, self.Qavg = env_expl.get_tables()
-        self.set_constants_env(env_expl)
+        self.StateSize, self.ActionSize, self.MeasureCost, self.s_init = env_expl.get_vars() # (already includes the done-state)
         
-    def learn_RMDP(self, N_robust, df):
+    def learn_RMDP(self, N_robust, df, tolerance = None, optimistic = False):
         """Learn the worst-case transition and Q-function (using ModelLearner_Robust module), given the uMDP is already initialised in this class."""
-        robustLearner = ModelLearner_Robust(self, df = df)
-        robustLearner.run(updates=N_robust)
+        robustLearner = ModelLearner_Robust(self, df = df, optimistic = optimistic)
+        robustLearner.run(updates=N_robust, tolerance=tolerance)
         self.PrMdp, self.QrMdp = robustLearner.get_model()
+        self.RMDP_sweeps, self.RMDP_residual = robustLearner.sweeps, robustLearner.residual
         
     def uP_from_alpha(self, alpha):
         """Set Pmin and Pmax, according to self.P and alpha"""
@@ -205,6 +317,11 @@ class RAM_Environment_Explicit(Environment_Explicit_Interface):
                             "Qavg":    self.Qavg,
                             "R":       self.R
                         }
+        # Number of sweeps (and final Bellman residual) of robust value iteration, if learned here
+        if getattr(self, "RMDP_sweeps", None) is not None:
+            dict_robust["RMDP_sweeps"] = self.RMDP_sweeps
+        if getattr(self, "RMDP_residual", None) is not None:
+            dict_robust["RMDP_residual"] = self.RMDP_residual
         dict_robust.update(super().env_to_dict())
         return dict_robust
     
@@ -214,6 +331,8 @@ class RAM_Environment_Explicit(Environment_Explicit_Interface):
         self.Pavg, self.Qavg, self.R = dict["Pavg"], np.array(dict["Qavg"]), dict["R"]
         self.Pmin, self.Pmax         = dict["Pmin"] , dict["Pmax"]
         self.PrMdp, self.QrMdp       = dict["PrMdp"], np.array(dict["QrMdp"])
+        self.RMDP_sweeps   = int(float(dict["RMDP_sweeps"])) if "RMDP_sweeps"   in dict else None
+        self.RMDP_residual = float(dict["RMDP_residual"])    if "RMDP_residual" in dict else None
     
     def get_avg_tables(self):
         """Returns (Pavg, R, Qavg)"""
@@ -258,11 +377,11 @@ class OptAM_Environment_Explicit(RAM_Environment_Explicit):
     """Class to explicitely express uncertain AM environments, i.e. with matrixes for uP, R and Q. 
     Additionally contains an explicit copy of an \'average\' AM environment to be used by some functions."""
     
-    def learn_RMDP(self, N_robust, df):
-        """Learn the worst-case transition and Q-function (using ModelLearner_Robust module), given the uMDP is already initialised in this class."""
-        robustLearner = ModelLearner_Robust(self, df = df, optimistic = True)
-        robustLearner.run(updates=N_robust)
-        self.PrMdp, self.QrMdp = robustLearner.get_model()
+    optimistic = True
+    
+    def learn_RMDP(self, N_robust, df, tolerance = None):
+        """Learn the best-case transition and Q-function (using ModelLearner_Robust module), given the uMDP is already initialised in this class."""
+        super().learn_RMDP(N_robust, df, tolerance, optimistic = True)
     
     
     
@@ -50,8 +50,10 @@ class Avoid(gym.Env):
         elif (a == UP):
             self.y = max(self.y-1, self.Ymin)
     
-    def step_patrol(self):
-        speeds = np.random.binomial(1,self.p_slip, 2)
+    def step_patrol(self, speeds = None):
+        """Moves both patrollers, with speeds (0 or 1 for each) sampled if not given."""
+        if speeds is None:
+            speeds = np.random.binomial(1,self.p_slip, 2)
         # Move p1:
         if self.p1_dir == RIGHT:
             self.p1_x = min(self.p1_x + speeds[0], self.Xmax)
@@ -97,9 +99,9 @@ class Avoid(gym.Env):
             state, self.state_shape )
         self.steps = 0
 
-    def step(self, a):
+    def step(self, a, speeds = None):
         self.step_agent(a)
-        self.step_patrol()
+        self.step_patrol(speeds)
 
         self.steps += 1
         if self.steps >= self.max_steps:
@@ -111,6 +113,53 @@ class Avoid(gym.Env):
             return self.get_state(), self.caught_penalty, False, {}
         else:
             return self.get_state(), self.step_penalty, False, {}
+
+    def step_batch(self, states, actions, rng = None):
+        """Performs actions in states (both arrays) as step does after set_state, with random numbers drawn from rng
+        (a np.random.Generator, or np.random by default). Returns arrays (next states, rewards, dones)."""
+        if rng is None:
+            rng = np.random
+        states, actions = np.asarray(states), np.asarray(actions)
+        y, x, p1_x, p2_x, p1_dir, p2_dir = np.unravel_index(states, self.state_shape)
+
+        # Move agent
+        x = np.where(actions == LEFT,  np.maximum(x-1, self.Xmin), x)
+        x = np.where(actions == RIGHT, np.minimum(x+1, self.Xmax), x)
+        y = np.where(actions == DOWN,  np.minimum(y+1, self.Ymax), y)
+        y = np.where(actions == UP,    np.maximum(y-1, self.Ymin), y)
+
+        # Move patrollers (as in step_patrol)
+        speeds = rng.binomial(1, self.p_slip, (np.size(states), 2))
+        def move_patroller(p_x, p_dir, speed):
+            right = p_dir == RIGHT
+            p_x = np.where(right, np.minimum(p_x + speed, self.Xmax), np.maximum(p_x - speed, self.Xmin))
+            p_dir = np.where(right, np.where(p_x == self.Xmax, LEFT, RIGHT), np.where(p_x == self.Xmin, RIGHT, p_dir))
+            return p_x, p_dir
+        p1_x, p1_dir = move_patroller(p1_x, p1_dir, speeds[:,0])
+        p2_x, p2_dir = move_patroller(p2_x, p2_dir, speeds[:,1])
+
+        # Rewards (as in step, with steps = 1)
+        timeout = np.full(np.size(states), 1 >= self.max_steps)
+        at_goal = np.logical_and(~timeout, np.logical_and(y == self.Ymax, x == self.Xmax))
+        caught = np.logical_and(~np.logical_or(timeout, at_goal), np.logical_and.reduce(
+                    [y >= 1, y <= 3, x >= p1_x-1, x <= p1_x+1]))      # (only p1 catches, see is_caught)
+        x, y = np.where(caught, 0, x), np.where(caught, 0, y)
+        rewards = np.select([timeout, at_goal, caught], [0, self.goal_reward, self.caught_penalty], self.step_penalty)
+
+        next_states = np.ravel_multi_index((y, x, p1_x, p2_x, p1_dir, p2_dir), self.state_shape)
+        return next_states, rewards, np.logical_or(timeout, at_goal)
+
+    def transition_distribution(self, s, a):
+        """Returns all outcomes of taking action a in state s, as list of (prob, snext, reward, done)"""
+        outcomes = []
+        for speed1 in [0, 1]:
+            for speed2 in [0, 1]:
+                p = (self.p_slip if speed1 else 1-self.p_slip) * (self.p_slip if speed2 else 1-self.p_slip)
+                if p > 0:
+                    self.set_state(s)
+                    snext, reward, done, _info = self.step(a, [speed1, speed2])
+                    outcomes.append((p, snext, reward, done))
+        return outcomes
     
     def reset(self):
         self.x, self.y = 0, 0
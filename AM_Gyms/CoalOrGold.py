@@ -65,15 +65,18 @@ class CoalOrGold(gym.Env):
         elif (a == UP):
             self.y = max(self.y-1, self.Ymin)
     
-    def mine(self):
+    def mine(self, found_gold = None):
+        """Mines the deposit at the current position (if any). Whether gold is found is sampled, if not given."""
         for (i, pos) in enumerate(self.deposits):
             if (not self.deposits_mined[i]) and (self.x == pos[0] and self.y == pos[1]):
                 self.deposits_mined[i] = True
-                self.hasGold = self.hasGold or bool(np.random.binomial(1,self.goldChance))
+                if found_gold is None:
+                    found_gold = bool(np.random.binomial(1,self.goldChance))
+                self.hasGold = self.hasGold or found_gold
                 return True
         return False
                 
-    def step(self, a):
+    def step(self, a, found_gold = None):
 
         if self.steps >= self.max_steps:
             return self.get_state(), self.step_penalty, True, {}
@@ -82,7 +85,7 @@ class CoalOrGold(gym.Env):
             
             if self.at_goal() and np.all(self.deposits_mined):
                 return self.get_state(), self.CoalReward, True, {}
-            elif self.mine():
+            elif self.mine(found_gold):
                 return self.get_state(), self.step_penalty, False, {}
             elif self.hasGold:
                 return self.get_state(), self.GoldReward, True, {}
@@ -92,6 +95,49 @@ class CoalOrGold(gym.Env):
             self.step_agent(a)
             return self.get_state(), self.step_penalty, False, {}
 
+    def step_batch(self, states, actions, rng = None):
+        """Performs actions in states (both arrays) as step does after set_state, with random numbers drawn from rng
+        (a np.random.Generator, or np.random by default). Returns arrays (next states, rewards, dones)."""
+        if rng is None:
+            rng = np.random
+        states, actions = np.asarray(states), np.asarray(actions)
+        x, y, has_gold, *mined = np.unravel_index(states, self.state_shape)
+        mined = np.stack(mined, axis=1).astype(bool)
+        interact = actions == INTERACT
+
+        # Move agent
+        x_next = np.where(actions == LEFT,  np.maximum(x-1, self.Xmin), x)
+        x_next = np.where(actions == RIGHT, np.minimum(x+1, self.Xmax), x_next)
+        y_next = np.where(actions == DOWN,  np.minimum(y+1, self.Ymax), y)
+        y_next = np.where(actions == UP,    np.maximum(y-1, self.Ymin), y_next)
+
+        # Interact (as in step & mine)
+        at_goal = np.logical_and(y == np.floor(self.Ymax / 2), x == 0)
+        coal_done = np.logical_and.reduce([interact, at_goal, np.all(mined, axis=1)])
+        at_deposit = np.stack([np.logical_and(x == pos[0], y == pos[1]) for pos in self.deposits], axis=1)
+        mining = np.logical_and(np.logical_and(interact, ~coal_done)[:,np.newaxis], np.logical_and(at_deposit, ~mined))
+        is_mining = np.any(mining, axis=1)
+        found_gold = rng.binomial(1, self.goldChance, np.size(states)).astype(bool)
+        mined = np.logical_or(mined, mining)
+        has_gold = np.where(is_mining, np.logical_or(has_gold, found_gold), has_gold)
+        gold_done = np.logical_and.reduce([interact, ~coal_done, ~is_mining, has_gold.astype(bool)])
+
+        rewards = np.select([coal_done, gold_done, np.logical_and(interact, ~is_mining)],
+                            [self.CoalReward, self.GoldReward, self.interactPenalty], self.step_penalty)
+        next_states = np.ravel_multi_index((x_next, y_next, has_gold.astype(int)) + tuple(mined.T.astype(int)), self.state_shape)
+        return next_states, rewards, np.logical_or(coal_done, gold_done)
+
+    def transition_distribution(self, s, a):
+        """Returns all outcomes of taking action a in state s, as list of (prob, snext, reward, done).
+        (Outcomes with the same next state are not merged.)"""
+        outcomes = []
+        for (p, found_gold) in [(1-self.goldChance, False), (self.goldChance, True)]:
+            if p > 0:
+                self.set_state(s)
+                snext, reward, done, _info = self.step(a, found_gold)
+                outcomes.append((p, snext, reward, done))
+        return outcomes
+
         
 
 
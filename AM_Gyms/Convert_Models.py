@@ -0,0 +1,36 @@
+"""Converts all json models in a folder (by default AM_Gyms/Learned_Models) to the binary (npz) model format.
+Usage: python -m AM_Gyms.Convert_Models [folder] [-remove_json True]"""
+import os
+import argparse
+import time as t
+
+from AM_Gyms.AM_Tables import model_file, read_model, write_model
+
+def convert_folder(folder:str, remove_json:bool = False, logging:bool = True):
+    """Converts all json models in folder, returns number of converted models"""
+    nmbr_converted, t_json, t_npz = 0, 0, 0
+    for fileName in sorted(os.listdir(folder)):
+        fullPath = os.path.join(folder, fileName)
+        if (fileName.startswith(".") or fileName.endswith(".npz") or not os.path.isfile(fullPath)
+                or model_file(fullPath)[1] != "json"):
+            continue
+        t_start = t.perf_counter()
+        model = read_model(fullPath)
+        t_json += t.perf_counter() - t_start
+        write_model(fullPath, model, format="npz")
+        t_start = t.perf_counter()
+        read_model(fullPath)
+        t_npz += t.perf_counter() - t_start
+        if remove_json:
+            os.remove(fullPath)
+        nmbr_converted += 1
+    if logging:
+        print("Converted {} models in {} (loading time {:.2f} s as json, {:.2f} s as npz)".format(nmbr_converted, folder, t_json, t_npz))
+    return nmbr_converted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert json models to the binary (npz) model format.")
+    parser.add_argument('folder'        , nargs='?', default=os.path.join("AM_Gyms", "Learned_Models"), help='Folder containing the models')
+    parser.add_argument('-remove_json'  , default=False, help='Option to remove the json files after conversion')
+    args = parser.parse_args()
+    convert_folder(args.folder, args.remove_json in [True, "True", "true"])
@@ -76,6 +76,26 @@ class DroneInCorridor(Env):
         
         return x + self.Xmin, y + self.Ymin, vx + self.Vmin, vy + self.Vmin
     
+    def vars_to_states(self, x, y, vx, vy):
+        """Vectorised version of vars_to_state (for arrays of state variables)"""
+        x, y, vx, vy = x - self.Xmin, y - self.Ymin, vx - self.Vmin, vy - self.Vmin
+        states_first_rectangle = 1 + (self.Vnmbr-1) + self.Vnmbr * ((self.Vnmbr-1) + self.Vnmbr * ((self.Xnmbr-1) + self.Xnmbr * (self.WallYmin-1)) )
+        return np.where(y < self.WallYmin,
+                        vx + self.Vnmbr * (vy + self.Vnmbr * (x + self.Xnmbr * (y))),
+                        states_first_rectangle + vx + self.Vnmbr * (vy + self.Vnmbr * (x + (self.WallXmin) * (y - self.WallYmin))))
+
+    def states_to_vars(self, states):
+        """Vectorised version of state_to_vars (for an array of states)"""
+        states_first_rectangle = (self.Vnmbr-1) + self.Vnmbr * ((self.Vnmbr-1) + self.Vnmbr * ((self.Xnmbr-1) + self.Xnmbr * (self.WallYmin-1)) )
+        first = states <= states_first_rectangle
+        row_size = np.where(first, self.Xnmbr, self.WallXmin) * self.Vnmbr * self.Vnmbr
+        states = np.where(first, states, states - (1+states_first_rectangle))
+        y  = states // row_size + np.where(first, 0, self.WallYmin)
+        x  = (states % row_size) // (self.Vnmbr * self.Vnmbr)
+        vy = (states % (self.Vnmbr * self.Vnmbr)) // self.Vnmbr
+        vx = states % self.Vnmbr
+        return x + self.Xmin, y + self.Ymin, vx + self.Vmin, vy + self.Vmin
+    
     def vars_to_action(self, ax, ay):
         """Given action variables, returns 1D action"""
         ax, ay = ax - self.Amin, ay - self.Amin
@@ -88,9 +108,13 @@ class DroneInCorridor(Env):
         
         return (ax + self.Amin, ay + self.Amin)
     
+    # Representative roll p for each outcome of Gaussian_disturb, with its probability: (prob, p)
+    disturbance_rolls = [(0.68, 0), (0.14, 0.68), (0.14, 0.82), (0.04, 0.96)]
+
     @staticmethod
-    def Gaussian_disturb(a, amax):
-        p = np.random.rand()
+    def Gaussian_disturb(a, amax, p = None):
+        if p is None:
+            p = np.random.rand()
         if p < 0.68:
             pass
         elif p < 0.82:
@@ -105,6 +129,12 @@ class DroneInCorridor(Env):
             a = amax * np.sign(a)
         return a
         
+    @staticmethod
+    def Gaussian_disturb_batch(a, amax, p):
+        """Vectorised version of Gaussian_disturb (for arrays of accelerations and rolls)"""
+        a = a + np.select([p < 0.68, p < 0.82, p < 0.96, a < 0.98], [0, 1, -1, 2], -2)
+        return np.where(np.abs(a) > amax, amax * np.sign(a), a)
+        
     # Gym Functionality:
     
     def in_field(self, x, y):
@@ -125,11 +155,14 @@ class DroneInCorridor(Env):
         return (    x > self.GoalXmin and x < self.GoalXmax and
                     y > self.GoalYmin and y < self.GoalYmax)
     
-    def step(self, a):
+    def step(self, a, rolls = None):
         
-        # Read action & perform disturbation
+        # Read action & perform disturbation (with rolls sampled if not given)
         ax, ay = self.action_to_vars(a)
-        ax, ay = self.Gaussian_disturb(ax, self.Amax), self.Gaussian_disturb(ay, self.Amax)
+        if rolls is None:
+            ax, ay = self.Gaussian_disturb(ax, self.Amax), self.Gaussian_disturb(ay, self.Amax)
+        else:
+            ax, ay = self.Gaussian_disturb(ax, self.Amax, rolls[0]), self.Gaussian_disturb(ay, self.Amax, rolls[1])
         
         # Calculate (avg and final) speeds
         vx_prev, vy_prev = self.vx, self.vy
@@ -172,6 +205,45 @@ class DroneInCorridor(Env):
         else:
             self.x, self.y = self.x+dx, self.y+dy
             return self.get_state(), 0, False, {}
+
+    def step_batch(self, states, actions, rng = None):
+        """Performs actions in states (both arrays) as step does after set_state, with random numbers drawn from rng
+        (a np.random.Generator, or np.random by default). Returns arrays (next states, rewards, dones)."""
+        if rng is None:
+            rng = np.random
+        states, actions = np.asarray(states), np.asarray(actions)
+        x, y, vx, vy = self.states_to_vars(states)
+        ax, ay = self.action_to_vars(actions)
+        rolls = rng.random((2, np.size(states)))
+        ax, ay = self.Gaussian_disturb_batch(ax, self.Amax, rolls[0]), self.Gaussian_disturb_batch(ay, self.Amax, rolls[1])
+
+        vx_next = np.clip(vx + ax, self.Vmin, self.Vmax)
+        vy_next = np.clip(vy + ay, self.Vmin, self.Vmax)
+        dx, dy = np.round((vx + vx_next) / 2).astype(int), np.round((vy + vy_next) / 2).astype(int)
+        x_next, y_next = x + dx, y + dy
+
+        # Out of field, crossing a wall (i.e. the box from start to end intersects it), or in goal: done
+        out_field = ~np.logical_and.reduce([x_next <= self.Xmax, x_next >= self.Xmin, y_next <= self.Ymax, y_next >= self.Ymin])
+        in_wall = np.logical_and.reduce([np.maximum(x, x_next) >= self.WallXmin, np.minimum(x, x_next) <= self.WallXmax,
+                                         np.maximum(y, y_next) >= self.WallYmin, np.minimum(y, y_next) <= self.WallYmax])
+        in_goal = np.logical_and.reduce([x_next > self.GoalXmin, x_next < self.GoalXmax, y_next > self.GoalYmin, y_next < self.GoalYmax])
+        in_wall = np.logical_and(in_wall, ~out_field)
+        in_goal = np.logical_and(in_goal, ~np.logical_or(out_field, in_wall))
+        dones = np.logical_or.reduce([out_field, in_wall, in_goal])
+
+        next_states = np.where(dones, 0, self.vars_to_states(np.where(dones, x, x_next), np.where(dones, y, y_next), vx_next, vy_next))
+        return next_states, in_goal.astype(float), dones
+
+    def transition_distribution(self, s, a):
+        """Returns all outcomes of taking action a in state s, as list of (prob, snext, reward, done).
+        (Outcomes with the same next state are not merged.)"""
+        outcomes = []
+        for (px, roll_x) in self.disturbance_rolls:
+            for (py, roll_y) in self.disturbance_rolls:
+                self.set_state(s)
+                snext, reward, done, _info = self.step(a, (roll_x, roll_y))
+                outcomes.append((px*py, snext, reward, done))
+        return outcomes
         
     def reset(self):
         self.s = self.s_init
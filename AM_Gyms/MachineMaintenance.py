@@ -46,7 +46,7 @@ class Machine_Maintenance_Env(gym.Env):
         self.np_random, seed = seeding.np_random(seed)
         return [seed]
     
-    def step(self, action):
+    def step(self, action, transition = None):
         assert self.action_space.contains(action)
         
         
@@ -54,18 +54,15 @@ class Machine_Maintenance_Env(gym.Env):
         if   action == 0: current_cum_probs = self.cum_probs["Working"]
         elif action == 1: current_cum_probs = self.cum_probs["Repair"]
         
-        # Transition state:
-        rnd = np.random.rand()
-        has_transitioned = False
-        for transition in current_cum_probs:
-            cum_prob = current_cum_probs[transition]
-            if cum_prob > rnd and not has_transitioned:
-                has_transitioned = True
-                if transition == "Next"     : self.state = min(self.state+1, self.N)
-                elif transition == "This"   : pass
-                elif transition == "R1"     : self.state = -1
-                elif transition == "R2"     : self.state = -2
-                else                        : print("Transition not recognised: probability dictionary likely set up wrong!")
+        # Transition state (sampled, if not given):
+        if transition is None:
+            rnd = np.random.rand()
+            transition = next((transition for transition in current_cum_probs if current_cum_probs[transition] > rnd), None)
+        if transition == "Next"       : self.state = min(self.state+1, self.N)
+        elif transition == "This"   : pass
+        elif transition == "R1"     : self.state = -1
+        elif transition == "R2"     : self.state = -2
+        elif transition is not None : print("Transition not recognised: probability dictionary likely set up wrong!")
         
         # Determine reward:
         if self.state == -2         : reward = self.rewards["R2"]
@@ -79,6 +76,23 @@ class Machine_Maintenance_Env(gym.Env):
         done = self.nmbr_steps >= self.max_steps or np.random.rand() < self.done_prob
         return self.state+2, reward, done, {}
     
+    def transition_distribution(self, s, action):
+        """Returns all outcomes of taking action in state s, as list of (prob, snext, reward, done)"""
+        if   action == 0: current_cum_probs = self.cum_probs["Working"]
+        elif action == 1: current_cum_probs = self.cum_probs["Repair"]
+        
+        outcomes, cum_prob_prev = [], 0
+        for transition in current_cum_probs:
+            cum_prob = min(current_cum_probs[transition], 1)
+            p, cum_prob_prev = cum_prob - cum_prob_prev, max(cum_prob, cum_prob_prev)
+            if p > 0:
+                self.set_state(s)
+                snext, reward, _done, _info = self.step(action, transition)
+                outcomes.append((p * (1-self.done_prob), snext, reward, False))
+                if self.done_prob > 0:
+                    outcomes.append((p * self.done_prob, snext, reward, True))
+        return outcomes
+    
     def reset(self):
         self.state = 0
         self.nmbr_steps = 0
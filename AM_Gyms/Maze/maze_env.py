@@ -47,6 +47,7 @@ class MazeEnv(gym.Env):
         high: np.ndarray = np.array(self.maze_size, dtype=int) - np.ones(len(self.maze_size), dtype=int)
         self.observation_space: spaces.Box = spaces.Box(low, high, dtype=np.int64)
         self.breakChance = breakChance
+        self.move_table: np.ndarray = None
 
     def step(self, action: int or str) -> Tuple[np.array, float, bool, Dict]:
         """Run one timestep of the environment's dynamics. When end of
@@ -85,6 +86,30 @@ class MazeEnv(gym.Env):
         s = int(np.ravel_multi_index(self.maze_view.robot, self.maze_size))
         return s, reward, done, info
     
+    def build_move_table(self):
+        """Builds table with the next state for each state and action (if the robot moves)"""
+        self.move_table = np.zeros((np.prod(self.maze_size), len(self.actions)), dtype=np.int64)
+        for s in range(np.prod(self.maze_size)):
+            pos = np.array(np.unravel_index(s, self.maze_size))
+            cell = self.maze_view.maze.cells[pos[0]][pos[1]]
+            for (a, direction) in enumerate(self.actions):
+                next_pos = pos if cell.walls[direction] else pos + np.array(self.maze_view.maze.compass[direction])
+                self.move_table[s, a] = np.ravel_multi_index(next_pos, self.maze_size)
+
+    def step_batch(self, states: np.ndarray, actions: np.ndarray, rng = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Vectorised version of step: performs actions in states (both arrays), with random numbers drawn from rng
+        (a np.random.Generator, or np.random by default). Returns arrays (next states, rewards, dones)."""
+        if rng is None:
+            rng = np.random
+        if self.move_table is None:
+            self.build_move_table()
+        states, actions = np.asarray(states), np.asarray(actions)
+        moves = rng.random(np.size(states)) > self.breakChance
+        next_states = np.where(moves, self.move_table[states, actions], states)
+        dones = next_states == np.ravel_multi_index(self.maze_view.goal, self.maze_size)
+        rewards = np.where(dones, 1, -0.01)
+        return next_states, rewards, dones
+
     def set_state(self, state):
         pos = np.unravel_index(state, self.maze_size)
         self.maze_view.robot = pos
@@ -264,6 +264,10 @@ een.blit(self.__background, (0, 0))
     def goal(self) -> np.array:
         return self.__goal
 
+    @property
+    def maze(self) -> Maze:
+        return self.__maze
+
     # @property
     # def robot(self) -> np.array:
     #     return self.__robot
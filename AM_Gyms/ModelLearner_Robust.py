@@ -1,5 +1,10 @@
 import numpy as np
 import math as m
+import time as t
+import argparse
+import heapq
+
+from AM_Gyms.Sparse_Tables import dict_to_csr, csr_to_dict, align_to_csr, gather_rows, greedy_minimize
 
 def deep_copy(dict, S ,A):
     copy = {}
@@ -15,7 +20,7 @@ def deep_copy(dict, S ,A):
 class ModelLearner_Robust():
     """Class to find the worst-case transition function and Q-values for a uMDP."""
     
-    def __init__(self, model, df = 0.90, optimistic = False):
+    def __init__(self, model, df = 0.90, optimistic = False, vectorised = True):
         
         # Unpacking variables from environment:
         self.model        = model # NOTE: must be of class RAM_Environment_Explicit!
@@ -33,6 +38,10 @@ class ModelLearner_Robust():
         self.df         = df
         self.epsilon    = 0.25
         self.optimistic = optimistic
+        self.vectorised = vectorised
+        self.tolerance  = 1e-8      # (vectorised, without given tolerance) continue sweeping until Qr changes less than this in a sweep
+        self.max_sweeps = 100_000
+        self.log_interval = 100     # number of sweeps between residual reports
     
     def update_Qavg(self, s, a):
         """Updates Q-table according to (known) model dynamics (currently unused)"""
@@ -124,10 +133,139 @@ class ModelLearner_Robust():
             return np.random.randint(self.ActionSize)
         return np.argmax(self.Qr[s])
     
-    def run(self, updates = 1_000, logging = True):
+    def build_arrays(self):
+        """Stores Pmin, Pmax, Pr and R as arrays over all transitions (s,a,snext) in Pavg, in CSR-format (see Sparse_Tables.py)"""
+        S, A = self.StateSize, self.ActionSize
+        self.indptr, self.indices, _pavg = dict_to_csr(self.Pavg, S, A)
+        self.pmin    = align_to_csr(self.Pmin, self.indptr, self.indices, S, A)
+        self.pmax    = align_to_csr(self.Pmax, self.indptr, self.indices, S, A)
+        self.pr      = align_to_csr(self.Pr,   self.indptr, self.indices, S, A)
+        self.rewards = align_to_csr(self.R,    self.indptr, self.indices, S, A)
+        self.entry_row = np.repeat(np.arange(S*A), np.diff(self.indptr))
+        self.slack = 1 - np.bincount(self.entry_row, self.pmin, minlength=S*A)
+    
+    def update_Qr_rows(self, rows:np.ndarray = None):
+        """Updates Pr and Qr for the given state-action pairs (rows s*ActionSize+a, default: all) at once,
+        using the values of the previous sweep. Returns the largest change in Qr."""
+        if rows is None:
+            positions, entry_row, rows = slice(None), self.entry_row, np.arange(self.StateSize*self.ActionSize)
+        else:
+            positions, entry_row = gather_rows(self.indptr, rows)
+        next_values = self.Qr_max[self.indices[positions]]
+        values = -next_values if self.optimistic else next_values
+        pr = greedy_minimize(values, self.pmin[positions], self.pmax[positions], entry_row, self.slack[rows])
+        self.pr[positions] = pr
+        Q = np.bincount(entry_row, pr * (self.df * next_values + self.rewards[positions]), minlength=np.size(rows))
+        Qr = self.Qr.reshape(-1)
+        residual = np.max(np.abs(Q - Qr[rows]), initial=0)
+        Qr[rows] = Q
+        return residual
+    
+    def run_vectorised(self, updates = 1_000, logging = True, tolerance = None):
+        """Same as run, but with all state-action pairs updated at once in each sweep.
+        With a tolerance, only pairs for which a successor changed since their last update are updated
+        (i.e. prioritized sweeping), until no Qr-value can change by more than tolerance (or after 'updates' sweeps).
+        Otherwise, since these sweeps do not use values updated in the same sweep, more of them are required than in run:
+        we perform (at least) 'updates' sweeps over all pairs, and continue until Qr has converged (see self.tolerance)."""
+        if logging:
+            print("Learning robust model started (vectorised):")
+        self.build_arrays()
+        S, A = self.StateSize, self.ActionSize
+        self.Qr = np.array(self.Qr, dtype=float)
+        self.residuals = []
+        # Upper bound on the change in Qr if a pair were updated (infinite initially)
+        nonempty = np.diff(self.indptr) > 0
+        priority = np.where(nonempty, np.inf, 0)
+        
+        while len(self.residuals) < (updates if tolerance is not None else self.max_sweeps):
+            if tolerance is None and len(self.residuals) >= updates and self.residuals[-1] <= self.tolerance:
+                break
+            rows = None if tolerance is None else np.flatnonzero(priority > tolerance)
+            if rows is not None and np.size(rows) == 0:
+                break
+            Qr_max_old = self.Qr_max
+            residual = self.update_Qr_rows(rows)
+            self.Qr_max = np.max(self.Qr, axis=1)
+            self.residuals.append(residual)
+            if tolerance is not None:
+                # A pair's value changes at most df times the largest change of its successors
+                priority[rows] = 0
+                changes = np.abs(self.Qr_max - Qr_max_old)[self.indices]
+                priority[nonempty] += self.df * np.maximum.reduceat(changes, self.indptr[:-1][nonempty])
+            if logging and len(self.residuals) % self.log_interval == 0:
+                print("Sweep {}: Bellman residual {:.2e} ({} pairs updated)".format(
+                       len(self.residuals), residual, S*A if rows is None else np.size(rows)))
+        
+        self.sweeps = len(self.residuals)
+        self.residual = self.residuals[-1] if self.residuals else 0
+        self.Pr = csr_to_dict(self.indptr, self.indices, self.pr, S, A)
+        if tolerance is not None and np.max(priority) > tolerance:
+            self.warn_not_converged(np.max(priority), tolerance)
+        if logging:
+            print("Learning completed after {} sweeps (Bellman residual {:.2e})!\n\n".format(self.sweeps, self.residual))
+    
+    def run_prioritized(self, updates = 1_000, logging = True, tolerance = 1e-8):
+        """Prioritized sweeping with a priority queue of state-action pairs, ordered by how much their successors
+        have changed since their last update. Stops once no Qr-value can change by more than tolerance
+        (or after 'updates' updates per pair)."""
+        if logging:
+            print("Learning robust model started (prioritized sweeping):")
+        S, A = self.StateSize, self.ActionSize
+        predecessors = {s:set() for s in range(S)}
+        for s in range(S):
+            for a in range(A):
+                for snext in self.Pavg[s][a]:
+                    predecessors[snext].add((s,a))
+        
+        priority = np.full((S, A), np.inf)
+        queue = [(-np.inf, s, a) for s in range(S) for a in range(A)]
+        heapq.heapify(queue)
+        self.residuals = []
+        nmbr_updates, max_change = 0, 0
+        while queue and nmbr_updates < updates * S * A:
+            minus_p, s, a = heapq.heappop(queue)
+            if -minus_p != priority[s,a]:
+                continue # (outdated queue entry)
+            if -minus_p <= tolerance:
+                break
+            Qr_old, Qr_max_old = self.Qr[s][a], self.Qr_max[s]
+            self.update_Qr(s, a)
+            priority[s,a] = 0
+            max_change = max(max_change, abs(self.Qr[s][a] - Qr_old))
+            change = abs(self.Qr_max[s] - Qr_max_old)
+            if change > 0:
+                for (ps, pa) in predecessors[s]:
+                    priority[ps,pa] += self.df * change
+                    heapq.heappush(queue, (-priority[ps,pa], ps, pa))
+            nmbr_updates += 1
+            # Report residual per 'sweep', i.e. per S*A updates
+            if nmbr_updates % (S*A) == 0:
+                self.residuals.append(max_change)
+                if logging and len(self.residuals) % self.log_interval == 0:
+                    print("Sweep {}: Bellman residual {:.2e}".format(len(self.residuals), max_change))
+                max_change = 0
+        
+        self.sweeps = -(-nmbr_updates // (S*A))    # (partial sweeps counted as whole ones)
+        self.residual = np.max(priority)
+        if self.residual > tolerance:
+            self.warn_not_converged(self.residual, tolerance)
+        if logging:
+            print("Learning completed after {} updates ({:.1f} sweeps, max remaining change {:.2e})!\n\n".format(
+                   nmbr_updates, nmbr_updates / (S*A), self.residual))
+    
+    def warn_not_converged(self, residual, tolerance):
+        # NOTE: Pr is chosen according to next state values only (not rewards), which can make values oscillate.
+        print("WARNING: robust value iteration did not converge (residual {:.2e} > tolerance {:.2e})".format(residual, tolerance))
+    
+    def run(self, updates = 1_000, logging = True, tolerance = None):
         """Calculates model dynamics using eps_modelearning episodes, then Qr using
-        'updates' updates per state."""
+        'updates' updates per state. If a tolerance is given, we instead stop once Qr has converged
+        (up to tolerance), using prioritized sweeping, with 'updates' as maximum."""
 
+        if self.vectorised:
+            return self.run_vectorised(updates, logging, tolerance)
+        if tolerance is not None:
+            return self.run_prioritized(updates, logging, tolerance)
         if logging:
             print("Learning robust model started:")
         for i in range(updates):
@@ -139,8 +277,218 @@ class ModelLearner_Robust():
             # if ((i+1)%(min([round(updates/10), 1])) == 0 and logging):
             #     print("Episode {} completed!".format(i+1))
 
+        self.sweeps, self.residual = updates, None
         if logging:
             print("Learning completed after {} updates per state!\n\n".format(updates))
     def get_model(self):
         """Return (Pr, Qr)"""
-        return (self.Pr, self.Qr)
\ No newline at end of file
+        return (self.Pr, self.Qr)
+
+
+class ModelLearner_Robust_Alphas():
+    """Class to find the worst-case (or best-case) transition functions and Q-values for a family of uMDPs at once,
+    with uncertainty sets as given by RAM_Environment_Explicit.uP_from_alpha for a list of alphas.
+
+    All uMDPs share the sparsity pattern of Pavg, so their bounds are stacked along a second (batch) axis
+    and solved as in ModelLearner_Robust.run_vectorised. Only the middle alpha is solved starting from Qavg, the others
+    are solved in rounds of increasing resolution, each warm-started from the Q-values of its nearest solved alphas."""
+
+    def __init__(self, model, df = 0.90, optimistic = False):
+        self.StateSize, self.ActionSize, self.cost, self.s_init = model.get_vars()
+        self.Pavg, self.R, self.Qavg = model.get_avg_tables()
+        S, A = self.StateSize, self.ActionSize
+
+        self.indptr, self.indices, self.pavg = dict_to_csr(self.Pavg, S, A)
+        self.rewards   = align_to_csr(self.R, self.indptr, self.indices, S, A)
+        self.entry_row = np.repeat(np.arange(S*A), np.diff(self.indptr))
+        self.nonempty  = np.diff(self.indptr) > 0
+
+        self.df         = df
+        self.optimistic = optimistic
+        self.tolerance  = 1e-8      # (without given tolerance) continue sweeping until Qr changes less than this, as in ModelLearner_Robust
+        self.max_sweeps = 100_000
+        self.batches    = 0         # number of batched solves performed
+
+    warn_not_converged = ModelLearner_Robust.warn_not_converged
+
+    def bounds(self, alphas:np.ndarray):
+        """Returns (pmin, pmax) for all entries and alphas, as in uP_from_alpha"""
+        pmax = np.minimum(self.pavg[:,np.newaxis] / alphas[np.newaxis,:], 1)
+        return np.zeros_like(pmax), pmax
+
+    def solve_batch(self, alphas:np.ndarray, Qr:np.ndarray, updates:int, tolerance:float = None):
+        """Robust value iteration for all alphas at once, starting from Qr (S x A x alphas).
+        Returns (Qr, pr, sweeps, residuals, remaining priority), with the last three given per alpha."""
+        S, A, k = self.StateSize, self.ActionSize, np.size(alphas)
+        pmin, pmax = self.bounds(alphas)
+        slack = np.ones(S*A)    # (pmin is 0 for all alphas)
+        pr = np.repeat(self.pavg[:,np.newaxis], k, axis=1)
+        Qr = np.array(Qr, dtype=float).reshape(S*A, k)
+        Qr_max = np.max(Qr.reshape(S, A, k), axis=1)
+        priority = np.where(self.nonempty[:,np.newaxis], np.inf, 0) * np.ones(k)
+        sweeps, residuals = np.zeros(k, dtype=int), np.zeros(k)
+        converged = np.zeros(k, dtype=bool)
+
+        for sweep in range(1, (updates if tolerance is not None else self.max_sweeps) + 1):
+            if tolerance is None:
+                if np.all(converged):
+                    break
+                rows = np.arange(S*A)
+            else:
+                active = priority > tolerance
+                rows = np.flatnonzero(np.any(active, axis=1))
+                if np.size(rows) == 0:
+                    break
+            positions, entry_row = gather_rows(self.indptr, rows)
+            next_values = Qr_max[self.indices[positions]]
+            values = -next_values if self.optimistic else next_values
+            p = greedy_minimize(values, pmin[positions], pmax[positions], entry_row, slack[rows])
+            pr[positions] = p
+            contributions = p * (self.df * next_values + self.rewards[positions][:,np.newaxis])
+            Q = np.bincount((entry_row[:,np.newaxis] * k + np.arange(k)).reshape(-1), contributions.reshape(-1),
+                            minlength=np.size(rows)*k).reshape(np.size(rows), k)
+            residual = np.max(np.abs(Q - Qr[rows]), axis=0, initial=0)
+            Qr[rows] = Q
+            Qr_max_old, Qr_max = Qr_max, np.max(Qr.reshape(S, A, k), axis=1)
+
+            # Sweeps and residuals are counted per alpha, for as long as it had pairs to update (or had not converged)
+            updated = ~converged if tolerance is None else np.any(active[rows], axis=0)
+            sweeps[updated], residuals[updated] = sweep, residual[updated]
+            if tolerance is None:
+                converged |= (sweep >= updates) & (residual <= self.tolerance)
+            if tolerance is not None:
+                priority[rows] = 0
+                changes = np.abs(Qr_max - Qr_max_old)[self.indices]
+                priority[self.nonempty] += self.df * np.maximum.reduceat(changes, self.indptr[:-1][self.nonempty], axis=0)
+        self.batches += 1
+        return Qr.reshape(S, A, k), pr, sweeps, residuals, np.max(priority, axis=0)
+
+    @staticmethod
+    def warm_start(alpha:float, solved_alphas:list, solved_Q:list):
+        """Returns initial Q-values for alpha: interpolated between the nearest solved alphas on both sides, or else those of the nearest solved alpha"""
+        solved_alphas = np.array(solved_alphas)
+        lower, upper = np.flatnonzero(solved_alphas < alpha), np.flatnonzero(solved_alphas > alpha)
+        if np.size(lower) == 0 or np.size(upper) == 0:
+            return solved_Q[np.argmin(np.abs(solved_alphas - alpha))]
+        l, u = lower[np.argmax(solved_alphas[lower])], upper[np.argmin(solved_alphas[upper])]
+        w = (alpha - solved_alphas[l]) / (solved_alphas[u] - solved_alphas[l])
+        return (1-w) * solved_Q[l] + w * solved_Q[u]
+
+    def run(self, alphas:list, updates = 1_000, logging = True, tolerance = None):
+        """Returns, for each alpha, (Pmin, Pmax, Pr, Qr, sweeps, residual). See ModelLearner_Robust.run for updates and tolerance."""
+        S, A = self.StateSize, self.ActionSize
+        values = np.unique(np.asarray(alphas, dtype=float))
+        if logging:
+            print("Learning robust models for {} alphas started (batched):".format(np.size(values)))
+        solved_alphas, solved_Q = [], []
+        results = {}
+
+        # First solve the middle alpha (starting from Qavg), then every stride-th alpha (in sorted order), halving the stride each round
+        rounds = [[np.size(values) // 2]]
+        stride = 2 ** int(np.floor(np.log2(np.size(values))))
+        while stride >= 1:
+            rounds.append(list(range(0, np.size(values), stride)))
+            stride //= 2
+        for batch in rounds:
+            batch = [i for i in batch if values[i] not in results]
+            if batch:
+                batch_alphas = values[batch]
+                if solved_alphas:
+                    Q_init = np.stack([self.warm_start(alpha, solved_alphas, solved_Q) for alpha in batch_alphas], axis=2)
+                else:
+                    Q_init = np.repeat(np.array(self.Qavg, dtype=float)[:,:,np.newaxis], np.size(batch), axis=2)
+                Qr, pr, sweeps, residuals, remaining = self.solve_batch(batch_alphas, Q_init, updates, tolerance)
+                pmin, pmax = self.bounds(batch_alphas)
+                for (j, alpha) in enumerate(batch_alphas):
+                    results[alpha] = (pmin[:,j], pmax[:,j], pr[:,j], Qr[:,:,j], sweeps[j], residuals[j])
+                    solved_alphas.append(alpha); solved_Q.append(Qr[:,:,j])
+                    if tolerance is not None and remaining[j] > tolerance:
+                        self.warn_not_converged(remaining[j], tolerance)
+                if logging:
+                    print("Alphas {}: {} sweeps".format(", ".join("{:g}".format(alpha) for alpha in batch_alphas), ", ".join(str(n) for n in sweeps)))
+
+        models = []
+        for alpha in np.asarray(alphas, dtype=float):
+            pmin, pmax, pr, Qr, sweeps, residual = results[alpha]
+            models.append((csr_to_dict(self.indptr, self.indices, pmin, S, A), csr_to_dict(self.indptr, self.indices, pmax, S, A),
+                           csr_to_dict(self.indptr, self.indices, pr, S, A), Qr, int(sweeps), float(residual)))
+        if logging:
+            print("Learning completed in {} batches!\n\n".format(self.batches))
+        return models
+
+
+def benchmark(modelNames:list, folder:str, alpha:float = 0.8, updates:int = 50, df:float = 0.99, tolerance:float = None):
+    """Compares the vectorised and the (original) state-by-state robust value iteration on the given base models.
+    Both perform at least 'updates' sweeps and then continue until Qr has converged (up to tolerance if given,
+    using prioritized sweeping for the vectorised version, otherwise up to ModelLearner_Robust.tolerance)."""
+    from AM_Gyms.AM_Tables import RAM_Environment_Explicit
+    for modelName in modelNames:
+        results = {}
+        for vectorised in [False, True]:
+            model = RAM_Environment_Explicit()
+            try:
+                model.import_MDP_env(modelName, folder)
+            except FileNotFoundError:
+                print("{}: model not found in {}, skipped".format(modelName, folder))
+                break
+            model.uP_from_alpha(alpha)
+            learner = ModelLearner_Robust(model, df = df, vectorised = vectorised)
+            t_start = t.perf_counter()
+            learner.run(updates, logging = False, tolerance = tolerance if vectorised else None)
+            sweeps = learner.sweeps
+            if not vectorised:
+                # Continue sweeping until Qr has converged as far as in the vectorised version
+                while sweeps < learner.max_sweeps:
+                    Qr_old = np.array(learner.Qr, dtype=float)
+                    learner.run(1, logging = False)
+                    sweeps += 1
+                    if np.max(np.abs(learner.Qr - Qr_old)) <= (learner.tolerance if tolerance is None else tolerance):
+                        break
+            results[vectorised] = (t.perf_counter() - t_start, learner.get_model(), sweeps)
+        if len(results) < 2:
+            continue
+        (time_loop, (Pr_loop, Qr_loop), sweeps_loop), (time_vect, (Pr_vect, Qr_vect), sweeps_vect) = results[False], results[True]
+        max_diff_P = max(abs(p - Pr_vect[s][a][snext]) for s in Pr_loop for a in Pr_loop[s] for (snext, p) in Pr_loop[s][a].items())
+        # Pr can differ between next states of equal value, so we also compare the expected next value under both
+        V = np.max(Qr_vect, axis=1)
+        max_diff_PV = max(abs(sum((p - Pr_vect[s][a][snext]) * V[snext] for (snext, p) in Pr_loop[s][a].items())) for s in Pr_loop for a in Pr_loop[s])
+        print("{} (alpha={}): max difference Qr {:.2e}, Pr {:.2e} (expected next value {:.2e}); time {:.2f} s (loop, {} sweeps) vs {:.2f} s (vectorised, {} sweeps), speedup {:.1f}x".format(
+               modelName, alpha, np.max(np.abs(Qr_loop - Qr_vect)), max_diff_P, max_diff_PV, time_loop, sweeps_loop, time_vect, sweeps_vect, time_loop/time_vect))
+
+def benchmark_alphas(modelNames:list, folder:str, alphas:list, updates:int = 10_000, df:float = 0.99, tolerance:float = 1e-6):
+    """Compares learning robust models for all alphas at once (ModelLearner_Robust_Alphas) with learning them one by one."""
+    from AM_Gyms.AM_Tables import RAM_Environment_Explicit
+    for modelName in modelNames:
+        model = RAM_Environment_Explicit()
+        try:
+            model.import_MDP_env(modelName, folder)
+        except FileNotFoundError:
+            print("{}: model not found in {}, skipped".format(modelName, folder))
+            continue
+        t_start = t.perf_counter()
+        family = model.learn_robust_models_alphas(alphas, updates, df = df, tolerance = tolerance)
+        time_family, time_single, max_diff_Q = t.perf_counter() - t_start, 0, 0
+        for (alpha, robust_model) in zip(alphas, family):
+            model.uP_from_alpha(alpha)
+            learner = ModelLearner_Robust(model, df = df)
+            t_start = t.perf_counter()
+            learner.run(updates, logging = False, tolerance = tolerance)
+            time_single += t.perf_counter() - t_start
+            max_diff_Q = max(max_diff_Q, np.max(np.abs(learner.get_model()[1] - robust_model.QrMdp)))
+        print("{} ({} alphas): max difference Qr {:.2e}; time {:.2f} s (one by one) vs {:.2f} s (at once), speedup {:.1f}x".format(
+               modelName, len(alphas), max_diff_Q, time_single, time_family, time_single/time_family))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vectorised robust value iteration against the state-by-state version.")
+    parser.add_argument('models'    , nargs='*', default=["Avoid_0.5", "Drone"], help='Names of (non-robust) models in the folder')
+    parser.add_argument('-folder'   , default="AM_Gyms/Learned_Models", help='Folder containing the models')
+    parser.add_argument('-alpha'    , default=0.8,  help='Size of the uncertainty set (as in uP_from_alpha)')
+    parser.add_argument('-updates'  , default=None, help='(Minimal) number of updates per state (default: 50, or 10_000 with -alphas)')
+    parser.add_argument('-tol'      , default=None, help='Tolerance for the vectorised version (default: at least the same number of updates, until converged)')
+    parser.add_argument('-alphas'   , default=None, nargs='+', help='Instead, benchmark learning models for all these alphas at once against learning them one by one')
+    args = parser.parse_args()
+    if args.alphas is not None:
+        benchmark_alphas(args.models, args.folder, [float(alpha) for alpha in args.alphas], 10_000 if args.updates is None else int(args.updates),
+                         tolerance = 1e-6 if args.tol is None else float(args.tol))
+    else:
+        benchmark(args.models, args.folder, float(args.alpha), 50 if args.updates is None else int(args.updates), tolerance = None if args.tol is None else float(args.tol))
\ No newline at end of file
@@ -2,12 +2,18 @@
 
 
 from AM_Gyms.AM_Env_wrapper import AM_ENV
+from AM_Gyms.Sparse_Tables import dict_to_csr, align_to_csr
 import numpy as np
+import multiprocessing as mp
+import time as t
+import os
 
 class ModelLearner():
     """Class to learn an OpenAI model and export it as a json file (with an explicit P, R and Q table)."""
     
     
+    min_chunks = 64     # minimal number of chunks of states when learning in parallel
+    
     def __init__(self, env:AM_ENV, df = 0.95, record_done = None):
          
          self.env = env
@@ -82,26 +88,147 @@ class ModelLearner():
         for i in range(final_updates):
             self.update_model()
             
-    def run_setStates(self, SA_updates = 100, logging = True):
+    def run_setStates(self, SA_updates = 100, logging = True, chunk_size = 1_000_000, workers = 1, seed = None):
+        """Learns the model from SA_updates samples of each state-action pair (using set_state, or step_batch if available).
+        Samples are first counted (for chunks of at most chunk_size samples, optionally divided over a number of worker
+        processes), after which the model is normalised once and Q is computed by value iteration."""
         if logging:
             print("Learning MDP-model started:")
         
-        for i in range(SA_updates):
-            
-            sorted_states = np.argsort(self.Q_max[:-1])
-            for s in sorted_states:
-                for a in range(self.ActionSize):
-                    # Set env to state, take action & update model.
-                    self.env.set_state(s)
-                    reward, done = self.env.step(a)
-                    if done:
-                        snext = self.doneState
-                    else:
-                        (snext,_cost) = self.env.measure()
-                    
-                    self.update_counters(s, a, snext, reward)
-                    self.update_model([(s,a)])
-            # print("{} iterations completed".format(i))
+        states_per_chunk = max(1, chunk_size // (SA_updates * self.ActionSize))
+        self.collect_counts(states_per_chunk, SA_updates, workers, seed, logging)
+        
+        self.normalise_model()
+        iterations = self.value_iteration()
+        if logging:
+            print("Model learned from {} samples per state-action pair, value iteration converged in {} iterations".format(SA_updates, iterations))
+    
+    def run_exact(self, logging = True, tolerance = 1e-8, max_iterations = 10_000, workers = 1):
+        """Builds P and R directly from the transition distributions of the environment
+        (see AM_ENV.transition_distribution, optionally divided over a number of worker processes),
+        then computes Q by value iteration."""
+        if logging:
+            print("Building exact MDP-model:")
+        
+        self.collect_counts(self.StateSize-1, None, workers, None, logging)
+        self.normalise_model()
+        
+        if self.record_done:
+            self.insert_done_transitions()
+        iterations = self.value_iteration(tolerance, max_iterations)
+        if logging:
+            print("Model built, value iteration converged in {} iterations".format(iterations))
+    
+    def collect_counts(self, states_per_chunk:int, SA_updates:int = None, workers:int = 1, seed:int = None, logging:bool = False):
+        """Adds counts for all (non-done) states to the counters, divided into chunks of states.
+        If SA_updates is None, the exact transition distributions are used, otherwise SA_updates samples per state-action pair.
+        
+        When sampling, each chunk uses its own random stream derived from seed (drawn from the global numpy stream if not given),
+        and with multiple workers chunks are divided over a process pool (each with a copy of the environment).
+        Results then do not depend on the number of workers."""
+        if workers <= 1 and SA_updates is None:
+            for start in range(0, self.StateSize-1, states_per_chunk):
+                chunk = np.arange(start, min(start + states_per_chunk, self.StateSize-1))
+                self.add_counts(*self.count_chunk(chunk, SA_updates))
+            return
+        
+        # Use (at least) min_chunks chunks, such that work can be divided evenly
+        states_per_chunk = max(1, min(states_per_chunk, -(-(self.StateSize-1) // self.min_chunks)))
+        chunks = [np.arange(start, min(start + states_per_chunk, self.StateSize-1)) for start in range(0, self.StateSize-1, states_per_chunk)]
+        if seed is None:
+            seed = np.random.randint(2**32)
+        tasks = [(chunk, SA_updates, chunk_seed) for (chunk, chunk_seed) in zip(chunks, np.random.SeedSequence(seed).spawn(len(chunks)))]
+        global_state = np.random.get_state()
+        if workers > 1:
+            pool = mp.get_context("fork").Pool(workers, initializer=init_worker, initargs=(self,))
+            results = pool.imap_unordered(count_chunk_worker, tasks)
+        else:
+            pool = None
+            init_worker(self)
+            results = map(count_chunk_worker, tasks)
+        
+        throughput = {}
+        try:
+            for (keys, weights, reward_sums, pid, nmbr_transitions, time) in results:
+                self.add_counts(keys, weights, reward_sums)
+                prev_transitions, prev_time = throughput.get(pid, (0, 0))
+                throughput[pid] = (prev_transitions + nmbr_transitions, prev_time + time)
+        finally:
+            if pool is not None:
+                pool.close(); pool.join()
+            else:
+                init_worker(None)   # (such that the learner is not kept alive by this module)
+            np.random.set_state(global_state)
+        
+        if logging:
+            for (i, (nmbr_transitions, time)) in enumerate(throughput.values()):
+                print("Worker {}: {} transitions in {:.2f} s ({:.0f} per s)".format(i, nmbr_transitions, time, nmbr_transitions / max(time, 1e-9)))
+    
+    def count_chunk(self, chunk:np.ndarray, SA_updates:int = None):
+        """Returns counts (keys, weights, reward_sums, see aggregate_counts) for all state-action pairs of the states in chunk,
+        either sampled (SA_updates per pair) or exact (if SA_updates is None)."""
+        if SA_updates is None:
+            transitions = np.array([(s, a, snext if not done else self.doneState, p, reward)
+                                    for s in chunk.tolist() for a in range(self.ActionSize)
+                                    for (p, snext, reward, done) in self.env.transition_distribution(s, a) if p > 0], dtype=float).reshape(-1, 5)
+            states, actions, next_states = transitions[:,:3].astype(np.int64).T
+            weights, rewards = transitions[:,3], transitions[:,4]
+        else:
+            states  = np.repeat(chunk, self.ActionSize * SA_updates)
+            actions = np.tile(np.repeat(np.arange(self.ActionSize), SA_updates), np.size(chunk))
+            next_states, rewards = self.sample_transitions(states, actions)
+            weights = np.ones(np.size(states))
+        return aggregate_counts(states * self.ActionSize + actions, next_states, weights, rewards, self.StateSize)
+    
+    def sample_transitions(self, states:np.ndarray, actions:np.ndarray):
+        """Samples a transition for each given state and action, returns arrays of next states (doneState if done) and rewards"""
+        if self.env.has_step_batch():
+            next_states, rewards, dones = self.env.step_batch(states, actions)
+            return np.where(dones, self.doneState, next_states), rewards
+        
+        next_states, rewards = np.zeros(np.size(states), dtype=np.int64), np.zeros(np.size(states))
+        for (i, (s, a)) in enumerate(zip(states.tolist(), actions.tolist())):
+            self.env.set_state(s)
+            rewards[i], done = self.env.step(a)
+            if done:
+                next_states[i] = self.doneState
+            else:
+                (next_states[i], _cost) = self.env.measure()
+        return next_states, rewards
+    
+    def add_counts(self, keys:np.ndarray, weights:np.ndarray, reward_sums:np.ndarray):
+        """Adds counts (as returned by aggregate_counts) to the counters, without updating the model"""
+        np.add.at(self.counter.reshape(-1), keys // self.StateSize, weights)
+        for (key, weight, reward_sum) in zip(keys.tolist(), weights.tolist(), reward_sums.tolist()):
+            row, snext = divmod(key, self.StateSize)
+            s, a = divmod(row, self.ActionSize)
+            self.P_counter[s][a][snext] = self.P_counter[s][a].get(snext, 0) + weight
+            self.R_counter[s][a][snext] = self.R_counter[s][a].get(snext, 0) + reward_sum
+    
+    def normalise_model(self):
+        """Computes P and R from the counters, for all (non-done) states"""
+        for s in range(self.StateSize-1):
+            for a in range(self.ActionSize):
+                for snext in self.P_counter[s][a]:
+                    self.P[s][a][snext] = self.P_counter[s][a][snext] / self.counter[s,a]
+                    self.R[s][a][snext] = self.R_counter[s][a][snext] / self.P_counter[s][a][snext]
+    
+    def value_iteration(self, tolerance = 1e-8, max_iterations = 10_000):
+        """Computes Q for the current model by (vectorised) value iteration, returns the number of iterations."""
+        nmbr_rows = self.StateSize * self.ActionSize
+        indptr, indices, probs = dict_to_csr(self.P, self.StateSize, self.ActionSize)
+        rewards = align_to_csr(self.R, indptr, indices, self.StateSize, self.ActionSize)
+        entry_row = np.repeat(np.arange(nmbr_rows), np.diff(indptr))
+        self.R_expected = np.bincount(entry_row, probs * rewards, minlength=nmbr_rows).reshape(self.StateSize, self.ActionSize)
+        
+        for i in range(max_iterations):
+            Q_next = np.bincount(entry_row, probs * self.Q_max[indices], minlength=nmbr_rows).reshape(self.StateSize, self.ActionSize)
+            Q = self.R_expected + self.df * Q_next
+            residual = np.max(np.abs(Q - self.Q))
+            self.Q, self.Q_max = Q, np.max(Q, axis=1)
+            if residual < tolerance:
+                break
+        return i+1
         
     def run_episode(self):
         self.env.reset()
@@ -181,6 +308,28 @@ class ModelLearner():
                 if not self.P[s][a]:
                     self.P[s][a][self.doneState] = 1
 
+def aggregate_counts(rows:np.ndarray, next_states:np.ndarray, weights:np.ndarray, rewards:np.ndarray, StateSize:int):
+    """Sums weights and weighted rewards of transitions per (row, next state) pair, with rows given as s*ActionSize + a.
+    Returns (keys, weights, reward_sums), with keys = row*StateSize + next state."""
+    keys, inverse = np.unique(rows * StateSize + next_states, return_inverse=True)
+    return keys, np.bincount(inverse, weights), np.bincount(inverse, weights * rewards)
+
+# Parallel learning: each worker process has its own copy of the learner (and its environment)
+worker_learner = None
+
+def init_worker(learner:ModelLearner):
+    global worker_learner
+    worker_learner = learner
+
+def count_chunk_worker(task):
+    """Counts transitions for one chunk (see ModelLearner.count_chunk), returns counts plus (pid, transitions, time) for logging"""
+    chunk, SA_updates, seed = task
+    np.random.seed(seed.generate_state(1)[0])
+    t_start = t.perf_counter()
+    keys, weights, reward_sums = worker_learner.count_chunk(chunk, SA_updates)
+    nmbr_transitions = np.size(chunk) * worker_learner.ActionSize * (SA_updates if SA_updates is not None else 1)
+    return keys, weights, reward_sums, os.getpid(), nmbr_transitions, t.perf_counter() - t_start
+
 def build_dictionary(statesize, actionsize, array:np.ndarray = None):
     dict = {}
     for s in range(statesize):
@@ -0,0 +1,82 @@
+"""File containing a content-addressed cache for learned (robust) models, which can be shared by concurrently running processes.
+
+Models are stored under a hash of all parameters they are learned with (environment, variant, size, alpha, N, df, ...)
+and the learner version. When a model is not cached yet, exactly one process learns it (using a file lock), while others
+wait and then import the result. Files are written atomically, so partially written models are never read."""
+import os
+import json
+import hashlib
+import time as t
+from contextlib import contextmanager
+
+from AM_Gyms.AM_Tables import atomic_write
+
+try:
+    import fcntl
+except ImportError:     # (e.g. on Windows: no locking between processes)
+    fcntl = None
+
+# Increase when the model learners change, such that previously cached models are not used anymore.
+learner_version = 1
+
+class ModelCache():
+    """Cache of explicit environments (see AM_Tables.py), stored as '<tag>_<hash>' in the given folder."""
+
+    def __init__(self, folder:str, logging:bool = True):
+        self.folder = folder
+        self.logging = logging
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(**params):
+        """Returns hash of the given parameters (plus learner version)"""
+        params = dict(params, learner_version = learner_version)
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def path(self, tag:str, **params):
+        """Returns full path (without extension) of the model with given tag and parameters"""
+        return os.path.join(self.folder, "{}_{}".format(tag, self.key(**params)))
+
+    @staticmethod
+    def contains_path(fullPath:str):
+        return os.path.exists(fullPath + ".npz") or os.path.exists(fullPath)
+
+    def contains(self, tag:str, **params):
+        """Checks whether the model with given tag and parameters is cached"""
+        return self.contains_path(self.path(tag, **params))
+
+    @contextmanager
+    def lock(self, fullPath:str):
+        """Holds an (inter-process) lock for the given model while in this context"""
+        if fcntl is None:
+            yield
+            return
+        with open(fullPath + ".lock", 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if self.logging:
+                    print("Waiting for another process to learn {}...".format(os.path.basename(fullPath)))
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def get(self, env_explicit, tag:str, learn, **params):
+        """Loads the model with given tag and parameters into env_explicit. If it is not cached yet,
+        it is first learned by calling learn(env_explicit) and then exported. Returns the full path of the model."""
+        fullPath = self.path(tag, **params)
+        if not self.contains_path(fullPath):
+            with self.lock(fullPath):
+                if not self.contains_path(fullPath):
+                    t_start = t.perf_counter()
+                    learn(env_explicit)
+                    env_explicit.export_model(os.path.basename(fullPath), self.folder)
+                    atomic_write(fullPath + ".params", lambda outfile: json.dump(dict(params, tag = tag,
+                                 learner_version = learner_version), outfile, indent=1, default=str))
+                    if self.logging:
+                        print("Learned and cached {} in {:.1f} s".format(os.path.basename(fullPath), t.perf_counter() - t_start))
+                    return fullPath
+        env_explicit.import_model(os.path.basename(fullPath), self.folder)
+        return fullPath
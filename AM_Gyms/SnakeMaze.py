@@ -51,7 +51,8 @@ class SnakeMaze(gym.Env):
         self.y, self.x = np.unravel_index(state, self.state_shape)
         self.steps = 0
 
-    def step_agent(self, a):
+    def step_agent(self, a, nmbr_steps = None):
+        """Moves the agent according to action a. For left/right actions, the number of steps is sampled (if not given)."""
 
         if a == DOWN:
             if ((self.y % 2 == 0) and (self.x == self.Xmax) ):
@@ -70,12 +71,22 @@ class SnakeMaze(gym.Env):
             else:
                 sign = 1
 
-            roll = np.random.random()
-            for (i, p) in enumerate(chances):
-                if roll < p:
-                    # print(a, sign*i, self.x, min(self.Xmax, max(self.Xmin, self.x + sign * i)))
-                    self.x = min(self.Xmax, max(self.Xmin, self.x + sign * i))
-                    return
+            if nmbr_steps is None:
+                roll = np.random.random()
+                nmbr_steps = next(i for (i, p) in enumerate(chances) if roll < p)
+            self.x = min(self.Xmax, max(self.Xmin, self.x + sign * nmbr_steps))
+            return
+
+    @staticmethod
+    def steps_distribution(a):
+        """Returns list of (prob, nmbr_steps) for action a"""
+        if a == DOWN:
+            return [(1, 0)]
+        if a == RISKYLEFT or a == RISKYRIGHT:
+            chances = RISKY_CHANCES
+        else:
+            chances = NORMAL_CHANCES
+        return [(p - p_prev, i) for (i, (p_prev, p)) in enumerate(zip([0] + chances[:-1], chances)) if p > p_prev]
 
 
 
@@ -89,7 +100,7 @@ class SnakeMaze(gym.Env):
         # elif (a == DOWN and (self.y % 2 == 1) and (self.x == self.Xmin) ):
         #     self.y = min(self.y+1, self.Ymax)
                 
-    def step(self, a):
+    def step(self, a, nmbr_steps = None):
 
         if self.steps >= self.max_steps:
             return self.get_state(), self.step_penalty, True, {}
@@ -99,10 +110,45 @@ class SnakeMaze(gym.Env):
         
         # if np.random.random() > self.slipChance:
         #     self.step_agent(a)
-        self.step_agent(a)
+        self.step_agent(a, nmbr_steps)
 
         return self.get_state(), self.step_penalty, False, {}
 
+    def step_batch(self, states, actions, rng = None):
+        """Performs actions in states (both arrays) as step does after set_state, with random numbers drawn from rng
+        (a np.random.Generator, or np.random by default). Returns arrays (next states, rewards, dones)."""
+        if rng is None:
+            rng = np.random
+        states, actions = np.asarray(states), np.asarray(actions)
+        y, x = np.unravel_index(states, self.state_shape)
+        at_goal = np.logical_and(x == 0, y == self.Ymax)
+
+        # Down is only possible at the end of a row
+        at_row_end = np.where(y % 2 == 0, x == self.Xmax, x == self.Xmin)
+        y_next = np.where(np.logical_and(actions == DOWN, at_row_end), np.minimum(y+1, self.Ymax), y)
+
+        # Left/right: sample number of steps (i.e. the first i with roll < chances[i])
+        roll = rng.random(np.size(states))
+        risky = np.logical_or(actions == RISKYLEFT, actions == RISKYRIGHT)
+        nmbr_steps = np.where(risky, np.searchsorted(RISKY_CHANCES, roll, side="right"),
+                                     np.searchsorted(NORMAL_CHANCES, roll, side="right"))
+        nmbr_steps[actions == DOWN] = 0
+        sign = np.where(np.logical_or(actions == LEFT, actions == RISKYLEFT), -1, 1)
+        x_next = np.clip(x + sign * nmbr_steps, self.Xmin, self.Xmax)
+
+        next_states = np.where(at_goal, states, np.ravel_multi_index((y_next, x_next), self.state_shape))
+        rewards = np.where(at_goal, self.GoalReward + self.step_penalty, self.step_penalty)
+        return next_states, rewards, at_goal
+
+    def transition_distribution(self, s, a):
+        """Returns all outcomes of taking action a in state s, as list of (prob, snext, reward, done)"""
+        outcomes = []
+        for (p, nmbr_steps) in self.steps_distribution(a):
+            self.set_state(s)
+            snext, reward, done, _info = self.step(a, nmbr_steps)
+            outcomes.append((p, snext, reward, done))
+        return outcomes
+
     
     def reset(self):
         self.x, self.y = 0, 0
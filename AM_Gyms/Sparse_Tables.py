@@ -0,0 +1,136 @@
+"""File containing functions for converting (dict-based) model tables into sparse arrays, and for computing with them."""
+import numpy as np
+
+def dict_to_csr(P:dict, StateSize:int, ActionSize:int):
+    """Returns (indptr, indices, data) of table P in CSR-format.
+
+    Rows are state-action pairs (with row index s*ActionSize + a), columns are next states.
+    Within each row, next states are sorted. Explicit zeros in P are kept."""
+
+    counts = np.zeros(StateSize * ActionSize, dtype=np.int64)
+    for s in range(StateSize):
+        if s not in P:
+            continue
+        for a in range(ActionSize):
+            if a in P[s]:
+                counts[s*ActionSize + a] = len(P[s][a])
+
+    indptr  = np.zeros(StateSize * ActionSize + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+    indices = np.zeros(indptr[-1], dtype=np.int64)
+    data    = np.zeros(indptr[-1], dtype=np.float64)
+
+    for s in range(StateSize):
+        if s not in P:
+            continue
+        for a in range(ActionSize):
+            if a not in P[s] or not P[s][a]:
+                continue
+            row = s*ActionSize + a
+            snexts = np.fromiter(P[s][a].keys(), dtype=np.int64, count=len(P[s][a]))
+            probs  = np.fromiter(P[s][a].values(), dtype=np.float64, count=len(P[s][a]))
+            order  = np.argsort(snexts)
+            indices[indptr[row]:indptr[row+1]] = snexts[order]
+            data   [indptr[row]:indptr[row+1]] = probs[order]
+
+    return indptr, indices, data
+
+def csr_to_dict(indptr:np.ndarray, indices:np.ndarray, data:np.ndarray, StateSize:int, ActionSize:int):
+    """Returns table in (nested) dict-form, i.e. the inverse of dict_to_csr."""
+    indptr, indices, data = indptr.tolist(), indices.tolist(), data.tolist()
+    P = {}
+    for s in range(StateSize):
+        P[s] = {}
+        for a in range(ActionSize):
+            row = s*ActionSize + a
+            start, end = indptr[row], indptr[row+1]
+            P[s][a] = dict(zip(indices[start:end], data[start:end]))
+    return P
+
+def gather_rows(indptr:np.ndarray, rows:np.ndarray):
+    """Returns the positions (in indices/data) of all entries in given rows, and for each entry the index of its row in rows."""
+    starts = indptr[rows]
+    counts = indptr[rows+1] - starts
+    total = counts.sum()
+    row_of_entry = np.repeat(np.arange(np.size(rows)), counts)
+    positions = np.arange(total) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return positions, row_of_entry
+
+def weighted_row_sum(indptr:np.ndarray, indices:np.ndarray, data:np.ndarray, rows:np.ndarray, weights:np.ndarray):
+    """Computes sum_i weights[i] * M[rows[i]] for sparse matrix M, returned as (sorted column indices, values)."""
+    if np.size(rows) == 1:
+        start, end = indptr[rows[0]], indptr[rows[0]+1]
+        return indices[start:end].copy(), weights[0] * data[start:end]
+    positions, row_of_entry = gather_rows(indptr, rows)
+    columns, inverse = np.unique(indices[positions], return_inverse=True)
+    values = np.bincount(inverse, weights = weights[row_of_entry] * data[positions], minlength=np.size(columns))
+    return columns, values
+
+def align_to_csr(T:dict, indptr:np.ndarray, indices:np.ndarray, StateSize:int, ActionSize:int):
+    """Returns the values of (dict-based) table T on the sparsity pattern (indptr, indices), with 0 for missing entries."""
+    indptr_T, indices_T, data_T = dict_to_csr(T, StateSize, ActionSize)
+    if np.array_equal(indptr_T, indptr) and np.array_equal(indices_T, indices):
+        return data_T
+    data = np.zeros(np.size(indices))
+    for s in range(StateSize):
+        T_s = T.get(s, {})
+        for a in range(ActionSize):
+            T_sa = T_s.get(a, {})
+            row = s*ActionSize + a
+            for j in range(indptr[row], indptr[row+1]):
+                data[j] = T_sa.get(int(indices[j]), 0)
+    return data
+
+def row_cdf(indptr:np.ndarray, data:np.ndarray):
+    """Returns, for each entry, the (normalised) cumulative probability of its row up to and including that entry, plus its row index.
+    The values row + cdf are increasing over all entries, which allows sampling from many rows with one searchsorted call (see sample_rows)."""
+    nmbr_rows = np.size(indptr) - 1
+    counts = np.diff(indptr)
+    entry_row = np.repeat(np.arange(nmbr_rows), counts)
+    cum = np.cumsum(data)
+    row_start_cum = np.concatenate([[0], cum])[indptr[:-1]]
+    row_total = np.bincount(entry_row, weights=data, minlength=nmbr_rows)
+    cdf = (cum - row_start_cum[entry_row]) / np.where(row_total > 0, row_total, 1)[entry_row]
+    # Guard against rounding: the last entry of each row has cdf 1
+    cdf[indptr[1:][counts > 0] - 1] = 1
+    return entry_row + cdf
+
+def sample_rows(row_cdf_values:np.ndarray, indptr:np.ndarray, rows:np.ndarray, uniforms:np.ndarray):
+    """Returns the positions of sampled entries in given rows (using values from row_cdf and uniform samples in [0,1)).
+    Raises a ValueError if any of the rows is empty."""
+    if np.any(indptr[rows+1] == indptr[rows]):
+        raise ValueError("Cannot sample from empty rows {}".format(np.unique(rows[indptr[rows+1] == indptr[rows]])))
+    positions = np.searchsorted(row_cdf_values, rows + uniforms, side="right")
+    return np.minimum(positions, indptr[rows+1]-1)
+
+def greedy_minimize(values:np.ndarray, pmin:np.ndarray, pmax:np.ndarray, entry_row:np.ndarray, slack:np.ndarray, order:np.ndarray = None):
+    """For each column of values (entries x k), returns the probabilities minimizing the expected value of each row,
+    given bounds pmin/pmax. Entries should be grouped by row, with rows in increasing order.
+    Bounds (and slack) can also differ per column, i.e. be given as (entries x k) and (rows x k) arrays.
+    Optionally, the sorting of entries (per column, by row and then by value) can be given as order.
+
+    Probability mass is added to the lowest-valued entries first (see ModelLearner_Robust.custom_delta_minimize)."""
+    if values.ndim == 1:
+        return greedy_minimize(values[:, np.newaxis], pmin, pmax, entry_row, slack, np.lexsort((values, entry_row))[:, np.newaxis])[:,0]
+
+    # Sort entries by row, then by value.
+    if order is None:
+        order = np.argsort(values, axis=0, kind="stable")
+        order = np.take_along_axis(order, np.argsort(entry_row[order], axis=0, kind="stable"), axis=0)
+
+    # Fill up the free probability mass (slack) of each row, in sorted order
+    if pmin.ndim == 1:
+        pmin, pmax = pmin[:,np.newaxis], pmax[:,np.newaxis]
+    pmin_sorted = np.take_along_axis(np.broadcast_to(pmin, np.shape(order)), order, axis=0)
+    capacity = np.take_along_axis(np.broadcast_to(pmax, np.shape(order)), order, axis=0) - pmin_sorted
+    cum_before = np.cumsum(capacity, axis=0) - capacity
+    row_starts = np.searchsorted(entry_row, entry_row)
+    cum_before -= cum_before[row_starts]
+    slack_entries = slack[entry_row]
+    if slack_entries.ndim == 1:
+        slack_entries = slack_entries[:,np.newaxis]
+    added = np.clip(slack_entries - cum_before, 0, capacity)
+
+    P = np.empty_like(capacity)
+    np.put_along_axis(P, order, pmin_sorted + added, axis=0)
+    return P
@@ -233,6 +233,10 @@ class FrozenLakeEnv(Env):
             self.render()
         return (int(s), r, t, (False, {"prob": p}))
 
+    def transition_distribution(self, s, a):
+        """Returns all outcomes of taking action a in state s, as list of (prob, snext, reward, done)"""
+        return self.P[s][a]
+
     def reset(
         self,
         *,
@@ -2,10 +2,18 @@ import gym
 from gym import spaces
 from gym.utils import seeding
 import numpy as np
+from bisect import bisect_right
 from AM_Gyms.AM_Env_wrapper import AM_ENV
+from AM_Gyms.Sparse_Tables import dict_to_csr, align_to_csr, row_cdf, sample_rows
 
 
 class GenericAMGym(AM_ENV):
+    """AM environment defined by explicit P and R tables.
+    
+    Tables are converted to flat (CSR) arrays at construction, which are used for sampling: step uses them as Python lists
+    (with a buffer of uniform samples, refilled in blocks), the batch functions as numpy arrays."""
+    
+    uniform_buffer_size = 256
     
     def __init__(self, P:dict, R:dict, StateSize:int, ActionSize:int, MeasureCost:float, s_init:int, name:str, has_terminal_state:bool=True, max_steps:int = 1_000):
         
@@ -30,6 +38,8 @@ class GenericAMGym(AM_ENV):
         
         self.name = name
         self.seed()
+        self.build_sparse_tables()
+        self.uniforms, self.uniform_index = [], 0
     
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
@@ -38,16 +48,18 @@ class GenericAMGym(AM_ENV):
     def step(self, action):
         assert self.action_space.contains(action)
         
-        # Make transition
-        prev_state = self.state
-        p_dict = self.P[self.state][action]
-        states, probs = list(p_dict.keys()), list(p_dict.values())
-        self.state = np.random.choice(a=states, p=probs)
-        
-        # Get reward
-        reward = 0
-        if self.state in self.R[prev_state][action]:
-            reward = self.R[prev_state][action][self.state]
+        # Make transition: sample position in row using cumulative probabilities (see Sparse_Tables.sample_rows)
+        if self.uniform_index >= len(self.uniforms):
+            self.uniforms, self.uniform_index = np.random.random(self.uniform_buffer_size).tolist(), 0
+        u = self.uniforms[self.uniform_index]
+        self.uniform_index += 1
+        row = self.state * self.ActionSize + action
+        start, end = self.step_indptr[row], self.step_indptr[row+1]
+        if start == end:
+            raise ValueError("No transitions defined for state {} and action {}".format(self.state, action))
+        position = min(bisect_right(self.step_cdf, row + u, start, end), end-1)
+        self.state = self.step_indices[position]
+        reward = self.step_rewards[position]
         
         # Check if done
         self.steps_taken += 1
@@ -61,7 +73,47 @@ class GenericAMGym(AM_ENV):
     def reset(self):
         self.state = self.s_init
         self.steps_taken = 0
+        self.uniforms, self.uniform_index = [], 0     # such that episodes only depend on the global seed
         return self.state
     
     def getname(self):
-        return self.name
\ No newline at end of file
+        return self.name
+    
+    def build_sparse_tables(self):
+        """Builds CSR-arrays of P (with cumulative probabilities for sampling) and R, plus list-versions for step."""
+        # (Some stored models contain more states than StateSize, which we include as well)
+        nmbr_states = max(self.StateSize, len(self.P))
+        indptr, indices, data = dict_to_csr(self.P, nmbr_states, self.ActionSize)
+        rewards = align_to_csr(self.R, indptr, indices, nmbr_states, self.ActionSize)
+        self.sparse_tables = (indptr, indices, row_cdf(indptr, data), rewards)
+        self.step_indptr, self.step_indices, self.step_cdf, self.step_rewards = [array.tolist() for array in self.sparse_tables]
+    
+    # Batch functions, for running many episodes in lock-step:
+    
+    def sample_transitions(self, states:np.ndarray, actions:np.ndarray):
+        """Samples next states and rewards for arrays of states and actions"""
+        indptr, indices, cdf, rewards = self.sparse_tables
+        positions = sample_rows(cdf, indptr, states*self.ActionSize + actions, np.random.random(np.size(states)))
+        return indices[positions], rewards[positions]
+    
+    def reset_episodes(self, nmbr_episodes:int):
+        """Resets (and sets the number of) episodes for batch functions"""
+        self.episode_states = np.full(nmbr_episodes, self.s_init, dtype=np.int64)
+        self.episode_steps  = np.zeros(nmbr_episodes, dtype=np.int64)
+    
+    def reset_episode_ids(self, ids:np.ndarray):
+        """Resets the given episodes"""
+        self.episode_states[ids], self.episode_steps[ids] = self.s_init, 0
+    
+    def step_episodes(self, ids:np.ndarray, actions:np.ndarray):
+        """Performs actions in all given episodes, returns arrays of rewards and dones"""
+        next_states, rewards = self.sample_transitions(self.episode_states[ids], actions)
+        self.episode_states[ids] = next_states
+        self.episode_steps[ids] += 1
+        dones = (np.logical_and(self.has_terminal_state, next_states == self.StateSize-1)
+                 | (self.episode_steps[ids] > self.max_steps))
+        return rewards, dones
+    
+    def measure_episodes(self, ids:np.ndarray):
+        """Returns current states of the given episodes, and the measuring cost"""
+        return self.episode_states[ids], self.MeasureCost
\ No newline at end of file
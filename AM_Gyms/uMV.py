@@ -54,7 +54,17 @@ class uMV_Env(gym.Env):
         return "uMV_{}".format(float_to_str(self.p))
     
     def set_state(self, s):
-        self.s = s
+        self.state = s
+
+    def transition_distribution(self, s, action):
+        """Returns all outcomes of taking action in state s, as list of (prob, snext, reward, done)"""
+        if s == 0:
+            return [(1-self.p, 1, 0, False), (self.p, 2, 0, False)]
+        elif s == 3:
+            return [(1, 3, 0, True)]
+        self.set_state(s)
+        snext, reward, done, _info = self.step(action)
+        return [(1, snext, reward, done)]
     
     
 def float_to_str(float):
@@ -13,6 +13,7 @@ import math as m
 import time
 
 from AM_Gyms.AM_Env_wrapper import AM_ENV
+from AM_Gyms.AM_Belief import Belief
 
 
 class BAM_QMDP:
@@ -22,7 +23,8 @@ class BAM_QMDP:
     ###     INITIALISATION AND DEFINING VARIABLES:      ###
     #######################################################
 
-    def __init__(self, env:AM_ENV, eta = 0.00, nmbr_particles = 100,  offline_training_steps = 0):
+    def __init__(self, env:AM_ENV, eta = 0.00, nmbr_particles = 100,  offline_training_steps = 0,
+                 belief_propagation = "particles", max_belief_support = None, min_probability_considered = 0.001):
         # Environment arguments:
         self.env = env
         self.StateSize, self.ActionSize, self.MeasureCost, self.s_init = env.get_vars()
@@ -33,6 +35,11 @@ class BAM_QMDP:
         # Meta-variables:
         self.eta = eta                              # Chance of picking a non-greedy action (should be called epsilon...)
         self.nmbr_particles = nmbr_particles        # Number of particles used to represent the belief state.
+        self.belief_propagation = belief_propagation    # How next beliefs are computed: "particles" (sampled) or "exact" (sparse, pruned)
+        if max_belief_support is None:
+            max_belief_support = nmbr_particles
+        self.max_belief_support = max_belief_support    # Maximum number of states in an exact belief (only the most likely are kept)
+        self.min_probability_considered = min_probability_considered   # States with lower probability are pruned from exact beliefs
         self.NmbrOptimiticTries = 20                # Meta variable determining for how many tries a transition should be biased.
         self.selfLoopPenalty = 1                 # Penalty applied to Q-value for self loops (1 means no penalty)
         self.lossBoost = 1                          # Testing variable to boost the effect of Measurement Loss/Regret (1 means no boost)
@@ -63,23 +70,24 @@ class BAM_QMDP:
         # Arrays keeping track of model:
         
         # Value Estimation Tables
-        self.QTable             = np.ones ( (self.StateSize, self.ActionSize), dtype=np.longfloat )* self.optimisticPenalty    # Q-table as used by other functions, includes initial bias
+        self.QTable             = np.ones ( (self.StateSize, self.ActionSize) )* self.optimisticPenalty      # Q-table as used by other functions, includes initial bias
 
-        self.QTableUnbiased     = np.zeros( (self.StateSize, self.ActionSize), dtype=np.longfloat )                             # Q-table based solely on experience (unbiased)
+        self.QTableUnbiased     = np.zeros( (self.StateSize, self.ActionSize) )                                 # Q-table based solely on experience (unbiased)
                                                                                          
-        self.QTableRewards      = np.zeros( (self.StateSize, self.ActionSize) )                                                 # Record average immidiate reward for (s,a) (called \hat{R} in report)
-        self.Qmax               = np.zeros( (self.StateSize), dtype=np.longfloat)                                               # Q-value of optimal action as given by Q (used for readability)
-        self.QMaxUnbiased       = np.zeros( (self.StateSize), dtype=np.longfloat)
+        self.QTableRewards      = np.zeros( (self.StateSize, self.ActionSize) )                                 # Record average immidiate reward for (s,a) (called \hat{R} in report)
+        self.Qmax               = np.zeros( (self.StateSize) )                                                  # Q-value of optimal action as given by Q (used for readability)
+        self.QMaxUnbiased       = np.zeros( (self.StateSize) )
         self.QCounter           = np.zeros( (self.StateSize, self.ActionSize ))
         
         self.QTableUnbiased[self.doneState] = 0
         self.QTable[self.doneState]         = 0
         
         
-        self.alpha              = np.ones ( (self.StateSize, self.ActionSize, self.StateSize) ) * self.initPrior                 # Alpha-values used for dirichlet-distributions.
-        self.alpha_sum          = np.ones ( (self.StateSize, self.ActionSize) ) * (self.initPrior * self.StateSize)
+        # Dirichlet-distributions for T: alpha[s,a,s'] = initPrior + T_counts[(s,a)][s'], with only observed successors s' stored.
+        self.T_counts           = {}                                                                            # (s,a) -> {s': observed count}
+        self.T_arrays           = {}                                                                            # (s,a) -> arrays of observed successors & counts (built when used)
+        self.alpha_sum          = np.ones ( (self.StateSize, self.ActionSize) ) * (self.initPrior * self.StateSize)  # Sum of all alpha-values of (s,a)
         self.ChangedStates      = {}
-        self.T                  = np.zeros((self.StateSize, self.ActionSize, self.StateSize), dtype=np.longfloat) # States to be checked in global Q update
         # Other vars:
         self.totalReward        = 0     # reward over all episodes
         self.totalSteps         = 0     # steps over all episodes
@@ -107,12 +115,10 @@ class BAM_QMDP:
         self.init_episode_variables()
 
         # Initialise state, history, and previous state vars
-        s = {}
         if self.s_init == -1: # Random start
-            for i in range(self.StateSize):
-                s[i] = 1.0/self.StateSize
+            s = Belief(np.arange(self.StateSize), np.ones(self.StateSize)/self.StateSize)
         else:
-            s[self.s_init] = 1
+            s = Belief.point(self.s_init)
         next_action_known = False
  
         ### MAIN LOOP ###
@@ -151,8 +157,7 @@ class BAM_QMDP:
                 self.measurements_taken += 1
             
             #6: Update b_next
-                b_next.clear()
-                b_next[s_next] = 1
+                b_next = Belief.point(s_next)
                 
             #7: Update P:
                 self.update_T(s,b_next,action, self.is_done)
@@ -178,8 +183,11 @@ class BAM_QMDP:
         return returnVars  
             
 
-    def run(self, nmbr_episodes, get_full_results=False, print_info = False, logmessages = True):
-        "Performs the specified number of episodes of BAM-QMDP."
+    def run(self, nmbr_episodes, get_full_results=False, print_info = False, logmessages = True, logging = None):
+        """Performs the specified number of episodes of BAM-QMDP.
+        If logging is given (as by Run.py), it replaces logmessages and full results are returned."""
+        if logging is not None:
+            logmessages, get_full_results = logging, True
         self.init_run_variables()
         epreward,epsteps,epms = np.zeros((nmbr_episodes)), np.zeros((nmbr_episodes)), np.zeros((nmbr_episodes))
         for i in range(nmbr_episodes):
@@ -194,11 +202,11 @@ class BAM_QMDP:
         if print_info:
             print("""
 Run complete: 
-Alpha table: {}
+Transition counts: {}
 QTable: {}
 Rewards Table: {}
 Unbiased QTable: {}            
-            """.format(self.alpha,  self.QTable, self.QTableRewards, self.QTableUnbiased))
+            """.format(self.T_counts,  self.QTable, self.QTableRewards, self.QTableUnbiased))
         if get_full_results:
             return(self.totalReward, epreward,epsteps,epms)
         return self.totalReward
@@ -207,50 +215,35 @@ Unbiased QTable: {}
     ###                 HELPER FUNCTIONS:               ###
     #######################################################
 
-    def get_action(self,S):
+    def get_action(self,S:Belief):
         "Obtains the most greedy action according to current belief and model."
 
         #Compute optimal action
-        thisQ = np.zeros(self.ActionSize) # weighted value of each action, according to current belief
-        for s in S:
-            p = S[s]
-            thisQ += self.QTable[s]*p
+        thisQ = S.probs @ self.QTable[S.states] # weighted value of each action, according to current belief
         thisQMax = np.max(thisQ)
         return int(np.random.choice(np.where(np.isclose(thisQ,thisQMax))[0])) #randomize tiebreaks
         
-    def get_loss(self, S, action):
+    def get_loss(self, S:Belief, action):
         "Returns measure regret of taking given action in given belief state"
-        Loss = 0
-        for s in S:
-            p = S[s]
-            QTable_max = np.max(self.QTable[s]) # expected return if we were in state s
-            Loss +=  p * max( 0.0, QTable_max - self.QTableUnbiased[s,action] )
-        return Loss
+        QTable_max = np.max(self.QTable[S.states], axis=1) # expected return if we were in each state
+        return S.probs @ np.maximum( 0.0, QTable_max - self.QTableUnbiased[S.states, action] )
     
     def get_support(self, S, action):
         "Compute transition support of current belief-action pair"
 
         # If belief state becomes too big, always measure
-        if len(S) > 0.5*self.nmbr_particles:
+        if len(S) > 0.5*self.max_belief_support:
             return 0
         
         elif len(S) > 1:
             return self.NmbrOptimiticTries
         
         # Calculate support:
-        support = 0
-        for s in S:
-            support += S[s]*(np.sum(self.alpha[s,action] ) - self.StateSize*self.initPrior )
-        return support
-
-    def check_validity_belief(self, b:dict):
-        if self.doneState in b:
-            p_done = b[self.doneState]
-            b.pop(self.doneState)
-            scaling_factor = 1 / (1-p_done)
-            for s in b:
-                b[s] = b[s] * scaling_factor
-        return b
+        return S.probs @ (self.alpha_sum[S.states,action] - self.StateSize*self.initPrior)
+
+    def check_validity_belief(self, b:Belief):
+        "Removes done-state from belief (and renormalises)"
+        return b.without(self.doneState)
     
     
     def _dict_to_arrays_(self, S):
@@ -271,45 +264,113 @@ Unbiased QTable: {}
         return particles
     
     def sample_T(self,s, action, nmbr=1):
-        "Returns a (sampled) transition function according to current dirichlet distribution"
+        """Returns a (sampled) transition function according to current dirichlet distribution, as (states, probs, rest):
+        the probabilities of all observed successors, and the remaining probability (spread uniformly over all other states)"""
+        states, observed = self.get_counts(s, action)
+        nmbr_unobserved = self.StateSize - np.size(states)
         if self.use_exp:
             if self.alpha_sum[s,action] > 8:
-                return (self.alpha[s,action] - self.initPrior) / (self.alpha_sum[s,action] - ( self.StateSize * self.initPrior) )
-            return (self.alpha[s,action]) / self.alpha_sum[s,action]
+                return states, observed / (self.alpha_sum[s,action] - ( self.StateSize * self.initPrior) ), 0.0
+            return states, (observed + self.initPrior) / self.alpha_sum[s,action], self.initPrior * nmbr_unobserved / self.alpha_sum[s,action]
         if nmbr != 1:
             print("Average samples not implemented yet!")
-        return self.dirichlet_approx(alpha = self.alpha[s,action], nmbr_samples = 1)
-        
+        # Sample from the dirichlet distribution, with the probability of all unobserved states sampled as one component
+        gammas = np.random.gamma(np.append(observed + self.initPrior, self.initPrior * nmbr_unobserved))
+        gammas = gammas / np.sum(gammas)
+        return states, gammas[:-1], gammas[-1]
+    
+    def get_counts(self, s, action):
+        "Returns (sorted) arrays of all observed successors of (s,action) and their counts"
+        if (s, action) not in self.T_arrays:
+            counts = self.T_counts.get((s, action), {})
+            states = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            observed = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+            order = np.argsort(states)
+            self.T_arrays[(s, action)] = (states[order], observed[order])
+        return self.T_arrays[(s, action)]
+    
+    def sample_unobserved(self, sources, action):
+        "Returns random successors of (s,action) which have not been observed yet, for each s in sources"
+        s_next = np.empty(np.size(sources), dtype=np.int64)
+        for s in np.unique(sources):
+            observed_states, _counts = self.get_counts(s, action)
+            todo = np.flatnonzero(sources == s)
+            while np.size(todo) > 0:
+                s_next[todo] = np.random.randint(self.StateSize, size=np.size(todo))
+                todo = todo[np.isin(s_next[todo], observed_states)]
+        return s_next
         
     def guess_next_state(self, S, action):
         "Samples a next belief state after action a, according to current belief and model."
+        if self.belief_propagation == "exact":
+            return self.propagate_belief(S, action)
 
-        # Sample probability distribution for next state 
-        probDist = np.zeros(self.StateSize)
-        for s in S:
-            probDist += S[s] * self.sample_T(s,action)
-        
-        # Filter all zero-probability states for efficiency
-        states = np.arange(self.StateSize)
-        filter = np.nonzero(probDist)
-        probDist, states = probDist[filter], states[filter]
+        # Sample probability distribution for next state: probabilities of observed successors, and remaining probabilities per state of S
+        if len(S) == 1:
+            next_states, probs, rest = self.sample_T(S.states[0], action)
+            probDist = np.append(probs, rest)
+        else:
+            next_states, next_probs, rests = [np.zeros(0, dtype=np.int64)], [np.zeros(0)], np.zeros(len(S))
+            for (i, (s, p)) in enumerate(S.items()):
+                states, probs, rest = self.sample_T(s,action)
+                next_states.append(states)
+                next_probs.append(p * probs)
+                rests[i] = p * rest
+            next_states = np.concatenate(next_states)
+            probDist = np.append(np.concatenate(next_probs), rests)
 
         # Fix normalisation problems
         if np.sum(probDist) == 0:
-            probDist, states = np.ones(self.StateSize)/self.StateSize, np.arange(self.StateSize)
-        elif np.sum(probDist) < 1:
-            probDist = probDist/np.sum(probDist)
+            SnextArray = np.random.randint(self.StateSize, size=self.nmbr_particles)
         
-        # Sample next states
-        SnextArray = np.random.choice(states, size=self.nmbr_particles, p=probDist)
+        # Sample next states: either an observed successor, or a random unobserved successor of a state in S
+        else:
+            choices = np.random.choice(np.size(probDist), size=self.nmbr_particles, p=probDist/np.sum(probDist))
+            SnextArray = np.empty(self.nmbr_particles, dtype=np.int64)
+            observed = choices < np.size(next_states)
+            SnextArray[observed] = next_states[choices[observed]]
+            if not np.all(observed):
+                SnextArray[~observed] = self.sample_unobserved(S.states[choices[~observed] - np.size(next_states)], action)
 
         # Combine states into a probability distr.
-        S_next = {}
         states, counts = np.unique(SnextArray, return_counts=True)
-        for i in range(len(states)):
-            s = states[i]
-            S_next[int(s)] = counts[i] * 1/self.nmbr_particles
-        return S_next
+        return Belief(states, counts * 1/self.nmbr_particles)
+
+    def propagate_belief(self, S, action):
+        """Returns the next belief state after action a, computed exactly from the current belief and (expected or sampled) model.
+        Only observed successors are included (the probability of unobserved ones is dropped), and the belief is pruned
+        to the max_belief_support most likely states with probability at least min_probability_considered."""
+        if len(S) == 1:
+            states, probs, _rest = self.sample_T(S.states[0], action)
+        else:
+            next_states, next_probs = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+            for (s, p) in S.items():
+                states, probs, _rest = self.sample_T(s, action)
+                next_states.append(states)
+                next_probs.append(p * probs)
+            states, probs = np.concatenate(next_states), np.concatenate(next_probs)
+            if np.size(states) > 0:
+                b_next = Belief.from_unsorted(states, probs)
+                states, probs = b_next.states, b_next.probs
+
+        # If no successors have been observed, all states are equally likely
+        total = np.sum(probs)
+        if total == 0:
+            states = np.sort(np.random.choice(self.StateSize, size=min(self.max_belief_support, self.StateSize), replace=False))
+            return Belief(states, np.ones(np.size(states)) / np.size(states))
+
+        # Prune unlikely states, then keep only the most likely ones
+        probs = probs / total
+        filter = probs >= self.min_probability_considered
+        if not np.any(filter):
+            filter = probs > 0
+        if np.sum(filter) > self.max_belief_support:
+            filter = np.zeros(np.size(probs), dtype=bool)
+            filter[np.argpartition(-probs, self.max_belief_support)[:self.max_belief_support]] = True
+        if not np.all(filter):
+            states, probs = states[filter], probs[filter]
+            probs = probs / np.sum(probs)
+        return Belief(states, probs)
     
     
 
@@ -326,19 +387,24 @@ Unbiased QTable: {}
             
             # If done, we can update alphas regardless of whether we measured.
             if isDone:
-                self.alpha[s1,action,self.doneState] += p1
-                self.alpha_sum[s1,action] += p1
+                self.add_count(s1, action, self.doneState, p1)
             
             # Otherwise, update alpha normally when measuring
             elif len(S2) == 1 and len(S1) == 1:
                 for s2 in S2:
-                    self.alpha[s1,action,s2] += p1
-                    self.alpha_sum[s1,action] += p1
+                    self.add_count(s1, action, s2, p1)
             
             # If not measuring
             else:
                 pass
                                      
+    def add_count(self, s1, action, s2, p):
+        "Adds (probability) p to the observed count of transition (s1, a, s2)"
+        counts = self.T_counts.setdefault((s1, action), {})
+        counts[s2] = counts.get(s2, 0) + p
+        self.alpha_sum[s1,action] += p
+        self.T_arrays.pop((s1, action), None)
+                                     
     def update_Q_lastStep_only(self,S1, S2, action, reward, isDone = False, isReal = True):
         'Updates Q-table according to transition (S1, a, S2)'
 
@@ -353,9 +419,7 @@ Unbiased QTable: {}
             if not (s1 == self.doneState):
                 if not isDone:
                     if len(S2) > 1 :
-                        dict_this_s = dict()
-                        dict_this_s[s1] = 1
-                        S2 = self.guess_next_state(dict_this_s, action)
+                        S2 = self.guess_next_state(Belief.point(s1), action)
                     for s2 in S2:
                         #Compute chance of transition:
                         p2 = S2[s2]
@@ -390,7 +454,7 @@ Unbiased QTable: {}
                     self.QTableRewards[s1,action] = (self.QTableRewards[s1,action]*prevCounter + p1 * reward) / (self.QCounter[s1,action])
                 
                 # Implement bias
-                thisAlpha = np.sum(self.alpha[s1,action]) + p1
+                thisAlpha = self.alpha_sum[s1,action] + p1
 
                 if thisAlpha >= self.NmbrOptimiticTries and self.optimism_type != "UCB":
                     self.QTable[s1,action] = totQ
@@ -410,15 +474,14 @@ Unbiased QTable: {}
         for i in range(self.otsteps):
             # Choose random state and action
             s = np.random.randint(self.StateSize)
-            S_dict = {}
-            S_dict[s] = 1
+            S_point = Belief.point(s)
             
             if np.random.rand() < self.offline_eta:
                 a = np.random.randint(self.ActionSize)
             else:
-                a = self.get_action(S_dict)
+                a = self.get_action(S_point)
                 
-            if np.sum(self.alpha[s,a]) > 5:
-                b_next = self.guess_next_state(S_dict,a)
+            if self.alpha_sum[s,a] > 5:
+                b_next = self.guess_next_state(S_point,a)
                 r = self.QTableRewards[s,a]
-                self.update_Q_lastStep_only(S_dict, b_next,a, r, isReal=False)
+                self.update_Q_lastStep_only(S_point, b_next,a, r, isReal=False)
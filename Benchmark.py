@@ -0,0 +1,263 @@
+'''
+File for benchmarking the planning stack, such that the effect of optimisations can be measured, e.g.:
+
+        python Benchmark.py run                                  (run all benchmarks, compare with the stored baseline)
+        python Benchmark.py run -filter micro/next_belief macro/R-ATM
+        python Benchmark.py baseline                             (run all benchmarks, store them as the new baseline)
+        python Benchmark.py compare Data/Benchmarks/latest.json -threshold 0.1
+
+Micro-benchmarks time single functions (belief updates, action choices, measuring values, worst-case beliefs,
+robust model updates, environment steps and model learning) on beliefs reached during planning.
+Macro-benchmarks time full episodes of ATM, R-ATM and CR-ATM on several environments and sizes.
+
+Environments, models and agents are set up as in Run.py (which is run in this process, with models from the model cache).
+Reported times are medians over a number of repeats, per call (micro) or per episode (macro). Since these depend on
+the machine, the baseline should be re-recorded when changing machines.
+'''
+import os
+import io
+import sys
+import json
+import runpy
+import platform
+import datetime
+import itertools
+import argparse
+import contextlib
+import time as t
+import numpy as np
+
+from AM_Gyms.AM_Belief import Belief
+from AM_Gyms.ModelLearner_V2 import ModelLearner
+from AM_Gyms.ModelLearner_Robust import ModelLearner_Robust
+import ACNO_Beliefs as sparse
+from ACNO_Planning import next_belief, optimal_action, measuring_value, custom_worst_belief
+
+run_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Run.py")
+benchmark_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Data", "Benchmarks")
+
+micro_names = ["next_belief", "next_belief_sparse", "optimal_action", "optimal_action_sparse", "measuring_value", "measuring_value_sparse",
+               "custom_worst_belief", "worst_belief_solver", "custom_delta_minimize", "GenericAMGym.step", "ModelLearner.run_setStates"]
+
+# Planners of the macro-benchmarks, with the algorithm (as in Run.py) and whether they plan with robust models
+macro_algos = {"ATM": ("ATM", False), "R-ATM": ("ATM_Robust", True), "CR-ATM": ("ATM_Control_Robust", True)}
+
+######################################################
+        ###     Setup & timing        ###
+######################################################
+
+runs = {}
+
+def setup_run(algo:str, env:str, size:int, alpha_plan:float = 1):
+    """Runs Run.py (for one episode, without saving) in this process and returns its globals (agent, get_env, get_plan_env, ...).
+    Runs are only set up once per set of arguments."""
+    arguments = ["-algo", algo, "-env", env, "-env_size", str(size), "-alpha_plan", str(alpha_plan), "-alpha_measure", "1",
+                 "-nmbr_eps", "1", "-save", "False"]
+    if tuple(arguments) not in runs:
+        sys.argv = [run_file] + arguments
+        with contextlib.redirect_stdout(io.StringIO()):
+            runs[tuple(arguments)] = runpy.run_path(run_file, run_name="__main__")
+    return runs[tuple(arguments)]
+
+def time_calls(function, min_time:float = 0.1, repeats:int = 5):
+    """Returns (median time per call, number of calls per repeat) of function(), calling it often enough
+    for each repeat to take at least min_time. The first (calibration) repeat is not counted."""
+    number = 1
+    while True:
+        t_start = t.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = t.perf_counter() - t_start
+        if elapsed >= min_time:
+            break
+        number = number * min(10, max(2, int(min_time / max(elapsed, 1e-9)) + 1))
+    times = []
+    for _ in range(repeats):
+        t_start = t.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((t.perf_counter() - t_start) / number)
+    return float(np.median(times)), number
+
+def cycling(function, inputs:list):
+    """Returns function without arguments, which calls function on the next element of inputs on each call"""
+    inputs = itertools.cycle(inputs)
+    return lambda: function(*next(inputs))
+
+def reachable_beliefs(agent, nmbr_beliefs:int = 20, depth:int = 5):
+    """Returns (belief, action) pairs as reached by not measuring for up to depth steps from random states"""
+    rng, pairs = np.random.default_rng(0), []
+    while len(pairs) < nmbr_beliefs:
+        b = Belief.point(int(rng.integers(agent.StateSize - 1)))
+        for _ in range(depth):
+            a = sparse.optimal_action(b, agent.Q)
+            pairs.append((b, a))
+            b = agent.engine.next_belief(b, a)
+    return pairs[:nmbr_beliefs]
+
+def robust_rows(model, nmbr_rows:int = 100):
+    """Returns inputs of custom_delta_minimize for random state-action pairs of a robust model"""
+    rng, rows = np.random.default_rng(0), []
+    Pmin, Pmax, _R = model.get_uncertain_tables()
+    Pavg, _R, _Q = model.get_avg_tables()
+    _P, Q, _R = model.get_robust_tables()
+    Q_max = np.max(Q, axis=1)
+    for _ in range(nmbr_rows):
+        s, a = int(rng.integers(model.StateSize - 1)), int(rng.integers(model.ActionSize))
+        states = list(Pavg[s][a].keys())
+        rows.append((np.array([Pmin[s][a][snext] for snext in states]), np.array([Pmax[s][a][snext] for snext in states]),
+                     np.array([Pavg[s][a][snext] for snext in states]), Q_max[states]))
+    return rows
+
+def env_stepper(env):
+    """Returns function taking a random step in env (resetting it when done)"""
+    actions = itertools.cycle(np.random.default_rng(0).integers(env.ActionSize, size=1000).tolist())
+    env.reset()
+    def step():
+        _reward, done = env.step(next(actions))
+        if done:
+            env.reset()
+    return step
+
+######################################################
+        ###     Benchmarks        ###
+######################################################
+
+def micro_benchmarks(env:str, size:int, alpha:float):
+    """Returns dict of all micro-benchmarks (as functions without arguments) on the given environment"""
+    g = setup_run("ATM_Robust", env, size, alpha)
+    agent, model = g["agent"], g["get_plan_env"](0)
+    P, Q, _R = model.get_robust_tables()
+    Pmin, Pmax, _R = model.get_uncertain_tables()
+    np.random.seed(0)
+    pairs = reachable_beliefs(agent)
+    dict_pairs = [(b.to_dict(), a) for (b, a) in pairs]
+    learner = ModelLearner(g["get_env"](0, get_base=True), df=0.99)
+
+    def learn():
+        with contextlib.redirect_stdout(io.StringIO()):
+            learner.run_setStates(10, logging=False)
+
+    return {"next_belief":              cycling(lambda b, a: next_belief(b, a, P), dict_pairs),
+            "next_belief_sparse":       cycling(agent.engine.next_belief, pairs),
+            "optimal_action":           cycling(lambda b, a: optimal_action(b, Q), dict_pairs),
+            "optimal_action_sparse":    cycling(lambda b, a: sparse.optimal_action(b, Q), pairs),
+            "measuring_value":          cycling(lambda b, a: measuring_value(b, a, Q), dict_pairs),
+            "measuring_value_sparse":   cycling(lambda b, a: sparse.measuring_value(b, a, Q, agent.V_measure), pairs),
+            "custom_worst_belief":      cycling(lambda b, a: custom_worst_belief(b, a, P, Pmin, Pmax, Q), dict_pairs),
+            "worst_belief_solver":      cycling(agent.solver.solve, pairs),
+            "custom_delta_minimize":    cycling(ModelLearner_Robust.custom_delta_minimize, robust_rows(model)),
+            "GenericAMGym.step":        env_stepper(g["get_env"](0)),
+            "ModelLearner.run_setStates": learn}
+
+def macro_benchmark(algo:str, env:str, size:int, alpha:float):
+    """Returns function running one episode of the given planner on the given environment"""
+    algo_name, robust = macro_algos[algo]
+    agent = setup_run(algo_name, env, size, alpha if robust else 1)["agent"]
+    np.random.seed(0)
+    return agent.run_episode
+
+def parse_envs(specs:list):
+    """Returns list of (environment, size) from specifications 'env:size'"""
+    return [(spec.split(":")[0], int(spec.split(":")[1]) if ":" in spec else 0) for spec in specs]
+
+def selected(name:str, filters:list):
+    return not filters or any(f in name for f in filters)
+
+def run_benchmarks(args):
+    """Runs all (selected) benchmarks, returns dict of results by benchmark name"""
+    results = {}
+    def record(name, function):
+        with contextlib.redirect_stdout(io.StringIO()):
+            time, number = time_calls(function, float(args.min_time), int(args.repeats))
+        results[name] = {"time": time, "calls": number}
+        print("{:<60} {:>12}".format(name, format_time(time)))
+
+    if "micro" in args.suites:
+        for (env, size) in parse_envs(args.micro_envs):
+            names = [name for name in micro_names if selected("micro/{}/{}_{}".format(name, env, size), args.filter)]
+            if names:
+                benchmarks = micro_benchmarks(env, size, float(args.alpha))
+                for name in names:
+                    record("micro/{}/{}_{}".format(name, env, size), benchmarks[name])
+    if "macro" in args.suites:
+        for ((env, size), algo) in itertools.product(parse_envs(args.macro_envs), macro_algos):
+            name = "macro/{}/{}_{}".format(algo, env, size)
+            if selected(name, args.filter):
+                record(name, macro_benchmark(algo, env, size, float(args.alpha)))
+    return results
+
+######################################################
+        ###     Results & comparison        ###
+######################################################
+
+def format_time(time:float):
+    for (unit, factor) in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if time >= factor:
+            return "{:.3g} {}".format(time / factor, unit)
+    return "{:.3g} ns".format(time / 1e-9)
+
+def export_results(results:dict, path:str):
+    """Writes results (with a description of this machine) to path"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as outfile:
+        json.dump({"machine":   {"platform": platform.platform(), "processor": platform.processor(),
+                                 "cpus": os.cpu_count(), "python": platform.python_version()},
+                   "date":      datetime.datetime.now().isoformat(timespec="seconds"),
+                   "results":   results}, outfile, indent=1)
+
+def import_results(path:str):
+    with open(path, 'r') as infile:
+        return json.load(infile)["results"]
+
+def compare(results:dict, baseline:dict, threshold:float):
+    """Prints the change of all benchmarks w.r.t. the baseline, returns names of those slower by more than threshold (relative)"""
+    regressions = []
+    print("\n{:<60} {:>12} {:>12} {:>8}".format("Benchmark", "Baseline", "Current", "Ratio"))
+    for name in sorted(set(results) | set(baseline)):
+        if name not in baseline:
+            print("{:<60} {:>12} {:>12}  (not in baseline)".format(name, "-", format_time(results[name]["time"])))
+            continue
+        if name not in results:
+            continue
+        ratio = results[name]["time"] / baseline[name]["time"]
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            status = "faster"
+        else:
+            status = ""
+        print("{:<60} {:>12} {:>12} {:>7.2f}x {}".format(name, format_time(baseline[name]["time"]), format_time(results[name]["time"]), ratio, status))
+    print("\n{} of {} benchmarks slower than the baseline by more than {:.0%}".format(len(regressions), len(set(results) & set(baseline)), threshold))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run micro- and macro-benchmarks of the planning stack, and compare them to a baseline")
+    parser.add_argument('command'           , choices = ['run', 'baseline', 'compare'], help='run: run & compare with baseline, baseline: run & store as baseline, compare: compare stored results with baseline')
+    parser.add_argument('results'           , default = os.path.join(benchmark_folder, "latest.json"), nargs='?', help='Results file (written by run, read by compare)')
+    parser.add_argument('-baseline'         , default = os.path.join(benchmark_folder, "baseline.json"), help='Baseline file')
+    parser.add_argument('-threshold'        , default = 0.25,       help='Relative slowdown reported as regression (default: 0.25)')
+    parser.add_argument('-suites'           , default = ['micro', 'macro'], nargs='+', help='Suites to run (micro and/or macro)')
+    parser.add_argument('-filter'           , default = [],         nargs='+', help='Only run benchmarks with names containing any of these strings')
+    parser.add_argument('-micro_envs'       , default = ['SnakeMaze:10', 'Maintenance:16'], nargs='+', help='Environments (env:size) of the micro-benchmarks')
+    parser.add_argument('-macro_envs'       , default = ['uMV', 'SnakeMaze:10', 'SnakeMaze:20', 'Maintenance:8', 'Maintenance:16', 'Maintenance:32', 'Drone'],
+                                                          nargs='+', help='Environments (env:size) of the macro-benchmarks')
+    parser.add_argument('-alpha'            , default = 0.8,        help='Alpha of the robust models (R-ATM & CR-ATM)')
+    parser.add_argument('-min_time'         , default = 0.1,        help='Minimal time per repeat of a benchmark (s)')
+    parser.add_argument('-repeats'          , default = 5,          help='Number of repeats of each benchmark')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        results = import_results(args.results)
+    else:
+        results = run_benchmarks(args)
+        export_results(results, args.baseline if args.command == 'baseline' else args.results)
+    if args.command == 'baseline':
+        print("Baseline stored in {}".format(args.baseline))
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print("No baseline found at {} (create one with 'python Benchmark.py baseline')".format(args.baseline))
+        sys.exit(0)
+    regressions = compare(results, import_results(args.baseline), float(args.threshold))
+    sys.exit(1 if regressions else 0)
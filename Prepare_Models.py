@@ -0,0 +1,43 @@
+'''
+File for filling the model cache (see AM_Gyms/Model_Cache.py) before running a sweep of experiments, e.g.:
+
+        python Prepare_Models.py -env SnakeMaze -alphas 0.6 0.8 1 -algo ATM_Robust -workers 4
+
+Models are learned by (concurrent) Run.py processes with the -prepare_models option, one per variant, such that they are
+learned exactly as during the experiments. The robust models of all alphas are learned at once (see -prepare_alphas).
+Models which are already pre-computed or cached are not re-learned.
+'''
+import sys
+import subprocess
+import argparse
+import time as t
+from concurrent.futures import ThreadPoolExecutor
+
+def prepare(algo:str, env:str, variant:str, size:int, alphas:list, workers_per_model:int = 1):
+    """Runs Run.py such that all models required for the given experiments are cached (with the robust models
+    for all alphas learned at once). Returns (arguments, return code, time)"""
+    arguments = ["-algo", algo, "-env", env, "-env_var", str(variant), "-env_size", str(size),
+                 "-alpha_real", str(alphas[0]), "-alpha_plan", str(alphas[0]), "-alpha_measure", str(alphas[0]),
+                 "-workers", str(workers_per_model), "-prepare_models", "True", "-prepare_alphas"] + [str(alpha) for alpha in alphas]
+    t_start = t.perf_counter()
+    result = subprocess.run([sys.executable, "Run.py"] + arguments)
+    return arguments, result.returncode, t.perf_counter() - t_start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Learn and cache all models required for a sweep of experiments")
+    parser.add_argument('-algo'             , default = 'ATM',      help='Algorithm the models are used for (only ATM-variants require models)')
+    parser.add_argument('-env'              , default = 'Lake',     help='Environment to learn models for')
+    parser.add_argument('-env_var'          , default = ['None'],   nargs='+', help='Variant(s) of the environment')
+    parser.add_argument('-env_size'         , default = 0,          help='Size of the environment (if applicable)')
+    parser.add_argument('-alphas'           , default = [1],        nargs='+', help='Risk-sensitivity factors to learn models for')
+    parser.add_argument('-workers'          , default = 1,          help='Number of variants learned at once')
+    args = parser.parse_args()
+
+    jobs = [(args.algo, args.env, variant, int(args.env_size), [float(alpha) for alpha in args.alphas]) for variant in args.env_var]
+    with ThreadPoolExecutor(max_workers=int(args.workers)) as executor:
+        results = list(executor.map(lambda job: prepare(*job), jobs))
+
+    failed = [arguments for (arguments, returncode, _time) in results if returncode != 0]
+    print("Prepared models for {} variants ({} failed) in {:.1f} s".format(len(jobs), len(failed), sum(time for (_a, _r, time) in results)))
+    for arguments in failed:
+        print("Failed: python Run.py " + " ".join(arguments))
@@ -8,59 +8,35 @@ For a brief description of how to use it, see the Readme-file in this repo.
 ######################################################
 
 # File structure stuff
+import time as t
+t_imports_start = t.perf_counter()
 import sys
 import os
 
-from AM_Gyms.Avoid import Avoid
 sys.path.append(os.path.join(sys.path[0],"Baselines"))
 sys.path.append(os.path.join(sys.path[0],"Baselines", "ACNO_generalised"))
 
 # External modules
 import numpy as np
-import gym
-import matplotlib.pyplot as plt
-import time as t
 import datetime
 import json
+import copy
 import argparse
-from typing import List, Optional
-import os
+import multiprocessing as mp
 
-# Agents
-import Baselines.AMRL_Agent as amrl
-from Baselines.BAM_QMDP import BAM_QMDP
-# from ACNO_Planning_old import ACNO_Planner, ACNO_Planner_SemiRobust, ACNO_Planner_Correct
-
-from Baselines.ACNO_generalised.Observe_then_plan_agent import ACNO_Agent_OTP
-from Baselines.ACNO_generalised.Observe_while_plan_agent import ACNO_Agent_OWP
-from Baselines.DynaQ import QBasic, QOptimistic, QDyna
-from ACNO_Planning import ACNO_Planner, ACNO_Planner_Robust, ACNO_Planner_Control_Robust
-
-# Environments
-from AM_Gyms.NchainEnv import NChainEnv
-from AM_Gyms.Loss_Env import Measure_Loss_Env
-from AM_Gyms.frozen_lake_v2 import FrozenLakeEnv_v2
-from AM_Gyms.Sepsis.SepsisEnv import SepsisEnv
-from AM_Gyms.Blackjack import BlackjackEnv
-from AM_Gyms.MachineMaintenance import Machine_Maintenance_Env
-from AM_Gyms.frozen_lake import FrozenLakeEnv, generate_random_map, is_valid
+from Run_Results import ResultWriter, stream_file_name
+from ACNO_Profiling import merge_profiles, profile_summary
+
+# Explicit models & environment wrappers
+# (agents and environments themselves are only imported once selected, see the registries below)
 from AM_Gyms.AM_Tables import AM_Environment_Explicit, RAM_Environment_Explicit, OptAM_Environment_Explicit
-from AM_Gyms.uMV import uMV_Env
-from AM_Gyms.uMV2 import uMV2_Env
-from AM_Gyms.DroneInCorridor import DroneInCorridor
-from AM_Gyms.Avoid import Avoid
-from AM_Gyms.CoalOrGold import CoalOrGold
-from AM_Gyms.Maze.maze_env import MazeEnv
-from AM_Gyms.SnakeMaze import SnakeMaze
-
-# Environment wrappers
+from AM_Gyms.Model_Cache import ModelCache
 from AM_Gyms.AM_Env_wrapper import AM_ENV as wrapper
-from AM_Gyms.AM_Env_wrapper import AM_Visualiser as visualiser
-from Baselines.ACNO_generalised.ACNO_ENV import ACNO_ENV
-
-from AM_Gyms.ModelLearner_Robust import ModelLearner_Robust
 from AM_Gyms.generic_gym import GenericAMGym
 
+# Time spent on starting up (reported once the agent is set up)
+startup_times = {"imports": t.perf_counter() - t_imports_start, "environments": 0, "models": 0, "agent": 0}
+
 # JSON encoder
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -93,6 +69,16 @@ parser.add_argument('-env_var_measure'  , default = 0,                  help='En
 parser.add_argument('-alpha_real'       , default = 1,                  help='Risk-sensitivity factor as run on. Negative values are best-cases.')
 parser.add_argument('-beta'             , default = 0,                  help='Factor of randomising real env from RMDP version (unused).' )
 parser.add_argument('-env_remake'       , default=True,                 help='Option to make a new (random) environment each run or not')
+parser.add_argument('-resume'           , default = False,              help='Option to continue a partially finished experiment (with the same file name)')
+parser.add_argument('-workers'          , default = 1,                  help='Number of processes to divide the runs (and model learning) over (default: 1 = all in this process)')
+parser.add_argument('-run_seed'         , default = 0,                  help='Root seed from which the seeds of individual runs are derived when using multiple workers (default: 0)')
+parser.add_argument('-compile_depth'    , default = 0,                  help='Depth of the pre-computed belief graph (ATM, ATM_RMDP & ATM_Robust only, default: 0 = not used)')
+parser.add_argument('-batch'            , default = 1,                  help='Number of episodes run in lock-step (ATM planners only, default: 1 = sequential)')
+parser.add_argument('-profile'          , default = False,              help='Option to record time spent per phase of episodes & belief support sizes (ATM planners only, not with -batch)')
+parser.add_argument('-slow_solve_log'   , default = None,               help='Folder to write worst-case belief problems to which take longer than -slow_solve_time (R-ATM & CR-ATM only)')
+parser.add_argument('-slow_solve_time'  , default = 0.01,               help='Solve time (in s) above which worst-case belief problems are logged (default: 0.01)')
+parser.add_argument('-prepare_models'   , default = False,              help='Option to only learn (and cache) the models required for this experiment, without running it')
+parser.add_argument('-prepare_alphas'   , default = [],                 nargs='+', help='With -prepare_models: additional alphas to learn robust models for (all at once, for the planning variant, ATM planners only)')
 
 # Unpacking for use in this file:
 args             = parser.parse_args()
@@ -104,6 +90,13 @@ env_gen          = str(args.env_gen)
 MeasureCost      = float(args.m_cost)
 nmbr_eps         = int(args.nmbr_eps)
 nmbr_runs        = int(args.nmbr_runs)
+batch_size       = int(args.batch)
+compile_depth    = int(args.compile_depth)
+nmbr_workers     = int(args.workers)
+run_seed         = int(args.run_seed)
+profile          = args.profile in [True, "True", "true"]
+resume           = args.resume in [True, "True", "true"]
+prepare_models   = args.prepare_models in [True, "True", "true"]
 file_name        = args.f
 rep_name         = args.rep
 remake_env_opt   = True
@@ -179,314 +172,442 @@ MeasureCost_Taxi_default        = 0.01 / 20
 MeasureCost_Chain_default       = 0.05
 remake_env                      = False
 env_folder_name = os.path.join(os.getcwd(), "AM_Gyms", "Learned_Models")
+model_cache     = ModelCache(os.path.join(env_folder_name, "Cache"))
+
+# Registry of environments: each factory gets (variant, seed) and returns a dict with the (gym) environment 'env',
+# 'StateSize', 'ActionSize', 's_init' and default 'MeasureCost', and optionally 'has_terminal_state' and 'max_steps'.
+# Environment modules are only imported once their environment is selected.
+env_registry = {}
+
+def register_env(name):
+        def register(factory):
+                env_registry[name] = factory
+                return factory
+        return register
+
+# Our custom drone environment
+@register_env("Drone")
+def make_drone_env(variant, seed):
+        from AM_Gyms.DroneInCorridor import DroneInCorridor
+        env = DroneInCorridor()
+        StateSize, ActionSize, s_init = env.get_size()
+        return dict(env=env, StateSize=StateSize, ActionSize=ActionSize, s_init=s_init, MeasureCost=0.01)
+
+# Our two toy environments
+@register_env("uMV")
+def make_uMV_env(variant, seed):
+        from AM_Gyms.uMV import uMV_Env
+        if variant == 'None':           p = 0.5
+        else:                           p = float(variant)
+        return dict(env=uMV_Env(p=p), StateSize=4, ActionSize=2, s_init=0, MeasureCost=0.2)
+
+@register_env("uMV2")
+def make_uMV2_env(variant, seed):
+        from AM_Gyms.uMV2 import uMV2_Env
+        if variant == 'None':           rsmall = 0.8
+        else:                           rsmall = float(variant)
+        return dict(env=uMV2_Env(rsmall=rsmall), StateSize=4, ActionSize=2, s_init=0, MeasureCost=0.2)
+
+@register_env("SnakeMaze")
+def make_snakemaze_env(variant, seed):
+        from AM_Gyms.SnakeMaze import SnakeMaze
+        if env_size == 0:       size = 10
+        else:                   size = int(env_size)
+        env = SnakeMaze(size=size)
+        return dict(env=env, StateSize=env.get_size(), ActionSize=5, s_init=0, MeasureCost=0.001)
+
+# From here on, a lot of testing environments:
+
+# Measure Regret environment (Krale et al, 2023).
+@register_env("Loss")
+def make_loss_env(variant, seed):
+        from AM_Gyms.Loss_Env import Measure_Loss_Env
+        return dict(env=Measure_Loss_Env(), StateSize=4, ActionSize=2, s_init=0, MeasureCost=0.1)
+
+# Frozen lake environment (all variants)
+@register_env("Lake")
+def make_lake_env(variant, seed):
+        from AM_Gyms.frozen_lake import FrozenLakeEnv, generate_random_map
+        from AM_Gyms.frozen_lake_v2 import FrozenLakeEnv_v2
+        global env_size
+        global remake_env
+        if env_size == 0:
+                print("Using standard size map (4x4)")
+                env_size = 4
+        StateSize = env_size**2
+
+        if env_gen == "random":
+                map_name = None
+                desc = generate_random_map(size=env_size, seed = seed)
+        elif env_gen == "standard":
+                if env_size != 4 and env_size != 8:
+                        print("Standard map type can only be used for sizes 4 and 8")
+                else:
+                        map_name = "{}x{}".format(env_size, env_size)
+                        desc = None
+        else:
+                print("Using random map")
+                map_name = None
+                desc = generate_random_map(size=env_size)
+
+        if map_name is None and remake_env_opt:
+                remake_env = True
+        if variant == "det":
+                env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=False)
+        elif variant == "slippery":
+                env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=True)
+        elif variant == "semi-slippery":
+                env = FrozenLakeEnv_v2(desc=desc, map_name=map_name)
+        elif variant == None:
+                env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=False)
+        else: #default = deterministic
+                print("Environment var not recognised! (using deterministic variant)")
+                env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=False)
+        return dict(env=env, StateSize=StateSize, ActionSize=4, s_init=0, MeasureCost=MeasureCost_Lake_default)
+
+# Taxi environment, as used in AMRL-Q paper
+@register_env("Taxi")
+def make_taxi_env(variant, seed):
+        import gym
+        return dict(env=gym.make('Taxi-v3'), StateSize=500, ActionSize=6, s_init=-1, MeasureCost=MeasureCost_Taxi_default)
+
+# Chain environment, as used in AMRL-Q paper
+@register_env("Chain")
+def make_chain_env(variant, seed):
+        from AM_Gyms.NchainEnv import NChainEnv
+        if env_size == '10':
+                StateSize = 10
+        elif env_size == '20':
+                StateSize = 20
+        elif env_size == '30':
+                StateSize = 30
+        elif env_size == '50':
+                StateSize = 50
+        else: # default
+                print("env_map not recognised!")
+                StateSize = 20
+        return dict(env=NChainEnv(StateSize), StateSize=StateSize, ActionSize=2, s_init=0, MeasureCost=MeasureCost_Chain_default)
+
+# Sepsis environment, as used in ACNO-paper
+@register_env("Sepsis")
+def make_sepsis_env(variant, seed):
+        from AM_Gyms.Sepsis.SepsisEnv import SepsisEnv
+        return dict(env=SepsisEnv(), StateSize=720, ActionSize=8, s_init=-1, MeasureCost=0.05)
+
+# Standard OpenAI Gym blackjack environment
+@register_env("Blackjack")
+def make_blackjack_env(variant, seed):
+        from AM_Gyms.Blackjack import BlackjackEnv
+        return dict(env=BlackjackEnv(), StateSize=704, ActionSize=2, s_init=-1, MeasureCost=0.05)
+
+# Maintenance environment from Delage and Mannor (2010)
+@register_env("Maintenance")
+def make_maintenance_env(variant, seed):
+        from AM_Gyms.MachineMaintenance import Machine_Maintenance_Env
+        global env_size
+        if env_size == 0:
+                env_size = 10
+        return dict(env=Machine_Maintenance_Env(N=env_size), StateSize=env_size+2, ActionSize=2, s_init=0, MeasureCost=0.01,
+                    has_terminal_state=False, max_steps=50)
+
+# Custom AM version of Storm's 'Avoid' environment
+@register_env("Avoid")
+def make_avoid_env(variant, seed):
+        from AM_Gyms.Avoid import Avoid
+        if variant == "None":   p = 0.5
+        else:                   p = float(variant)
+        env = Avoid(p, max_steps=50)
+        return dict(env=env, StateSize=env.get_size(), ActionSize=5, s_init=0, MeasureCost=0.01, max_steps=50)
+
+# Custom environment
+@register_env("CoalOrGold")
+def make_coalorgold_env(variant, seed):
+        from AM_Gyms.CoalOrGold import CoalOrGold
+        if variant == "None":   p = 0.1
+        else:                   p = float(variant)
+        env = CoalOrGold(p, max_steps=50)
+        return dict(env=env, StateSize=env.get_size(), ActionSize=5, s_init=0, MeasureCost=0.01, max_steps=50)
+
+# OpenAI maze environment
+@register_env("Maze")
+def make_maze_env(variant, seed):
+        from AM_Gyms.Maze.maze_env import MazeEnv
+        if env_size == 0:       size = 25
+        else:                   size = int(env_size)
+        return dict(env=MazeEnv(maze_size=(size,size)), StateSize=size**2 -1, ActionSize=4, s_init=0, MeasureCost=0.005)
+
+# Environments constructed so far, by (seed, variant) and (seed, variant, alpha_real) respectively
+base_envs, robust_envs = {}, {}
 
 def get_env(seed = None, get_base = False, variant=None):
-        "Returns AM_Env as specified in global (user-specified) vars"
+        "Returns AM_Env as specified in global (user-specified) vars. Environments are only constructed once per seed and variant."
         global MeasureCost
-        global remake_env
-        global env_size
-        global env_fullname_run
         if variant is None:
                 variant = env_variant
-        
-        # Required for making robust env through generic-gym class
-        has_terminal_state = True
-        max_steps = 10_000
-        
-        np.random.seed(seed)
-        
 
-        # Basically, just a big messy pile of if/else statements to select the correct model...
-        
-        # Our custom drone environment
-        if env_name == "Drone":
-                env = DroneInCorridor()
-                StateSize, ActionSize, s_init = env.get_size()
-                if MeasureCost == -1:
-                        MeasureCost = 0.01
-
-        # Our two toy environments
-        elif env_name == "uMV":
-                if variant == 'None':           p = 0.5
-                else:                           p = float(variant)
-                env = uMV_Env(p=p)
-                StateSize, ActionSize, s_init = 4, 2, 0
-                if MeasureCost == -1:
-                        MeasureCost = 0.2
-        
-        elif env_name == "uMV2":
-                if variant == 'None':           rsmall = 0.8
-                else:                           rsmall = float(variant)
-                env = uMV2_Env(rsmall=rsmall)
-                StateSize, ActionSize, s_init = 4, 2, 0
-                if MeasureCost == -1:
-                        MeasureCost = 0.2
-        
-        elif env_name == "SnakeMaze":
-                if env_size == 0:       size = 10
-                else:                   size = int(env_size)
-                if variant == 'None':   p = 0.5
-                else:                   p = float(variant)
-                env = SnakeMaze(size=size)
-                StateSize, ActionSize, s_init = env.get_size(), 5, 0
+        np.random.seed(seed)
+        if (seed, variant) not in base_envs:
+                if env_name not in env_registry:
+                        print("Environment {} not recognised, please try again!".format(env_name))
+                        sys.exit(1)
+                t_start = t.perf_counter()
+                settings = env_registry[env_name](variant, seed)
                 if MeasureCost == -1:
-                        MeasureCost = 0.001
-                has_terminal_state = True
-        
+                        MeasureCost = settings["MeasureCost"]
+                ENV = wrapper(settings["env"], settings["StateSize"], settings["ActionSize"], MeasureCost, settings["s_init"])
+                base_envs[(seed, variant)] = ENV, settings
+                startup_times["environments"] += t.perf_counter() - t_start
+        ENV, settings = base_envs[(seed, variant)]
+        args.m_cost = MeasureCost
+        if get_base:
+                return ENV
 
-        # From here on, a lot of testing environments:
-        
-        # Measure Regret environment (Krale et al, 2023).
-        elif env_name == "Loss":
-                env = Measure_Loss_Env()
-                StateSize, ActionSize, s_init = 4, 2, 0
-                if MeasureCost == -1:
-                        MeasureCost = 0.1
-        # Frozen lake environment (all variants)
-        elif env_name == "Lake":
-                ActionSize, s_init = 4,0
-                if MeasureCost == -1:
-                        MeasureCost = MeasureCost_Lake_default
-                if env_size == 0:
-                        print("Using standard size map (4x4)")
-                        env_size = 4
-                        StateSize = 4**2
-                else:
-                        StateSize = env_size**2
-                        
-                if env_gen == "random":
-                        map_name = None
-                        desc = generate_random_map(size=env_size, seed = seed)
-                elif env_gen == "standard":
-                        if env_size != 4 and env_size != 8:
-                                print("Standard map type can only be used for sizes 4 and 8")
-                        else:
-                                map_name = "{}x{}".format(env_size, env_size)
-                                desc = None
-                else:
-                        print("Using random map")
-                        map_name = None
-                        desc = generate_random_map(size=env_size)
-                
-
-
-                if map_name is None and remake_env_opt:
-                        remake_env = True        
-                if variant == "det":
-                        env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=False)
-                elif variant == "slippery":
-                        env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=True)
-                elif variant == "semi-slippery":
-                        env = FrozenLakeEnv_v2(desc=desc, map_name=map_name)
-                elif variant == None:
-                        env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=False)
-                else: #default = deterministic
-                        print("Environment var not recognised! (using deterministic variant)")
-                        env = FrozenLakeEnv(desc=desc, map_name=map_name, is_slippery=False)
-                
-        # Taxi environment, as used in AMRL-Q paper         
-        elif env_name == "Taxi":
-                env = gym.make('Taxi-v3')
-                StateSize, ActionSize, s_init = 500, 6, -1
-                if MeasureCost == -1:
-                        MeasureCost = MeasureCost_Taxi_default
-
-        # Chain environment, as used in AMRL-Q paper
-        elif env_name == "Chain":
-                if env_size == '10':
-                        StateSize = 10
-                elif env_size == '20':
-                        StateSize = 20
-                elif env_size == '30':
-                        StateSize = 30
-                elif env_size == '50':
-                        StateSize = 50
-                else: # default
-                        print("env_map not recognised!")
-                        StateSize = 20
-                        
-                env = NChainEnv(StateSize)
-                ActionSize, s_init = 2, 0
-                if MeasureCost == -1:
-                        MeasureCost = MeasureCost_Chain_default
-        
-        # Sepsis environment, as used in ACNO-paper
-        elif env_name == 'Sepsis':
-                env = SepsisEnv()
-                StateSize, ActionSize, s_init = 720, 8, -1
-                if MeasureCost == -1:
-                        MeasureCost = 0.05
-
-        # Standard OpenAI Gym blackjack environment
-        elif env_name == 'Blackjack':
-                env = BlackjackEnv()
-                StateSize, ActionSize, s_init = 704, 2, -1
-                if MeasureCost ==-1:
-                        MeasureCost = 0.05
-
-        # Maintenance environment from Delage and Mannor (2010)
-        elif env_name == "Maintenance":
-                if env_size == 0:
-                        env_size = 10
-                env = Machine_Maintenance_Env(N=env_size)
-                StateSize, ActionSize, s_init = env_size+2, 2, 0
-                if MeasureCost == -1:
-                        MeasureCost = 0.01
-                has_terminal_state = False
-                max_steps = 50
-        
-        # Custom AM version of Storm's 'Avoid' environment
-        elif env_name == "Avoid":
-                if variant == "None":   p = 0.5
-                else:                   p = float(variant)
-                max_steps = 50
-                env = Avoid(p, max_steps=max_steps)
-                StateSize, ActionSize, s_init = env.get_size(), 5, 0
-                if MeasureCost == -1:
-                        MeasureCost = 0.01
-                has_terminal_state = True
-        
-        # Custom environment
-        elif env_name == "CoalOrGold":
-                if variant == "None":   p = 0.1
-                else:                   p = float(variant)
-                max_steps = 50
-                env = CoalOrGold(p, max_steps=max_steps)
-                StateSize, ActionSize, s_init = env.get_size(), 5, 0
-                if MeasureCost == -1:
-                        MeasureCost = 0.01
-                has_terminal_state = True
-
-        # OpenAI maze environment
-        elif env_name == "Maze":
-                if env_size == 0:       size = 25
-                else:                   size = int(env_size)
-                if variant == 'None':   p = 0.5
-                else:                   p = float(variant)
-                env = MazeEnv(maze_size=(size,size))
-                StateSize, ActionSize, s_init = size**2 -1, 4, 0
-                if MeasureCost == -1:
-                        MeasureCost = 0.005
-                has_terminal_state = True                
-                
-        
-        else:
-                print("Environment {} not recognised, please try again!".format(env_name))
-                return
-        
-        # Create the robust version of the environment (if required)
-        
-        ENV = wrapper(env, StateSize, ActionSize, MeasureCost, s_init)
-        args.m_cost = MeasureCost          
-        if not get_base:
+        # Create the robust version of the environment
+        if (seed, variant, alpha_real) not in robust_envs:
                 # learn the robust env, ...
-                env_explicit = get_explicit_env(ENV, env_folder_name, env_postname_real, alpha_real) 
+                env_explicit = get_explicit_env(ENV, env_folder_name, env_postname_real, alpha_real, variant)
                 if beta > 0:
+                        env_explicit = copy.deepcopy(env_explicit)
                         env_explicit.randomize(beta)
                 # ... then re-make into an openAI environment.
-                P, _Q, R = env_explicit.get_robust_tables() 
-                ENV = GenericAMGym(P, R, StateSize, ActionSize, MeasureCost,s_init, ENV.getname(), has_terminal_state, max_steps)
-        
-        return ENV
+                t_start = t.perf_counter()
+                P, _Q, R = env_explicit.get_robust_tables()
+                robust_envs[(seed, variant, alpha_real)] = GenericAMGym(P, R, settings["StateSize"], settings["ActionSize"], MeasureCost, settings["s_init"],
+                                                                       ENV.getname(), settings.get("has_terminal_state", True), settings.get("max_steps", 10_000))
+                startup_times["environments"] += t.perf_counter() - t_start
+        return robust_envs[(seed, variant, alpha_real)]
 
 ######################################################
         ###     Defining Agents        ###
 ######################################################
 
-def get_explicit_env(ENV, env_folder_name, env_postname, alpha):
-        """Returns an version of the environment with explicit readable transition- and Q-value functions, to use during planning. """
+# Bellman residual up to which robust models are learned (with at most 10_000 sweeps)
+rmdp_tolerance = 1e-6
+
+def base_model_params(ENV, variant):
+        """Returns the parameters identifying the base (MDP) model of ENV in the model cache"""
+        return {"env": ENV.getname(), "variant": str(variant), "size": env_size, "N": 200, "df": 0.99}
+
+def robust_model_params(alpha):
+        """Returns the parameters identifying a robust model (as learned for alpha) in the model cache"""
+        return {"kind": "RMDP" if alpha > 0 else "OptRMDP", "alpha": abs(alpha), "N_robust": 10_000, "tolerance": rmdp_tolerance}
+
+def get_base_model(ENV, variant):
+        """Returns the path of the base (MDP) model of ENV in the model cache, learning it if required"""
+        def learn_base(base_env):
+                try:
+                        base_env.import_model(ENV.getname(), env_folder_name)
+                except FileNotFoundError:
+                        base_env.learn_model_AMEnv(ENV, df=0.99, N=200, workers=nmbr_workers)
+        return model_cache.get(AM_Environment_Explicit(), ENV.getname(), learn_base, kind = "MDP", **base_model_params(ENV, variant))
+
+# Explicit environments constructed so far, by (tag, variant)
+explicit_envs = {}
+
+def get_explicit_env(ENV, env_folder_name, env_postname, alpha, variant=None):
+        """Returns an version of the environment with explicit readable transition- and Q-value functions, to use during planning.
+        Pre-computed models (in env_folder_name) are used if available, otherwise models are learned once and stored in the model cache.
+        Each model is only constructed once (such that e.g. equal planning and measuring models are shared)."""
+        if variant is None:
+                variant = env_variant
+        env_tag = ENV.getname() + env_postname
+        if (env_tag, str(variant)) not in explicit_envs:
+                t_start = t.perf_counter()
+                explicit_envs[(env_tag, str(variant))] = load_explicit_env(ENV, env_folder_name, env_tag, alpha, variant)
+                startup_times["models"] += t.perf_counter() - t_start
+        return explicit_envs[(env_tag, str(variant))]
+
+def load_explicit_env(ENV, env_folder_name, env_tag, alpha, variant):
+        """Returns explicit environment with tag env_tag, imported from env_folder_name or the model cache"""
         if alpha > 0:
                 env_explicit = RAM_Environment_Explicit()
         # We interpret negavive alpha's as optimtic
         elif alpha <0:
                 env_explicit = OptAM_Environment_Explicit()
-                alpha = - alpha
-                
-        env_tag = ENV.getname() + env_postname
         
-        # See if the (base) environment already exists, otherwise learn it.
+        # See if the environment has been pre-computed, otherwise get it from the cache (learning it if required).
         try:
                 env_explicit.import_model(fileName = env_tag, folder = env_folder_name)
         except FileNotFoundError:
-                try:
-                        env_explicit.import_MDP_env(ENV.getname(), folder = env_folder_name)
-                except FileNotFoundError:
-                        base_env = AM_Environment_Explicit()
-                        base_env.learn_model_AMEnv(ENV, df=0.99, N=200)
-                        base_env.export_model(ENV.getname(), env_folder_name)
-                        env_explicit.import_MDP_env(ENV.getname(), folder = env_folder_name)
-                env_explicit.learn_robust_model_Env_alpha(ENV, alpha, df=0.99, N_robust = 50)
-                env_explicit.export_model( env_tag, env_folder_name )
+                base_path = get_base_model(ENV, variant)
+                def learn_robust(env_explicit):
+                        env_explicit.import_MDP_env(os.path.basename(base_path), folder = model_cache.folder)
+                        env_explicit.learn_robust_model_Env_alpha(ENV, abs(alpha), df=0.99, N_robust = 10_000, tolerance = rmdp_tolerance)
+                model_cache.get(env_explicit, env_tag, learn_robust, **base_model_params(ENV, variant), **robust_model_params(alpha))
         env_explicit.MeasureCost = MeasureCost  # This is slightly hacky, cost probably shouldn't be part of the explict env or always be set manually...
         return env_explicit
 
+def prepare_alpha_models(ENV, variant, alphas):
+        """Learns the robust models of ENV for all given alphas at once (see RAM_Environment_Explicit.learn_robust_models_alphas),
+        except for those which are pre-computed or cached already."""
+        for explicit_class in [RAM_Environment_Explicit, OptAM_Environment_Explicit]:
+                todo = [alpha for alpha in alphas if (alpha < 0) == explicit_class.optimistic and alpha != 0
+                        and not ModelCache.contains_path(os.path.join(env_folder_name, ENV.getname() + "_a" + float_to_str(alpha)))
+                        and not model_cache.contains(ENV.getname() + "_a" + float_to_str(alpha), **base_model_params(ENV, variant), **robust_model_params(alpha))]
+                if not todo:
+                        continue
+                family = explicit_class()
+                family.import_MDP_env(os.path.basename(get_base_model(ENV, variant)), folder = model_cache.folder)
+                models = family.learn_robust_models_alphas([abs(alpha) for alpha in todo], df=0.99, N_robust = 10_000, tolerance = rmdp_tolerance)
+                for (alpha, model) in zip(todo, models):
+                        model_cache.get(explicit_class(), ENV.getname() + "_a" + float_to_str(alpha), lambda env_explicit, model=model: env_explicit.env_from_dict(model.env_to_dict()),
+                                        **base_model_params(ENV, variant), **robust_model_params(alpha))
+
+def get_plan_env(seed):
+        """Returns explicit environment used for planning"""
+        return get_explicit_env(get_env(seed, get_base=True, variant = env_variant_plan), env_folder_name, env_postname_plan, alpha_plan, env_variant_plan)
+
+def get_measure_env(seed):
+        """Returns explicit environment used for measuring (Control-Robust ATM only)"""
+        return get_explicit_env(get_env(seed, get_base=True, variant = env_variant_measure), env_folder_name, env_postname_measure, alpha_measure, env_variant_measure)
+
+# Registry of agents: each factory gets (ENV, seed) and returns the agent. Agent modules are only imported once their agent is selected.
+agent_registry = {}
+
+def register_agent(name):
+        def register(factory):
+                agent_registry[name] = factory
+                return factory
+        return register
+
+# ATMavg: the generic planner as used in Krale et al (2023)
+@register_agent("ATM")
+def make_ATM(ENV, seed):
+        from ACNO_Planning import ACNO_Planner
+        return ACNO_Planner(ENV, get_plan_env(seed))
+
+# ATMpes: the same planner, but using the RMDP model
+@register_agent("ATM_RMDP")
+def make_ATM_RMDP(ENV, seed):
+        from ACNO_Planning import ACNO_Planner
+        return ACNO_Planner(ENV, get_plan_env(seed), use_robust=True)
+
+# RATM
+@register_agent("ATM_Robust")
+def make_ATM_Robust(ENV, seed):
+        from ACNO_Planning import ACNO_Planner_Robust
+        return ACNO_Planner_Robust(ENV, get_plan_env(seed))
+
+# MLATM (refered to as 'control-robust' in code)
+@register_agent("ATM_Control_Robust")
+def make_ATM_Control_Robust(ENV, seed):
+        from ACNO_Planning import ACNO_Planner_Control_Robust
+        return ACNO_Planner_Control_Robust(ENV, get_plan_env(seed), get_measure_env(seed))
+
+# Now, some unused algorithms for generic ACNO-MDPs:
+
+# AMRL-Q, as specified in original paper
+@register_agent("AMRL")
+def make_AMRL(ENV, seed):
+        import Baselines.AMRL_Agent as amrl
+        return amrl.AMRL_Agent(ENV, turn_greedy=True)
+
+# AMRL-Q, alter so it is completely greedy in last steps.
+@register_agent("AMRL_greedy")
+def make_AMRL_greedy(ENV, seed):
+        import Baselines.AMRL_Agent as amrl
+        return amrl.AMRL_Agent(ENV, turn_greedy=False)
+
+# Dyna-ATMQ, from Krale et al (2023). Variant with no offline training
+@register_agent("BAM_QMDP")
+def make_BAM_QMDP(ENV, seed):
+        from Baselines.BAM_QMDP import BAM_QMDP
+        return BAM_QMDP(ENV, offline_training_steps=0)
+
+# BAM_QMDP, but a variant with 25 offline training steps per real step
+@register_agent("BAM_QMDP+")
+def make_BAM_QMDP_plus(ENV, seed):
+        from Baselines.BAM_QMDP import BAM_QMDP
+        return BAM_QMDP(ENV, offline_training_steps=25)
+
+# Both BAM_QMDP variants, but with exact (sparse and pruned) belief propagation instead of particles
+@register_agent("BAM_QMDP_exact")
+def make_BAM_QMDP_exact(ENV, seed):
+        from Baselines.BAM_QMDP import BAM_QMDP
+        return BAM_QMDP(ENV, offline_training_steps=0, belief_propagation="exact")
+
+@register_agent("BAM_QMDP+_exact")
+def make_BAM_QMDP_plus_exact(ENV, seed):
+        from Baselines.BAM_QMDP import BAM_QMDP
+        return BAM_QMDP(ENV, offline_training_steps=25, belief_propagation="exact")
+
+# Observe-while-planning agent from Nam et al (2021). It does not really work...
+@register_agent("ACNO_OWP")
+def make_ACNO_OWP(ENV, seed):
+        from Baselines.ACNO_generalised.ACNO_ENV import ACNO_ENV
+        from Baselines.ACNO_generalised.Observe_while_plan_agent import ACNO_Agent_OWP
+        return ACNO_Agent_OWP(ACNO_ENV(ENV))
+
+# Observe-then-plan agent from Nam et al (2021), with slight alterations
+@register_agent("ACNO_OTP")
+def make_ACNO_OTP(ENV, seed):
+        from Baselines.ACNO_generalised.ACNO_ENV import ACNO_ENV
+        from Baselines.ACNO_generalised.Observe_then_plan_agent import ACNO_Agent_OTP
+        return ACNO_Agent_OTP(ACNO_ENV(ENV))
+
+# A number of generic RL-agents.
+@register_agent("QBasic")
+def make_QBasic(ENV, seed):
+        from Baselines.DynaQ import QBasic
+        return QBasic(ENV)
+
+@register_agent("QOptimistic")
+def make_QOptimistic(ENV, seed):
+        from Baselines.DynaQ import QOptimistic
+        return QOptimistic(ENV)
+
+@register_agent("QDyna")
+def make_QDyna(ENV, seed):
+        from Baselines.DynaQ import QDyna
+        return QDyna(ENV)
+
 def get_agent(seed=None):
         global env_fullname_run
-        
-        # Setting up all different envs that might be required
-        ENV = get_env(seed)
-        env_fullname_run = ENV.getname() + env_postname_run 
-        ENV_base_plan = get_env(seed, get_base=True, variant = env_variant_plan)
-        ENV_base_measure = get_env(seed, get_base=True, variant = env_variant_measure)
 
-        # Now, just a list of if-else statements to select the correct agent:
-        
-        # ATMavg: the generic planner as used in Krale et al (2023)
-        if algo_name == "ATM":
-                env_plan = get_explicit_env(ENV_base_plan, env_folder_name, env_postname_plan, alpha_plan)
-                agent = ACNO_Planner(ENV, env_plan)
-        # ATMpes: the same planner, but using the RMDP model
-        elif algo_name == "ATM_RMDP":
-                env_plan = get_explicit_env(ENV_base_plan, env_folder_name, env_postname_plan, alpha_plan)
-                agent = ACNO_Planner(ENV, env_plan, use_robust=True)
-        # RATM
-        elif algo_name == "ATM_Robust":
-                env_plan = get_explicit_env(ENV_base_plan, env_folder_name, env_postname_plan, alpha_plan)
-                agent = ACNO_Planner_Robust(ENV, env_plan)
-        # MLATM (refered to as 'control-robust' in code)
-        elif algo_name == "ATM_Control_Robust":
-                env_plan = get_explicit_env(ENV_base_plan, env_folder_name, env_postname_plan, alpha_plan)
-                env_measure = get_explicit_env(ENV_base_measure, env_folder_name, env_postname_measure, alpha_measure)
-                agent = ACNO_Planner_Control_Robust(ENV, env_plan, env_measure)
-        
-        # Now, some unused algorithms for generic ACNO-MDPs:
-        
-        # AMRL-Q, as specified in original paper
-        elif algo_name == "AMRL":
-                agent = amrl.AMRL_Agent(ENV, turn_greedy=True)
-                # AMRL-Q, alter so it is completely greedy in last steps.
-        elif algo_name == "AMRL_greedy":
-                agent = amrl.AMRL_Agent(ENV, turn_greedy=False)
-        # Dyna-ATMQ, from Krale et al (2023). Variant with no offline training
-        elif algo_name == "BAM_QMDP":
-                agent = BAM_QMDP(ENV, offline_training_steps=0)
-        # BAM_QMDP, but a variant with 25 offline training steps per real step
-        elif algo_name == "BAM_QMDP+":
-                agent = BAM_QMDP(ENV, offline_training_steps=25)
-        # Observe-while-planning agent from Nam et al (2021). It does not really work...
-        elif algo_name == "ACNO_OWP":
-                ENV_ACNO = ACNO_ENV(ENV)
-                agent = ACNO_Agent_OWP(ENV_ACNO)
-        # Observe-then-plan agent from Nam et al (2021), with slight alterations
-        elif algo_name == "ACNO_OTP":
-                ENV_ACNO = ACNO_ENV(ENV)
-                agent = ACNO_Agent_OTP(ENV_ACNO)
-        # A number of generic RL-agents.
-        elif algo_name == "QBasic":
-                agent = QBasic(ENV)
-        elif algo_name == "QOptimistic":
-                agent = QOptimistic(ENV)
-        elif algo_name == "QDyna":
-                agent = QDyna(ENV)
-        else:
-                        print("Agent not recognised, please try again!")
-        return agent
+        ENV = get_env(seed)
+        env_fullname_run = ENV.getname() + env_postname_run
+        if algo_name not in agent_registry:
+                print("Agent not recognised, please try again!")
+                sys.exit(1)
+        return agent_registry[algo_name](ENV, seed)
 
 ######################################################
         ###     Exporting Results       ###
 ######################################################
 
-agent = get_agent(0)
+def setup_agent(seed=None):
+        """Returns agent as given by get_agent, with pre-computations done (if specified)"""
+        t_start, t_before = t.perf_counter(), startup_times["environments"] + startup_times["models"]
+        agent = get_agent(seed)
+        if compile_depth > 0 and algo_name in ["ATM", "ATM_RMDP", "ATM_Robust"]:
+                agent.compile(compile_depth)
+        if profile and hasattr(agent, "enable_profiling"):
+                agent.enable_profiling()
+        if args.slow_solve_log is not None and hasattr(agent, "solver"):
+                agent.solver.telemetry.log_slow_solves(args.slow_solve_log, float(args.slow_solve_time))
+        startup_times["agent"] += t.perf_counter() - t_start - (startup_times["environments"] + startup_times["models"] - t_before)
+        return agent
+
+def prepare_required_models():
+        """Learns all models required for this experiment (if not pre-computed or cached already)"""
+        if args.prepare_alphas and algo_name in ["ATM", "ATM_RMDP", "ATM_Robust", "ATM_Control_Robust"]:
+                alphas = [float(alpha) for alpha in args.prepare_alphas] + [alpha_plan]
+                alphas += [alpha_real] if env_variant == env_variant_plan else []
+                alphas += [alpha_measure] if env_variant_measure == env_variant_plan else []
+                prepare_alpha_models(get_env(0, get_base=True, variant = env_variant_plan), env_variant_plan, alphas)
+        ENV = get_env(0)
+        if algo_name in ["ATM", "ATM_RMDP", "ATM_Robust", "ATM_Control_Robust"]:
+                get_plan_env(0)
+        if algo_name == "ATM_Control_Robust":
+                get_measure_env(0)
+        print("Models for {} prepared".format(ENV.getname() + env_postname_run))
+
+if prepare_models:
+        prepare_required_models()
+        sys.exit(0)
+
+agent = setup_agent(0)
+print("Startup: imports {imports:.2f} s, environments {environments:.2f} s, models {models:.2f} s, agent {agent:.2f} s".format(**startup_times))
 
 # Automatically creates filename if not specified by user
 if file_name == None:
@@ -513,7 +634,10 @@ def export_data(rewards, steps, measures,
                         'steps_avg'             :avg_steps,
                         'measurements_avg'      :avg_measures,
                         'start_time'            :t_start,
-                        'current_time'          :t.perf_counter()
+                        'current_time'          :t.perf_counter(),
+                        'startup_times'         :startup_times,
+                        'profile'               :run_profile,
+                        'statistics_per_run'    :statistics_per_run
                 }, outfile, cls=NumpyEncoder)
 
 
@@ -524,6 +648,20 @@ def export_data(rewards, steps, measures,
 rewards, steps, measures = np.zeros((nmbr_runs, nmbr_eps)), np.zeros((nmbr_runs, nmbr_eps)), np.zeros((nmbr_runs, nmbr_eps))
 t_start = 0 + t.perf_counter()
 rewards_avg, steps_avg, measures_avg = np.zeros(nmbr_runs), np.zeros(nmbr_runs), np.zeros(nmbr_runs)
+statistics_per_run = [None] * nmbr_runs
+
+# Results are appended to a stream file after each run, and exported as a whole once all runs are done.
+runs_todo = list(range(nmbr_runs))
+if doSave:
+        writer = ResultWriter(rep_name+stream_file_name(file_name), vars(args), t_start, resume)
+        for (i, record) in writer.completed_runs.items():
+                if i < nmbr_runs:
+                        rewards[i], steps[i], measures[i] = record["reward_per_eps"], record["steps_per_eps"], record["measurements_per_eps"]
+                        rewards_avg[i], steps_avg[i], measures_avg[i] =np.average(rewards[i]), np.average(steps[i]),np.average(measures[i])
+                        statistics_per_run[i] = record.get("statistics")
+                        runs_todo.remove(i)
+        if len(runs_todo) < nmbr_runs:
+                print("Resuming: {} of {} runs already done".format(nmbr_runs - len(runs_todo), nmbr_runs))
 
 extra_logging = False
 
@@ -536,17 +674,61 @@ nmbr runs: {}
 nmbr episodes per run: {}.
 """.format(algo_name, env_fullname_run, nmbr_runs, nmbr_eps))
 
-for i in range(nmbr_runs):
+def perform_run(i):
+        """Performs run i with the agent of this process, returns (i, rewards, steps, measures, time taken, info),
+        with info the profile (if recorded) and the statistics of the agent (e.g. solver telemetry) for this run"""
         t_this_start = t.perf_counter()
-        (r_tot, rewards[i], steps[i], measures[i]) = agent.run(nmbr_eps, logging=extra_logging) 
+        if getattr(agent, "profiler", None) is not None:
+                agent.profiler.reset()
+        if batch_size > 1 and hasattr(agent, "run_batched"):
+                (r_tot, rewards_i, steps_i, measures_i) = agent.run_batched(nmbr_eps, batch_size, logging=extra_logging)
+        else:
+                (r_tot, rewards_i, steps_i, measures_i) = agent.run(nmbr_eps, logging=extra_logging)
+        info = {"profile":      agent.profiler.to_dict() if getattr(agent, "profiler", None) is not None else None,
+                "statistics":   agent.statistics() if hasattr(agent, "statistics") else None}
+        return i, rewards_i, steps_i, measures_i, t.perf_counter() - t_this_start, info
+
+def perform_run_worker(task):
+        """Performs run i in a worker process, with its own random seed"""
+        i, seed = task
+        np.random.seed(seed.generate_state(1)[0])
+        return perform_run(i)
+
+# Runs are performed either in this process or divided over a pool of worker processes.
+# Workers are forked (since this file is a script), such that they inherit the agent as set up above,
+# and results are returned in order as soon as they are available.
+# The seed of each run is derived from run_seed and its index, such that results (also when resuming) are reproducible.
+if nmbr_workers > 1 and len(runs_todo) > 0:
+        seeds = np.random.SeedSequence(run_seed).spawn(nmbr_runs)
+        pool = mp.get_context("fork").Pool(min(nmbr_workers, len(runs_todo)))
+        results = pool.imap(perform_run_worker, [(i, seeds[i]) for i in runs_todo])
+else:
+        pool = None
+        results = (perform_run(i) for i in runs_todo)
+
+run_profiles = []
+for (i, rewards_i, steps_i, measures_i, t_this, info) in results:
+        rewards[i], steps[i], measures[i] = rewards_i, steps_i, measures_i
+        statistics_per_run[i] = info["statistics"]
+        if info["profile"] is not None:
+                run_profiles.append(info["profile"])
         rewards_avg[i], steps_avg[i], measures_avg[i] =np.average(rewards[i]), np.average(steps[i]),np.average(measures[i])
-        t_this_end = t.perf_counter()
         if doSave:
-                avg_rewards, avg_steps, avg_measures = np.average(rewards_avg), np.average(steps_avg),np.average(measures_avg)
-                export_data(rewards[:i+1],steps[:i+1],measures[:i+1],
-                            avg_rewards, avg_steps, avg_measures, t_start)
+                writer.append_run(i, rewards[i], steps[i], measures[i], t_this, statistics_per_run[i])
         if extra_logging:
-                print("Run {0} done with average reward {2}! (in {1} s, with {3} steps and {4} measurements avg.)\n".format(i+1, t_this_end-t_this_start, rewards_avg[i], steps_avg[i], measures_avg[i]))
+                print("Run {0} done with average reward {2}! (in {1} s, with {3} steps and {4} measurements avg.)\n".format(i+1, t_this, rewards_avg[i], steps_avg[i], measures_avg[i]))
         # if remake_env and i<nmbr_runs-1:
         #         agent = get_agent(i+1)
+if pool is not None:
+        pool.close()
+        pool.join()
+# Profiles of all runs (if recorded) are summed
+run_profile = merge_profiles(run_profiles) if run_profiles else None
+if run_profile is not None:
+        print(profile_summary(run_profile))
+if doSave:
+        avg_rewards, avg_steps, avg_measures = np.average(rewards_avg), np.average(steps_avg),np.average(measures_avg)
+        writer.finalise(avg_rewards, avg_steps, avg_measures, t.perf_counter())
+        export_data(rewards, steps, measures,
+                    avg_rewards, avg_steps, avg_measures, t_start)
 print("{0} agent done! ({1} runs in {2} s, with average reward {3}, steps {4}, measures {5})\n\n".format(algo_name, nmbr_runs, t.perf_counter()-t_start, np.average(rewards_avg), np.average(steps_avg),np.average(measures_avg)))
@@ -4,6 +4,8 @@
 #       Note: this file has been written to efficiently use all resources on our setup. 
 #       Other setups may require altering the code such that less (or more) runs occur at once.
 #       Furthermore, in running all code in this file may take a long time: in practice we ran our experiments in stages.
+#       Alternatively, each sweep can be run with Sweep.py, which uses all cores and shares models between runs, e.g.:
+#           python3 ./Sweep.py -algos ATM -envs SnakeMaze -alpha_real 0.55:1.01:0.01 -alpha_plan 1 -nmbr_eps 50 -rep Data/Robust_Results/SnakeMaze/
 
 nmbr_cores = 5
 # nmbr_cores=12
@@ -0,0 +1,124 @@
+'''
+File containing the streaming result format used by Run.py.
+
+Results are written as JSON lines: a header with all parameters, then one record per finished run,
+and finally a summary. Since runs are only appended, a (partially) finished experiment can be resumed
+by reading back the completed runs. Running this file converts such files to the JSON layout as used
+by Plot_Data.ipynb, e.g.:
+
+        python Run_Results.py Data/AMData_ATM_Lake_mc001.jsonl
+
+'''
+import json
+import os
+import argparse
+import numpy as np
+
+# Parameters that do not influence results, and thus may differ when resuming
+run_only_parameters = ["nmbr_runs", "f", "rep", "save", "resume", "workers", "batch", "compile_depth", "profile", "slow_solve_log", "slow_solve_time"]
+
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return json.JSONEncoder.default(self, obj)
+
+def stream_file_name(file_name:str):
+    """Returns name of the streaming result file belonging to (JSON) result file file_name"""
+    return os.path.splitext(file_name)[0] + ".jsonl"
+
+def read_results(path:str):
+    """Reads streaming result file, returns (header, {run: record}, summary).
+    Lines which are not fully written (e.g. after a crash) are ignored."""
+    header, runs, summary = None, {}, None
+    with open(path, 'r') as infile:
+        for line in infile:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "parameters" in record:
+                header = record
+            elif "run" in record:
+                runs[record["run"]] = record
+            elif "summary" in record:
+                summary = record["summary"]
+    return header, runs, summary
+
+class ResultWriter():
+    """Appends results to a streaming result file, one run at a time."""
+
+    def __init__(self, path:str, parameters:dict, start_time:float, resume:bool = False):
+        self.path = path
+        self.completed_runs = {}
+        if resume and os.path.exists(path):
+            header, self.completed_runs, _summary = read_results(path)
+            if header is not None and not same_parameters(header["parameters"], parameters):
+                raise ValueError("Cannot resume {}: parameters are different".format(path))
+            if header is not None:
+                # Re-write only the complete records, such that new runs are appended to a valid file
+                self.write(header)
+                for i in sorted(self.completed_runs):
+                    self.write(self.completed_runs[i])
+                return
+            self.completed_runs = {}
+        self.write({"parameters": parameters, "start_time": start_time})
+
+    def write(self, record:dict):
+        mode = 'w' if "parameters" in record else 'a'
+        with open(self.path, mode) as outfile:
+            outfile.write(json.dumps(record, cls=NumpyEncoder) + "\n")
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def append_run(self, i:int, rewards:np.ndarray, steps:np.ndarray, measures:np.ndarray, time:float, statistics:dict = None):
+        record = {"run": i, "reward_per_eps": rewards, "steps_per_eps": steps, "measurements_per_eps": measures, "time": time}
+        if statistics is not None:
+            record["statistics"] = statistics
+        self.write(record)
+        self.completed_runs[i] = record
+
+    def finalise(self, avg_reward:float, avg_steps:float, avg_measures:float, current_time:float):
+        self.write({"summary": {"reward_avg": avg_reward, "steps_avg": avg_steps, "measurements_avg": avg_measures,
+                                "current_time": current_time}})
+
+def same_parameters(parameters:dict, other:dict):
+    """Checks whether two sets of parameters give the same experiment (ignoring run_only_parameters)"""
+    keys = (set(parameters) | set(other)) - set(run_only_parameters)
+    return all(str(parameters.get(key)) == str(other.get(key)) for key in keys)
+
+def to_json(path:str, json_path:str = None):
+    """Converts streaming result file to the JSON layout written by Run.py (export_data)"""
+    if json_path is None:
+        json_path = os.path.splitext(path)[0] + ".json"
+    header, runs, summary = read_results(path)
+    order = sorted(runs)
+    rewards  = [runs[i]["reward_per_eps"] for i in order]
+    steps    = [runs[i]["steps_per_eps"] for i in order]
+    measures = [runs[i]["measurements_per_eps"] for i in order]
+    if summary is None:
+        summary = {"reward_avg"         : np.average(np.mean(rewards, axis=1))  if order else 0,
+                   "steps_avg"          : np.average(np.mean(steps, axis=1))    if order else 0,
+                   "measurements_avg"   : np.average(np.mean(measures, axis=1)) if order else 0,
+                   "current_time"       : None}
+    with open(json_path, 'w') as outfile:
+        json.dump({
+                'parameters'            :header["parameters"],
+                'reward_per_eps'        :rewards,
+                'steps_per_eps'         :steps,
+                'measurements_per_eps'  :measures,
+                'reward_avg'            :summary["reward_avg"],
+                'steps_avg'             :summary["steps_avg"],
+                'measurements_avg'      :summary["measurements_avg"],
+                'start_time'            :header["start_time"],
+                'current_time'          :summary["current_time"],
+                'statistics_per_run'    :[runs[i].get("statistics") for i in order]
+        }, outfile, cls=NumpyEncoder)
+    return json_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert streaming result files (.jsonl) to the JSON layout used by Plot_Data.ipynb")
+    parser.add_argument('files', nargs='+', help='Streaming result files to convert')
+    args = parser.parse_args()
+    for path in args.files:
+        print("{} -> {}".format(path, to_json(path)))
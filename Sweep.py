@@ -0,0 +1,145 @@
+'''
+File for running sweeps of experiments (as in RunAll.sh) from a single Python process, e.g.:
+
+        python Sweep.py -algos ATM ATM_Robust -envs SnakeMaze -alpha_real 0.55:1:0.05 -alpha_plan 1 -nmbr_eps 50 -rep Data/Robust_Results/SnakeMaze/
+
+Each experiment is a call of Run.py (with the same arguments and file naming as from command line), but:
+  - Heavy modules (gym, cvxpy, ...) are imported only once;
+  - All required models are first learned or loaded in this process, then shared with the experiments (see AM_Tables.share_models);
+  - Experiments are run in forked processes over a pool sized to the machine, with the (estimated) longest experiments first.
+
+Values can be given as lists, or as ranges 'start:stop:step' (including stop, as in 'seq start step stop').
+'''
+import os
+import sys
+import runpy
+import itertools
+import argparse
+import traceback
+import time as t
+import multiprocessing as mp
+import numpy as np
+
+from AM_Gyms.AM_Tables import share_models
+
+run_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Run.py")
+
+# Relative cost of running an episode with each algorithm, used to start the longest experiments first
+cost_factors = {"ATM": 1, "ATM_RMDP": 1, "ATM_Robust": 5, "ATM_Control_Robust": 6}
+
+def parse_values(values:list):
+    """Returns list of (string) values, with ranges 'start:stop:step' expanded"""
+    expanded = []
+    for value in values:
+        if ":" in value:
+            start, stop, step = (float(v) for v in value.split(":"))
+            decimals = max(len(v.split(".")[1]) if "." in v else 0 for v in value.split(":"))
+            nmbr_values = int(np.floor((stop - start) / step + 1e-9)) + 1
+            expanded.extend(str(round(start + i*step, decimals)) for i in range(nmbr_values))
+        else:
+            expanded.append(value)
+    return expanded
+
+def make_jobs(args):
+    """Returns all jobs of the sweep, as lists of arguments for Run.py"""
+    jobs = []
+    for (algo, env, variant, size, alpha_real, alpha_plan, alpha_measure) in itertools.product(
+            args.algos, args.envs, args.env_var, args.env_size,
+            parse_values(args.alpha_real), parse_values(args.alpha_plan), parse_values(args.alpha_measure)):
+        jobs.append(["-algo", algo, "-env", env, "-env_var", variant, "-env_size", size,
+                     "-alpha_real", alpha_real, "-alpha_plan", alpha_plan, "-alpha_measure", alpha_measure,
+                     "-m_cost", str(args.m_cost), "-nmbr_eps", str(args.nmbr_eps), "-nmbr_runs", str(args.nmbr_runs),
+                     "-rep", args.rep] + args.extra)
+    return jobs
+
+def estimated_cost(job:list):
+    """Returns estimated (relative) run time of job"""
+    options = dict(zip(job[::2], job[1::2]))
+    return cost_factors.get(options["-algo"], 1) * int(options["-nmbr_eps"]) * int(options["-nmbr_runs"]) * max(int(options["-env_size"]), 1)
+
+def run_in_process(arguments:list):
+    """Runs Run.py with given arguments in this process. Returns exit code (0 if succesful)"""
+    sys.argv = [run_file] + arguments
+    try:
+        runpy.run_path(run_file, run_name="__main__")
+    except SystemExit as e:
+        return e.code or 0
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+def prepare_models(job:list, workers:int):
+    """Learns or loads all models required for job in this process (as decided by Run.py for its algorithm). Returns exit code"""
+    arguments = list(job)
+    for (option, value) in [("-workers", str(workers)), ("-prepare_models", "True")]:
+        if option in arguments:
+            arguments[arguments.index(option)+1] = value
+        else:
+            arguments += [option, value]
+    return run_in_process(arguments)
+
+def run_job(job:list):
+    """Runs job (in a forked process), returns (job, exit code, time)"""
+    np.random.seed()    # (otherwise all forked processes would use the same random numbers)
+    t_start = t.perf_counter()
+    return job, run_in_process(job), t.perf_counter() - t_start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a sweep of experiments (see Run.py for all options)")
+    parser.add_argument('-algos'            , default = ['ATM'],    nargs='+', help='Algorithms to be tested')
+    parser.add_argument('-envs'             , default = ['Lake'],   nargs='+', help='Environments to test on')
+    parser.add_argument('-env_var'          , default = ['None'],   nargs='+', help='Variants of the environments')
+    parser.add_argument('-env_size'         , default = ['0'],      nargs='+', help='Sizes of the environments')
+    parser.add_argument('-alpha_real'       , default = ['1'],      nargs='+', help='Values for alpha_real (or ranges start:stop:step)')
+    parser.add_argument('-alpha_plan'       , default = ['1'],      nargs='+', help='Values for alpha_plan (or ranges start:stop:step)')
+    parser.add_argument('-alpha_measure'    , default = ['0'],      nargs='+', help='Values for alpha_measure (or ranges start:stop:step), 0 means alpha_plan is copied')
+    parser.add_argument('-m_cost'           , default = -1.0,       help='Cost of measuring (default: use as specified by environment)')
+    parser.add_argument('-nmbr_eps'         , default = 500,        help='nmbr of episodes per run')
+    parser.add_argument('-nmbr_runs'        , default = 1,          help='nmbr of runs to perform')
+    parser.add_argument('-rep'              , default = './Data/',  help='Repository to store data (default: ./Data')
+    parser.add_argument('-workers'          , default = os.cpu_count(), help='Number of experiments run at once (default: number of cores)')
+    parser.add_argument('-dry_run'          , default = False,      help='Option to only print the experiments of the sweep')
+    parser.add_argument('-extra'            , default = [],         nargs=argparse.REMAINDER, help='Further arguments passed to Run.py (must be last)')
+    args = parser.parse_args()
+    nmbr_workers = int(args.workers)
+
+    jobs = sorted(make_jobs(args), key=estimated_cost, reverse=True)
+    if args.dry_run in [True, "True", "true"]:
+        for job in jobs:
+            print("python Run.py " + " ".join(job))
+        sys.exit(0)
+    os.makedirs(args.rep, exist_ok=True)
+
+    # Learn or load all models once, after which they are shared with all (forked) experiments.
+    # Robust models for all alphas of an environment are learned at once (for algorithms that use them).
+    t_start = t.perf_counter()
+    share_models()
+    prepared, failed = {}, []     # (exit codes of preparing models, by relevant options)
+    all_alphas = parse_values(args.alpha_real) + parse_values(args.alpha_plan) + [alpha for alpha in parse_values(args.alpha_measure) if float(alpha) != 0]
+    for (algo, env, variant, size) in itertools.product(args.algos, args.envs, args.env_var, args.env_size):
+        group = [job for job in jobs if job[1] == algo and job[3] == env and job[5] == variant and job[7] == size]
+        if prepare_models(group[0] + ["-prepare_alphas"] + all_alphas, nmbr_workers) != 0:
+            failed.extend(group)
+    for job in jobs:
+        options = dict(zip(job[::2], job[1::2]))
+        models_key = tuple(options[o] for o in ["-algo", "-env", "-env_var", "-env_size", "-alpha_real", "-alpha_plan", "-alpha_measure"])
+        if job in failed:
+            continue
+        if models_key not in prepared:
+            prepared[models_key] = prepare_models(job, nmbr_workers)
+        if prepared[models_key] != 0:
+            failed.append(job)
+    print("Models for {} experiments prepared in {:.1f} s".format(len(jobs), t.perf_counter() - t_start))
+
+    # Each experiment is run in its own (forked) process, such that they do not influence each other.
+    jobs = [job for job in jobs if job not in failed]
+    with mp.get_context("fork").Pool(min(nmbr_workers, max(len(jobs), 1)), maxtasksperchild=1) as pool:
+        for (i, (job, exit_code, time)) in enumerate(pool.imap_unordered(run_job, jobs)):
+            if exit_code != 0:
+                failed.append(job)
+            print("[{}/{}] {} in {:.1f} s".format(i+1, len(jobs), "Done" if exit_code == 0 else "FAILED", time))
+
+    print("Sweep of {} experiments done in {:.1f} s ({} failed)".format(len(jobs), t.perf_counter() - t_start, len(failed)))
+    for job in failed:
+        print("Failed: python Run.py " + " ".join(job))